@@ -0,0 +1,291 @@
+"""Run the question paper pipeline headlessly over a manifest of subjects
+
+    python qpg_batch.py manifest.json --out batch_output
+
+The manifest is JSON:
+
+    {
+      "defaults": {"num_papers": 5, "generate": ["bank", "papers"]},
+      "subjects": [
+        {
+          "subject_code": "CS301",
+          "subject_name": "Operating Systems",
+          "syllabus_file": "cs301/syllabus.txt",
+          "course_objectives_file": "cs301/cos.txt",
+          "sample_papers": ["cs301/2022.pdf", "cs301/2023.pdf"],
+          "calibration": {"total_marks": 60, "sections": {"UNIT-I": {"total_section_marks": 12}}},
+          "questions_per_section": 25
+        }
+      ]
+    }
+
+"syllabus" and "course_objectives" may be given inline instead of as files;
+paths are relative to the manifest, and sample papers are named by that
+relative path, so papers with the same file name in different folders are
+kept apart. "generate" lists any of "bank",
+"papers" (LLM generated) and "assembled" (built locally from the bank), and
+"calibration" takes the overrides of qpg_pipeline.calibrate_structure.
+
+Every stage is written to <out>/<subject_code>/ as soon as it finishes and
+status.json records progress, so rerunning the same command resumes each
+subject at the stage that failed and skips subjects that are done. Adding a
+target to a finished subject's "generate" list runs just that stage.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from qpg_metrics import RunMetrics, current_run, stage
+from qpg_pipeline import (
+    LLM_MAX_WORKERS,
+    PipelineError,
+    TEXTRACT_MAX_WORKERS,
+    _llm_tenant,
+    _run_concurrently,
+    analyze_papers_with_syllabus,
+    assemble_question_papers,
+    calibrate_structure,
+    extract_pdf_text,
+    generate_question_bank,
+    generate_question_papers,
+    openai_scheduler,
+    question_store,
+    warm_up_connections,
+)
+
+GENERATION_TARGETS = ("bank", "papers", "assembled")
+DEFAULT_SUBJECT = {"num_papers": 5, "questions_per_section": 25, "generate": ["papers"], "calibration": {}}
+
+def _write_json(path, data):
+    """Write JSON atomically, so an interrupted run never leaves a half-written stage"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _read_text(subject, key, base_dir):
+    """Inline text or the contents of <key>_file, relative to the manifest"""
+    if subject.get(f"{key}_file"):
+        with open(os.path.join(base_dir, subject[f"{key}_file"]), encoding='utf-8') as f:
+            return f.read()
+    return subject.get(key, '')
+
+def load_manifest(path):
+    """Subjects of a manifest with the defaults applied; raises ValueError on bad entries"""
+    manifest = _read_json(path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    defaults = {**DEFAULT_SUBJECT, **manifest.get('defaults', {})}
+    
+    subjects, seen = [], set()
+    for i, entry in enumerate(manifest.get('subjects', [])):
+        subject = {**defaults, **entry}
+        code = subject.get('subject_code')
+        if not code:
+            raise ValueError(f"subject {i + 1} has no subject_code")
+        if code in seen:
+            raise ValueError(f"subject_code {code} appears more than once")
+        seen.add(code)
+        unknown = set(subject['generate']) - set(GENERATION_TARGETS)
+        if unknown:
+            raise ValueError(f"{code}: unknown generate target(s) {', '.join(sorted(unknown))}")
+        if not subject.get('sample_papers'):
+            raise ValueError(f"{code}: no sample_papers")
+        
+        subject['subject_name'] = subject.get('subject_name', code)
+        subject['syllabus'] = _read_text(subject, 'syllabus', base_dir)
+        subject['course_objectives'] = _read_text(subject, 'course_objectives', base_dir)
+        subject['sample_papers'] = {os.path.normpath(p): os.path.join(base_dir, p) for p in subject['sample_papers']}
+        subjects.append(subject)
+    
+    return subjects
+
+class SubjectRun:
+    """Stages of one subject, checkpointed under out_dir"""
+    
+    def __init__(self, subject, out_dir, llm_workers, log):
+        self.subject = subject
+        self.code = subject['subject_code']
+        self.out_dir = out_dir
+        self.llm_workers = llm_workers
+        self.log = log
+        self.status_path = os.path.join(out_dir, 'status.json')
+        self.status = _read_json(self.status_path) if os.path.exists(self.status_path) else {}
+    
+    def _save_status(self, **changes):
+        self.status.update(changes, updated_at=time.time())
+        _write_json(self.status_path, self.status)
+    
+    def _stage_path(self, name):
+        return os.path.join(self.out_dir, f"{name}.json")
+    
+    def _stage_names(self):
+        """Stages the subject's generate targets need, in run order"""
+        targets = self.subject['generate']
+        names = ['extraction', 'analysis']
+        if 'bank' in targets or 'assembled' in targets:
+            names.append('question_bank')
+        if 'papers' in targets:
+            names.append('papers')
+        if 'assembled' in targets:
+            names.append('assembled_papers')
+        return names
+    
+    def _stage(self, name, fn):
+        """Return the saved result of a stage, or run it and save it"""
+        path = self._stage_path(name)
+        if os.path.exists(path):
+            self.log(f"[{self.code}] {name}: reusing {path}")
+            return _read_json(path)
+        
+        self._save_status(status='running', stage=name, error=None)
+        self.log(f"[{self.code}] {name}: running")
+        started = time.time()
+        with stage(name):
+            result = fn()
+        
+        warnings = result.pop('warnings', []) if isinstance(result, dict) else []
+        for warning in warnings:
+            self.log(f"[{self.code}] {name}: warning: {warning}")
+        _write_json(path, result)
+        self.status.setdefault('durations', {})[name] = round(time.time() - started, 2)
+        self.status.setdefault('warnings', {})[name] = warnings
+        self._save_status()
+        return result
+    
+    def _extract(self):
+        files = {}
+        for name, path in self.subject['sample_papers'].items():
+            with open(path, 'rb') as f:
+                files[name] = f.read()
+        
+        results, errors = _run_concurrently(
+            {
+                name: (lambda name, content, emit: extract_pdf_text(name, content, self.code), (name, content))
+                for name, content in files.items()
+            },
+            TEXTRACT_MAX_WORKERS
+        )
+        failures = [f"{name}: {errors[name]}" for name in files if name in errors]
+        failures += [f"{name}: {results[name]['error']}" for name in files if results.get(name, {}).get('error')]
+        papers = [
+            {'filename': name, 'extracted_text': results[name].get('extracted_text', ''), 'text_length': results[name].get('text_length', 0)}
+            for name in files
+            if name in results and results[name].get('extracted_text', '').strip()
+        ]
+        if not papers:
+            raise PipelineError("no sample paper produced any text" + (f" ({'; '.join(failures)})" if failures else ""))
+        return {"papers": papers, "warnings": ["Some papers could not be extracted: " + "; ".join(failures)] if failures else []}
+    
+    def _bank(self, calibrated_structure):
+        result = generate_question_bank(
+            calibrated_structure, self.subject['questions_per_section'], max_workers=self.llm_workers
+        )
+        added = question_store.add(self.code, self.subject['subject_name'], result['question_bank'])
+        self.log(f"[{self.code}] bank: {added} new question(s) saved to the question store")
+        return result
+    
+    def run(self):
+        # A finished subject is rerun only for stages its generate list gained since
+        if self.status.get('status') == 'done' and all(os.path.exists(self._stage_path(name)) for name in self._stage_names()):
+            self.log(f"[{self.code}] already done, skipping")
+            return True
+        
+        subject = self.subject
+        started = time.time()
+        # Subjects share the OpenAI rate limits fairly, like browser sessions
+        _llm_tenant.set(self.code)
+        self.metrics = RunMetrics(self.code)
+        current_run.set(self.metrics)
+        try:
+            extraction = self._stage('extraction', self._extract)
+            analysis = self._stage('analysis', lambda: analyze_papers_with_syllabus(
+                extraction['papers'], subject['subject_name'], subject['syllabus'], subject['course_objectives'],
+                max_workers=self.llm_workers
+            ))
+            
+            # Cheap and driven by the manifest, so always recomputed
+            calibrated_structure = calibrate_structure(
+                analysis, {"num_papers": subject['num_papers'], **subject['calibration']}
+            )
+            _write_json(os.path.join(self.out_dir, 'calibrated_structure.json'), calibrated_structure)
+            
+            targets = subject['generate']
+            bank = None
+            if 'bank' in targets or 'assembled' in targets:
+                bank = self._stage('question_bank', lambda: self._bank(calibrated_structure))
+            if 'papers' in targets:
+                self._stage('papers', lambda: generate_question_papers(
+                    calibrated_structure, subject['num_papers'], max_workers=self.llm_workers
+                ))
+            if 'assembled' in targets:
+                self._stage('assembled_papers', lambda: assemble_question_papers(
+                    calibrated_structure, bank['question_bank'], subject['num_papers']
+                ))
+        except Exception as e:
+            self._save_status(status='failed', error=str(e), traceback=traceback.format_exc(), metrics=self.metrics.summary())
+            self.log(f"[{self.code}] failed at {self.status.get('stage')}: {e}")
+            return False
+        
+        self._save_status(status='done', stage=None, error=None, traceback=None, metrics=self.metrics.summary())
+        total = self.status['metrics'].get('total', {})
+        self.log(f"[{self.code}] done in {time.time() - started:.1f}s, "
+                 f"{total.get('prompt_tokens', 0) + total.get('completion_tokens', 0):,} tokens, ${total.get('cost_usd', 0):.4f}")
+        return True
+
+def run_batch(subjects, out_dir, max_subjects=2, llm_workers=LLM_MAX_WORKERS, force=False, log=print):
+    """Run subjects concurrently; returns {subject_code: succeeded}"""
+    runs = []
+    for subject in subjects:
+        subject_dir = os.path.join(out_dir, subject['subject_code'])
+        os.makedirs(subject_dir, exist_ok=True)
+        run = SubjectRun(subject, subject_dir, llm_workers, log)
+        if force:
+            run.status = {}
+            for name in os.listdir(subject_dir):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(subject_dir, name))
+        runs.append(run)
+    
+    with ThreadPoolExecutor(max_workers=max(1, max_subjects)) as executor:
+        outcomes = list(executor.map(lambda run: run.run(), runs))
+    return {run.code: ok for run, ok in zip(runs, outcomes)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate question banks and papers for every subject of a manifest")
+    parser.add_argument("manifest", help="JSON manifest of subjects")
+    parser.add_argument("--out", default="batch_output", help="output directory, one folder per subject (default: batch_output)")
+    parser.add_argument("--subjects", type=int, default=2, help="subjects processed at the same time (default: 2)")
+    parser.add_argument("--llm-workers", type=int, default=LLM_MAX_WORKERS, help=f"concurrent LLM requests per subject stage (default: {LLM_MAX_WORKERS})")
+    parser.add_argument("--only", action="append", metavar="CODE", help="run only this subject_code (repeatable)")
+    parser.add_argument("--force", action="store_true", help="discard saved stages and start the selected subjects over")
+    args = parser.parse_args(argv)
+    
+    try:
+        subjects = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(f"cannot load manifest: {e}")
+    if args.only:
+        subjects = [s for s in subjects if s['subject_code'] in args.only]
+        if not subjects:
+            parser.error("no subject matches --only")
+    
+    warm_up_connections()
+    outcomes = run_batch(subjects, args.out, args.subjects, args.llm_workers, args.force)
+    failed = [code for code, ok in outcomes.items() if not ok]
+    queue_stats = openai_scheduler.stats()
+    print(f"OpenAI requests: {queue_stats['requests']}, retries: {queue_stats['retries']} "
+          f"({queue_stats['rate_limited']} rate limited), queue wait avg {queue_stats['mean_wait_seconds']:.1f}s, "
+          f"max {queue_stats['max_wait_seconds']:.1f}s")
+    print(f"{len(outcomes) - len(failed)}/{len(outcomes)} subject(s) done" + (f"; failed: {', '.join(failed)}" if failed else ""))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
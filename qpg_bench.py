@@ -0,0 +1,486 @@
+"""Benchmark the pipeline offline against local stand-ins for OpenAI and Textract
+
+    python qpg_bench.py --preset medium
+    python qpg_bench.py --papers 10 --sections 6 --questions 200 --tokens-per-second 400 --rate-limit 0.05
+
+Two HTTP servers are started on localhost: one speaks the streaming chat
+completions API (server-sent events with a final usage chunk), the other
+the Textract extraction API. Both answer with synthetic but well-formed
+responses sized to the scenario, with configurable time to first token,
+token rate, truncation (finish_reason "length") and 429 injection. The
+pipeline is pointed at them through OPENAI_BASE_URL and TEXTRACT_API_URL
+and driven through extraction, analysis, the question bank and the
+papers, with the LLM cache bypassed and every store and cache in a
+temporary directory, so nothing touches the real APIs or the app's data.
+
+The report gives the wall time, throughput and LLM call latency (p50/p95)
+of each stage, from the same qpg_metrics records the app and the batch
+runner produce; --json writes it to a file for comparing runs.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# papers: sample papers uploaded and analyzed, and papers generated; questions: bank questions per section
+PRESETS = {
+    "small": {"papers": 2, "sections": 2, "questions": 25},
+    "medium": {"papers": 5, "sections": 5, "questions": 100},
+    "large": {"papers": 20, "sections": 10, "questions": 500}
+}
+
+_ROMAN = ("I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX", "X", "XI", "XII")
+_SYLLABLES = ("ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "ba", "do", "fi", "gu", "ha", "je", "po")
+# Made-up words; random picks from this many keep synthetic questions far below the duplicate threshold
+_WORDS = tuple(sorted({a + b + c for a in _SYLLABLES for b in _SYLLABLES for c in _SYLLABLES}))
+
+def _section_id(index):
+    return f"UNIT-{_ROMAN[index] if index < len(_ROMAN) else index + 1}"
+
+def _sentence(rng, words):
+    return " ".join(rng.choice(_WORDS) for _ in range(words)).capitalize()
+
+def _topics(sections):
+    return [f"Topic {i + 1}" for i in range(sections * 4)]
+
+def _question(rng, question_id=None, marks=10, topics=()):
+    question = {
+        "question_text": _sentence(rng, rng.randint(18, 40)) + ". Calculate the result.",
+        "visual_aid": {"type": "description", "content": _sentence(rng, 12), "visualization_guide": _sentence(rng, 8)},
+        "given_data": [f"{_sentence(rng, 2)} = {rng.randint(1, 500)} kN" for _ in range(3)],
+        "find": _sentence(rng, 6),
+        "marks": marks,
+        "difficulty": rng.choice(("easy", "medium", "hard")),
+        "bloom_level": rng.choice(("Remember", "Understand", "Apply", "Analyze")),
+        "co": rng.choice(("CO1", "CO2", "CO3", "CO4")),
+        "topic": rng.choice(topics) if topics else "Topic 1",
+        "question_type": rng.choice(("numerical_problem", "theoretical", "mixed"))
+    }
+    if question_id:
+        question = dict({"question_id": question_id}, **question, solution_approach=_sentence(rng, 10))
+    return question
+
+def _sample_paper_text(rng, paper_index, sections):
+    """OCR-like text of one sample paper, as the mock Textract returns it"""
+    lines = ["MODEL INSTITUTE OF TECHNOLOGY", "Mid Semester Examination", "Time: 2 Hours    Max Marks: 40",
+             f"Set {paper_index + 1}", "Answer any ONE question from each unit"]
+    for i in range(sections):
+        lines.append(_section_id(i))
+        for part in ("a", "b"):
+            lines.append(f"{2 * i + 1}{part}) {_sentence(rng, rng.randint(25, 60))}. (10 Marks)")
+    return "\n".join(lines)
+
+def _analysis_response(rng, sections):
+    topics = _topics(sections)
+    return {
+        "are_compatible": True,
+        "compatibility_reason": "Same format across the benchmark papers",
+        "compatibility_score": 90,
+        "subject_analysis": {
+            "subject_name": "Benchmark Subject",
+            "syllabus_coverage": {"full_syllabus_topics": topics, "topics_in_sample_papers": topics[::2]},
+            "question_style_analysis": {"typical_question_formats": ["Calculate the...", "Determine the..."]},
+            "co_alignment": {"co_distribution_observed": {"CO1": 25, "CO2": 25, "CO3": 25, "CO4": 25}}
+        },
+        "common_structure": {
+            "exam_info": {"exam_type": "midterm_exam", "subject_name": "Benchmark Subject", "total_marks": 20 * sections,
+                          "exam_duration_minutes": 120, "total_questions": 2 * sections,
+                          "instruction_text": "Answer any ONE question from each unit"},
+            "sections": [
+                {
+                    "section_id": _section_id(i), "section_name": f"Unit {i + 1} Questions",
+                    "question_count": 2, "marks_per_question": 10, "total_section_marks": 20,
+                    "has_internal_choice": True, "internal_choice_format": "1a/1b",
+                    "observed_topics": topics[4 * i:4 * i + 4],
+                    "question_style_distribution": {"numerical_problems": 60, "theoretical": 30, "mixed": 10},
+                    "difficulty_distribution": {"easy": 25, "medium": 55, "hard": 20},
+                    "bloom_distribution": {"Remember": 10, "Understand": 20, "Apply": 40, "Analyze": 30}
+                }
+                for i in range(sections)
+            ],
+            "overall_distributions": {"co_distribution": {"CO1": 25, "CO2": 25, "CO3": 25, "CO4": 25}}
+        },
+        "generation_ready": {"can_generate": True, "generation_confidence": 90}
+    }
+
+def _structure_from_prompt(prompt):
+    """The calibrated structure JSON a bank or paper prompt embeds"""
+    start = prompt.index("CALIBRATED STRUCTURE:") + len("CALIBRATED STRUCTURE:")
+    return json.JSONDecoder().raw_decode(prompt[start:].lstrip())[0]
+
+def _paper_response(rng, prompt):
+    structure = _structure_from_prompt(prompt)
+    topics = structure.get('generation_params', {}).get('full_syllabus_topics', [])
+    number = 0
+    sections = []
+    for section in structure.get('sections', []):
+        groups = []
+        marks = max(1, section.get('total_section_marks', 20) // 2)
+        for _ in range(section.get('question_count', 2)):
+            number += 1
+            if section.get('has_internal_choice', True):
+                options = [dict(_question(rng, marks=marks, topics=topics), question_number=f"{number}{part}") for part in "ab"]
+                groups.append({"question_group": str(number), "internal_choice": True,
+                               "choice_instruction": "Answer any ONE question from this group", "options": options})
+            else:
+                groups.append(dict(_question(rng, marks=marks, topics=topics), question_group=str(number), internal_choice=False))
+        sections.append({"section_id": section.get('section_id'), "section_name": section.get('section_id'), "questions": groups})
+    exam_info = structure.get('exam_info', {})
+    return {"generated_papers": [{"paper_id": "Paper", "total_marks": exam_info.get('total_marks'),
+                                  "exam_duration": exam_info.get('exam_duration_minutes'),
+                                  "instructions": exam_info.get('instruction_text'), "sections": sections}]}
+
+_BANK_REQUEST = re.compile(r"Generate exactly (\d+) questions for (.+?), with question_id values (\w+?)_Q(\d+) to")
+
+def _bank_response(rng, prompt):
+    match = _BANK_REQUEST.search(prompt)
+    count, section_id, prefix, first = int(match.group(1)), match.group(2), match.group(3), int(match.group(4))
+    topics = _structure_from_prompt(prompt).get('generation_params', {}).get('full_syllabus_topics', [])
+    return {"question_bank": {section_id: [
+        _question(rng, f"{prefix}_Q{first + i:03d}", marks=rng.choice((5, 10)), topics=topics) for i in range(count)
+    ]}}
+
+class MockConfig:
+    """Behaviour of the stand-in servers; counters are updated by the handler threads"""
+
+    def __init__(self, sections, first_token_ms=400, tokens_per_second=150, truncate_rate=0.0, rate_limit=0.0,
+                 retry_after=0.5, textract_ms=1500, seed=0):
+        self.sections = sections
+        self.first_token_ms = first_token_ms
+        self.tokens_per_second = tokens_per_second
+        self.truncate_rate = truncate_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.textract_ms = textract_ms
+        self.rng = random.Random(seed)
+        self.counters = {"connections": 0, "chat_requests": 0, "rate_limited": 0, "truncated": 0, "completion_tokens": 0, "textract_requests": 0}
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def fork_rng(self):
+        """An independent generator per request, so handler threads never share one"""
+        with self._lock:
+            return random.Random(self.rng.getrandbits(64))
+
+# Characters per token for the mock's usage figures, and tokens per streamed event
+_CHARS_PER_TOKEN = 4
+_TOKENS_PER_EVENT = 8
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        # One handler serves every request of a keep-alive connection
+        super().setup()
+        self.config.count("connections")
+
+    def handle(self):
+        # A cancelled generation job closes its stream mid-response
+        try:
+            super().handle()
+        except ConnectionError:
+            pass
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send_json(self, status, payload, headers=()):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self._chat_completion(json.loads(body))
+        elif self.path.rstrip("/").endswith("/textract"):
+            self._textract(body)
+        else:
+            self._send_json(404, {"error": {"message": f"no mock for {self.path}"}})
+
+    def _chat_completion(self, request):
+        config = self.config
+        rng = config.fork_rng()
+        config.count("chat_requests")
+        if rng.random() < config.rate_limit:
+            config.count("rate_limited")
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+                            headers=[("Retry-After", str(config.retry_after))])
+            return
+
+        messages = request.get('messages', [])
+        system = messages[0]['content'] if messages else ""
+        prompt = messages[-1]['content'] if messages else ""
+        if "Write ONE replacement question" in prompt:
+            response = {"question": _question(rng)}
+        elif system.startswith("You are an expert question bank generator"):
+            response = _bank_response(rng, prompt)
+        elif system.startswith("You are an expert question paper generator"):
+            response = _paper_response(rng, prompt)
+        elif system.startswith("You are an expert educational assessment analyst"):
+            response = _analysis_response(rng, config.sections)
+        else:
+            response = {}
+        text = json.dumps(response, indent=2)
+
+        finish_reason = "stop"
+        max_chars = request.get('max_tokens', 16000) * _CHARS_PER_TOKEN
+        if len(text) > max_chars:
+            text, finish_reason = text[:max_chars], "length"
+        elif rng.random() < config.truncate_rate:
+            text, finish_reason = text[:int(len(text) * rng.uniform(0.4, 0.9))], "length"
+        if finish_reason == "length":
+            config.count("truncated")
+        self._stream_completion(request, text, finish_reason)
+
+    def _stream_completion(self, request, text, finish_reason):
+        """Send text as server-sent events at the configured pace, then the usage chunk"""
+        config = self.config
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        model = request.get('model', "gpt-4.1-mini")
+
+        def chunk(choices, usage=None):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model, "choices": choices}
+            if usage is not None:
+                payload["usage"] = usage
+            data = f"data: {json.dumps(payload)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        time.sleep(config.first_token_ms / 1000)
+        step = _TOKENS_PER_EVENT * _CHARS_PER_TOKEN
+        for i in range(0, len(text), step):
+            delta = {"content": text[i:i + step]}
+            if i == 0:
+                delta["role"] = "assistant"
+            chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+            if config.tokens_per_second:
+                time.sleep(_TOKENS_PER_EVENT / config.tokens_per_second)
+        chunk([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+
+        prompt_tokens = sum(len(message.get('content') or '') for message in request.get('messages', [])) // _CHARS_PER_TOKEN
+        completion_tokens = len(text) // _CHARS_PER_TOKEN
+        config.count("completion_tokens", completion_tokens)
+        if (request.get('stream_options') or {}).get('include_usage'):
+            chunk([], usage={"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                             "total_tokens": prompt_tokens + completion_tokens, "prompt_tokens_details": {"cached_tokens": 0}})
+        data = b"data: [DONE]\n\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n0\r\n\r\n")
+        self.wfile.flush()
+
+    def _textract(self, body):
+        """Answer like the Lambda behind TEXTRACT_API_URL: {"body": "{\"results\": [...]}"}"""
+        config = self.config
+        rng = config.fork_rng()
+        config.count("textract_requests")
+        match = re.search(rb'filename="([^"]*)"', body)
+        file_name = match.group(1).decode("utf-8", "replace") if match else "paper.pdf"
+        paper_index = int(re.sub(r"\D", "", file_name) or 0)
+        time.sleep(config.textract_ms / 1000 * rng.uniform(0.8, 1.2))
+        text = _sample_paper_text(rng, paper_index, config.sections)
+        results = [{"file_name": file_name, "extracted_text": text, "text_length": len(text), "final_status": "SUCCEEDED"}]
+        self._send_json(200, {"statusCode": 200, "body": json.dumps({"results": results})})
+
+def start_mock_server(config):
+    """Serve both mocks on a free localhost port; returns (server, base_url)"""
+    handler = type("MockHandler", (_MockHandler,), {"config": config})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="qpg-bench-mock", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def _fake_scans(papers, rng):
+    """Bytes that look like PDFs but have no readable text layer, so every file goes to Textract"""
+    return [(f"sample_paper_{i + 1}.pdf", b"%PDF-1.4\n%scanned\n" + rng.randbytes(200_000)) for i in range(papers)]
+
+def _percentile(values, fraction):
+    """Nearest-rank percentile, None for no values"""
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)] if values else None
+
+def _stage_report(name, seconds, items, unit, events):
+    kind = "textract" if name == "extraction" else "llm"
+    calls = [event for event in events if event.get('kind') == kind and event.get('stage') == name]
+    latencies = [event['seconds'] for event in calls]
+    first_tokens = [event['first_token_seconds'] for event in calls if event.get('first_token_seconds') is not None]
+    return {
+        "stage": name, "seconds": round(seconds, 3), "items": items, "unit": unit,
+        "per_second": round(items / seconds, 2) if seconds else None,
+        "calls": len(calls),
+        "completion_tokens": sum(event.get('completion_tokens', 0) for event in calls),
+        "call_p50": _percentile(latencies, 0.5), "call_p95": _percentile(latencies, 0.95),
+        "first_token_p50": _percentile(first_tokens, 0.5)
+    }
+
+def run_benchmark(papers, sections, questions, config, llm_workers=None, seed=0, warm_up=True):
+    """Drive the pipeline through one scenario against the mocks; returns the report dict
+
+    With warm_up the pooled connections are opened before timing starts, as
+    the app does at startup; without it the first calls pay for them.
+
+    Must run before qpg_pipeline is imported anywhere in the process: the
+    pipeline reads its endpoints, limits and storage paths at import time.
+    """
+    workdir = tempfile.mkdtemp(prefix="qpg_bench_")
+    server, base_url = start_mock_server(config)
+    os.environ.update({
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "sk-bench",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "TEXTRACT_API_URL": f"{base_url}/textract",
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.sqlite3"),
+        "QUESTION_STORE_PATH": os.path.join(workdir, "question_bank.sqlite3"),
+        "TEXTRACT_CACHE_DIR": os.path.join(workdir, "textract"),
+        "PDF_CACHE_DIR": os.path.join(workdir, "pdf"),
+        "METRICS_PATH": os.path.join(workdir, "metrics.jsonl")
+    })
+    import qpg_metrics
+    import qpg_pipeline
+
+    # pypdf logs every fake scan it fails to parse
+    logging.getLogger("pypdf").setLevel(logging.ERROR)
+
+    llm_workers = llm_workers or qpg_pipeline.LLM_MAX_WORKERS
+    qpg_metrics.current_run.set(qpg_metrics.RunMetrics("bench"))
+    qpg_pipeline._llm_cache_bypass.set(True)
+    qpg_pipeline._llm_tenant.set("bench")
+    rng = random.Random(seed)
+    if warm_up:
+        thread = qpg_pipeline.warm_up_connections()
+        if thread:
+            thread.join()
+
+    try:
+        started = time.perf_counter()
+        job_id = qpg_pipeline.submit_textract_job(_fake_scans(papers, rng), "BENCH", use_cache=False)
+        while qpg_pipeline.get_textract_job(job_id)['state'] != 'done':
+            time.sleep(0.05)
+        results = qpg_pipeline.get_textract_job(job_id)['result']['results']
+        extraction_seconds = time.perf_counter() - started
+        paper_texts = [{"filename": result['file_name'], "extracted_text": result['extracted_text'], "text_length": result['text_length']}
+                       for result in results if result and 'error' not in result]
+
+        started = time.perf_counter()
+        syllabus = "\n".join(f"{_section_id(i)}: " + ", ".join(_topics(sections)[4 * i:4 * i + 4]) for i in range(sections))
+        analysis = qpg_pipeline.analyze_papers_with_syllabus(
+            paper_texts, "Benchmark Subject", syllabus, "CO1: Apply\nCO2: Analyze", max_workers=llm_workers
+        )
+        analysis_seconds = time.perf_counter() - started
+        calibrated = qpg_pipeline.calibrate_structure(analysis, {"num_papers": papers})
+
+        started = time.perf_counter()
+        bank = qpg_pipeline.generate_question_bank(calibrated, questions, max_workers=llm_workers)
+        bank_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        generated = qpg_pipeline.generate_question_papers(calibrated, papers, max_workers=llm_workers)
+        papers_seconds = time.perf_counter() - started
+    finally:
+        server.shutdown()
+
+    events = list(qpg_metrics.read_events())
+    stages = [
+        _stage_report("extraction", extraction_seconds, len(paper_texts), "files", events),
+        _stage_report("analysis", analysis_seconds, len(paper_texts), "papers", events),
+        _stage_report("question_bank", bank_seconds, sum(len(q) for q in bank['question_bank'].values()), "questions", events),
+        _stage_report("papers", papers_seconds, len(generated['generated_papers']), "papers", events)
+    ]
+    return {
+        "scenario": {"papers": papers, "sections": sections, "questions": questions, "llm_workers": llm_workers, "warm_up": warm_up,
+                     "first_token_ms": config.first_token_ms, "tokens_per_second": config.tokens_per_second,
+                     "truncate_rate": config.truncate_rate, "rate_limit": config.rate_limit, "textract_ms": config.textract_ms},
+        "stages": stages,
+        "total_seconds": round(sum(s['seconds'] for s in stages), 3),
+        "mock": dict(config.counters),
+        "scheduler": qpg_pipeline.openai_scheduler.stats(),
+        "warnings": analysis.get('warnings', []) + bank.get('warnings', []) + generated.get('warnings', []),
+        "workdir": workdir
+    }
+
+def _format_seconds(value):
+    return f"{value:8.2f}" if value is not None else f"{'-':>8}"
+
+def print_report(report):
+    scenario = report['scenario']
+    print(f"Scenario: {scenario['papers']} paper(s), {scenario['sections']} section(s), {scenario['questions']} bank questions per section, "
+          f"{scenario['llm_workers']} LLM workers; {scenario['first_token_ms']} ms to first token, "
+          f"{scenario['tokens_per_second']} tokens/s, {scenario['truncate_rate']:.0%} truncated, {scenario['rate_limit']:.0%} rate limited")
+    print(f"{'stage':14} {'wall s':>8} {'items':>7} {'per s':>8} {'calls':>6} {'tokens':>9} {'p50 s':>8} {'p95 s':>8} {'ttft s':>8}")
+    for s in report['stages']:
+        print(f"{s['stage']:14} {s['seconds']:8.2f} {s['items']:>7} {_format_seconds(s['per_second'])} {s['calls']:>6} "
+              f"{s['completion_tokens']:>9,} {_format_seconds(s['call_p50'])} {_format_seconds(s['call_p95'])} {_format_seconds(s['first_token_p50'])}")
+    mock, scheduler = report['mock'], report['scheduler']
+    print(f"Total {report['total_seconds']:.2f}s; mock served {mock['chat_requests']} completions ({mock['rate_limited']} answered 429, "
+          f"{mock['truncated']} truncated) and {mock['textract_requests']} Textract calls over {mock['connections']} connection(s); "
+          f"scheduler retries: {scheduler['retries']}, queue wait p95 {scheduler['p95_wait_seconds']:.2f}s")
+    for warning in report['warnings']:
+        print(f"Warning: {warning}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against local mock OpenAI and Textract servers")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small", help="scenario size (default: small)")
+    parser.add_argument("--papers", type=int, help="sample papers to extract and analyze, and papers to generate")
+    parser.add_argument("--sections", type=int, help="sections per paper")
+    parser.add_argument("--questions", type=int, help="bank questions per section")
+    parser.add_argument("--llm-workers", type=int, help="concurrent LLM requests per stage (default: LLM_MAX_WORKERS)")
+    parser.add_argument("--first-token-ms", type=float, default=400, help="mock time to first token (default: 400)")
+    parser.add_argument("--tokens-per-second", type=float, default=150, help="mock streaming rate per completion, 0 for unthrottled (default: 150)")
+    parser.add_argument("--truncate", type=float, default=0.0, help="share of completions cut off with finish_reason length (default: 0)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of completions answered with 429 (default: 0)")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="Retry-After seconds sent with a 429 (default: 0.5)")
+    parser.add_argument("--textract-ms", type=float, default=1500, help="mock Textract time per file (default: 1500)")
+    parser.add_argument("--cold", action="store_true", help="skip the connection warm-up, so the first calls pay for connecting")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic content and injected failures")
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    args = parser.parse_args(argv)
+
+    scenario = dict(PRESETS[args.preset])
+    scenario.update({key: getattr(args, key) for key in scenario if getattr(args, key) is not None})
+    if "qpg_pipeline" in sys.modules:
+        parser.error("qpg_pipeline is already imported; run the benchmark in a fresh process")
+    config = MockConfig(scenario['sections'], args.first_token_ms, args.tokens_per_second, args.truncate,
+                        args.rate_limit, args.retry_after, args.textract_ms, args.seed)
+    try:
+        report = run_benchmark(scenario['papers'], scenario['sections'], scenario['questions'], config, args.llm_workers, args.seed, not args.cold)
+    except Exception as e:
+        print(f"Benchmark failed: {e}", file=sys.stderr)
+        return 1
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,418 @@
+"""Export generated question papers to PDF and question banks to Excel/CSV
+
+Papers are rendered with reportlab on a pool of worker processes, since
+layout is CPU-bound Python, and bundled into one ZIP. Rendered PDFs are
+cached on disk by paper content, so exporting the same papers again only
+rebuilds the ZIP.
+
+Question banks are written row by row, straight from the question store
+if need be, so exporting tens of thousands of questions uses little memory.
+"""
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO, TextIOWrapper
+from xml.sax.saxutils import escape
+
+try:
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+    from reportlab.lib.units import mm
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.platypus import KeepTogether, Paragraph, Preformatted, SimpleDocTemplate, Spacer, Table, TableStyle
+except ImportError:  # PDF export is unavailable without reportlab
+    A4 = None
+
+PDF_EXPORT_WORKERS = int(os.getenv("PDF_EXPORT_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(".qpg_cache", "pdf"))
+PDF_CACHE_MAX_MB = int(os.getenv("PDF_CACHE_MAX_MB", "200"))
+
+# A TrueType font with Greek letters and math symbols, used when present
+PDF_FONT_DIR = os.getenv("PDF_FONT_DIR", "/usr/share/fonts/truetype/dejavu")
+
+# Bump when the layout changes so cached PDFs are rendered again
+PDF_LAYOUT_VERSION = 1
+
+_pdf_cache = None
+_pdf_executor = None
+
+def _fonts():
+    """(regular, bold, monospace) font names, registering DejaVu once per process if available"""
+    try:
+        pdfmetrics.getFont("QPGSans")
+        return "QPGSans", "QPGSans-Bold", "QPGMono"
+    except KeyError:
+        pass
+    try:
+        pdfmetrics.registerFont(TTFont("QPGSans", os.path.join(PDF_FONT_DIR, "DejaVuSans.ttf")))
+        pdfmetrics.registerFont(TTFont("QPGSans-Bold", os.path.join(PDF_FONT_DIR, "DejaVuSans-Bold.ttf")))
+        pdfmetrics.registerFont(TTFont("QPGMono", os.path.join(PDF_FONT_DIR, "DejaVuSansMono.ttf")))
+        return "QPGSans", "QPGSans-Bold", "QPGMono"
+    except Exception:
+        return "Helvetica", "Helvetica-Bold", "Courier"
+
+def _styles():
+    regular, bold, mono = _fonts()
+    base = getSampleStyleSheet()
+    return {
+        "title": ParagraphStyle("QPGTitle", parent=base["Title"], fontName=bold, fontSize=15, spaceAfter=2 * mm),
+        "subtitle": ParagraphStyle("QPGSubtitle", parent=base["Normal"], fontName=regular, fontSize=10, alignment=TA_CENTER),
+        "section": ParagraphStyle("QPGSection", parent=base["Heading2"], fontName=bold, fontSize=12, spaceBefore=4 * mm, spaceAfter=2 * mm),
+        "body": ParagraphStyle("QPGBody", parent=base["Normal"], fontName=regular, fontSize=10, leading=13),
+        "bold": ParagraphStyle("QPGBold", parent=base["Normal"], fontName=bold, fontSize=10, leading=13),
+        "small": ParagraphStyle("QPGSmall", parent=base["Normal"], fontName=regular, fontSize=8, leading=10, textColor=colors.grey),
+        "or": ParagraphStyle("QPGOr", parent=base["Normal"], fontName=bold, fontSize=10, alignment=TA_CENTER, spaceBefore=1 * mm, spaceAfter=1 * mm),
+        "mono": ParagraphStyle("QPGMono", parent=base["Code"], fontName=mono, fontSize=8, leading=9.5, leftIndent=2 * mm)
+    }
+
+def _text(value):
+    return escape(str(value if value is not None else "")).replace("\n", "<br/>")
+
+def _question_cell(question, styles):
+    """Flowables for one question: text, visual aid, given data and what to find"""
+    cell = [Paragraph(_text(question.get('question_text', '')), styles["body"])]
+
+    visual_aid = question.get('visual_aid') or {}
+    if visual_aid.get('content'):
+        if visual_aid.get('type') == 'ascii':
+            cell.append(Spacer(1, 1 * mm))
+            cell.append(Preformatted(visual_aid['content'], styles["mono"]))
+        else:
+            cell.append(Paragraph(f"<i>Figure: {_text(visual_aid['content'])}</i>", styles["body"]))
+
+    given_data = question.get('given_data') or []
+    if given_data:
+        cell.append(Paragraph("<b>Given:</b> " + "; ".join(_text(item) for item in given_data), styles["body"]))
+    if question.get('find'):
+        cell.append(Paragraph(f"<b>Find:</b> {_text(question['find'])}", styles["body"]))
+    return cell
+
+def _question_row(question, styles):
+    return [
+        Paragraph(f"<b>{_text(question.get('question_number', ''))}</b>", styles["body"]),
+        _question_cell(question, styles),
+        Paragraph(_text(question.get('co', '')), styles["small"]),
+        Paragraph(_text(question.get('bloom_level', '')), styles["small"]),
+        Paragraph(f"<b>{_text(question.get('marks', ''))}</b>", styles["body"])
+    ]
+
+def _question_table(rows):
+    table = Table(rows, colWidths=[12 * mm, 118 * mm, 14 * mm, 18 * mm, 12 * mm])
+    table.setStyle(TableStyle([
+        ("VALIGN", (0, 0), (-1, -1), "TOP"),
+        ("LEFTPADDING", (0, 0), (-1, -1), 2),
+        ("RIGHTPADDING", (0, 0), (-1, -1), 2)
+    ]))
+    return table
+
+def render_paper_pdf(paper, exam_info):
+    """Render one generated paper to PDF bytes; runs in a worker process"""
+    styles = _styles()
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(
+        buffer, pagesize=A4, leftMargin=15 * mm, rightMargin=15 * mm, topMargin=15 * mm, bottomMargin=15 * mm,
+        title=str(paper.get('paper_id', 'Question Paper')), author="Question Paper Generator"
+    )
+
+    total_marks = paper.get('total_marks') or exam_info.get('total_marks', '')
+    duration = paper.get('exam_duration') or exam_info.get('exam_duration_minutes', '')
+    instructions = paper.get('instructions') or exam_info.get('instruction_text', '')
+    story = [
+        Paragraph(_text(exam_info.get('subject_name', 'Question Paper')), styles["title"]),
+        Paragraph(_text(f"{paper.get('paper_id', '')} · {paper.get('difficulty_level', '')} level"), styles["subtitle"]),
+        Spacer(1, 3 * mm),
+        Table(
+            [[Paragraph(f"<b>Time:</b> {_text(duration)} minutes", styles["body"]),
+              Paragraph(f"<b>Max. Marks:</b> {_text(total_marks)}", styles["body"])]],
+            colWidths=[87 * mm, 87 * mm],
+            style=TableStyle([("ALIGN", (1, 0), (1, 0), "RIGHT"), ("LINEBELOW", (0, 0), (-1, 0), 0.5, colors.black)])
+        ),
+        Spacer(1, 2 * mm)
+    ]
+    if instructions:
+        story.append(Paragraph(f"<b>Instructions:</b> {_text(instructions)}", styles["body"]))
+
+    for section in paper.get('sections', []):
+        heading = section.get('section_id', 'Section')
+        if section.get('section_name'):
+            heading = f"{heading}: {section['section_name']}"
+        story.append(Paragraph(_text(heading), styles["section"]))
+
+        for q_group in section.get('questions', []):
+            if q_group.get('internal_choice', False):
+                options = q_group.get('options', [])
+                block = []
+                if q_group.get('choice_instruction'):
+                    block.append(Paragraph(f"<i>{_text(q_group['choice_instruction'])}</i>", styles["small"]))
+                for n, option in enumerate(options):
+                    if n:
+                        block.append(Paragraph("OR", styles["or"]))
+                    block.append(_question_table([_question_row(option, styles)]))
+                story.append(KeepTogether(block))
+            else:
+                story.append(KeepTogether([_question_table([_question_row(q_group, styles)])]))
+            story.append(Spacer(1, 2 * mm))
+
+    doc.build(story)
+    return buffer.getvalue()
+
+def _render_job(job):
+    paper, exam_info = job
+    return render_paper_pdf(paper, exam_info)
+
+def _paper_cache_key(paper, exam_info):
+    payload = json.dumps([PDF_LAYOUT_VERSION, paper, exam_info], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _cache():
+    global _pdf_cache
+    if _pdf_cache is None:
+        # Imported here so worker processes, which only render, do not load the pipeline
+        from qpg_pipeline import BinaryFileCache
+        _pdf_cache = BinaryFileCache(PDF_CACHE_DIR, PDF_CACHE_MAX_MB * 1024 * 1024, suffix=".pdf")
+    return _pdf_cache
+
+def _executor():
+    """The process pool, started on first use and kept warm between exports"""
+    global _pdf_executor
+    if _pdf_executor is None:
+        # spawn: forking the threaded Streamlit server is not safe
+        _pdf_executor = ProcessPoolExecutor(
+            max_workers=PDF_EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pdf_executor
+
+def _render_all(jobs):
+    """Render jobs in the process pool; a single job, or a broken pool, renders in-process"""
+    global _pdf_executor
+    if len(jobs) > 1 and PDF_EXPORT_WORKERS > 1:
+        try:
+            return list(_executor().map(_render_job, jobs))
+        except BrokenProcessPool:
+            _pdf_executor = None
+    return [_render_job(job) for job in jobs]
+
+def _pdf_file_name(paper, index):
+    name = re.sub(r'[^\w.-]+', '_', str(paper.get('paper_id') or f"Paper_{index + 1}")).strip('_')
+    return f"{index + 1:02d}_{name}.pdf"
+
+def export_papers_zip(generation_result, exam_info):
+    """ZIP of one PDF per generated paper; returns (zip_bytes, stats)
+
+    stats has "rendered", "cached" and "seconds". Raises RuntimeError when
+    reportlab is not installed.
+    """
+    if A4 is None:
+        raise RuntimeError("PDF export needs the reportlab package (pip install reportlab)")
+
+    started = time.time()
+    papers = generation_result.get('generated_papers', [])
+    keys = [_paper_cache_key(paper, exam_info) for paper in papers]
+    pdf_cache = _cache()
+    pdfs = [pdf_cache.get(key) for key in keys]
+
+    missing = [i for i, pdf in enumerate(pdfs) if pdf is None]
+    for i, pdf in zip(missing, _render_all([(papers[i], exam_info) for i in missing])):
+        pdfs[i] = pdf
+        try:
+            pdf_cache.put(keys[i], pdf)
+        except OSError:
+            pass
+
+    buffer = BytesIO()
+    # PDFs are already compressed; storing them keeps the ZIP step instant
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for i, (paper, pdf) in enumerate(zip(papers, pdfs)):
+            archive.writestr(_pdf_file_name(paper, i), pdf)
+
+    return buffer.getvalue(), {
+        "rendered": len(missing),
+        "cached": len(papers) - len(missing),
+        "seconds": time.time() - started
+    }
+
+# Question bank export
+
+BANK_EXPORT_FIELDS = (
+    "question_id", "question_text", "given_data", "find", "marks", "difficulty",
+    "bloom_level", "co", "topic", "question_type", "solution_approach"
+)
+_BANK_COLUMN_WIDTHS = (14, 80, 40, 40, 8, 12, 14, 8, 30, 16, 60)
+
+# Excel refuses cells longer than this and XML cannot carry control characters
+_XLSX_MAX_CELL = 32767
+_XML_ILLEGAL = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+_XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{sheets}</Types>'
+)
+_XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+# Style 1 is the bold header row, style 2 wraps long text
+_XLSX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0" applyAlignment="1"><alignment vertical="top" wrapText="1"/></xf>'
+    '</cellXfs></styleSheet>'
+)
+
+def _bank_cell(question, field):
+    """A question field as a cell value: numbers stay numbers, lists are joined, nested data is JSON"""
+    value = question.get(field)
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, (list, tuple)):
+        return "; ".join(item if isinstance(item, str) else json.dumps(item, ensure_ascii=False) for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+def _column_letter(index):
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def _xlsx_row(row_number, values, style):
+    cells = []
+    for n, value in enumerate(values):
+        ref = f"{_column_letter(n)}{row_number}"
+        if isinstance(value, (int, float)):
+            cells.append(f'<c r="{ref}" s="{style}"><v>{value}</v></c>')
+        else:
+            text = escape(_XML_ILLEGAL.sub("", value)[:_XLSX_MAX_CELL])
+            cells.append(f'<c r="{ref}" s="{style}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return f'<row r="{row_number}">{"".join(cells)}</row>'
+
+def _sheet_name(section_id, used):
+    """Excel sheet names: at most 31 characters, none of []:*?/\\ and unique ignoring case"""
+    base = re.sub(r'[\[\]:*?/\\]', '_', str(section_id or "")).strip("'")[:31] or "Section"
+    name, n = base, 1
+    while name.lower() in used:
+        n += 1
+        suffix = f" ({n})"
+        name = base[:31 - len(suffix)] + suffix
+    used.add(name.lower())
+    return name
+
+def write_bank_xlsx(sections, fileobj):
+    """Write a question bank as an XLSX workbook with one sheet per section
+
+    sections is an iterable of (section_id, questions) and each questions
+    iterable is consumed once, row by row. Rows are streamed straight into
+    the ZIP container as inline strings (no shared string table), so memory
+    stays flat however many questions there are. fileobj must be seekable.
+    """
+    sheet_names = []
+    used = set()
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as archive:
+        for section_id, questions in sections:
+            sheet_names.append(_sheet_name(section_id, used))
+            with archive.open(f"xl/worksheets/sheet{len(sheet_names)}.xml", "w") as sheet:
+                sheet.write((
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                    '<sheetViews><sheetView workbookViewId="0">'
+                    '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+                    '</sheetView></sheetViews><cols>'
+                    + "".join(f'<col min="{n}" max="{n}" width="{width}" customWidth="1"/>'
+                              for n, width in enumerate(_BANK_COLUMN_WIDTHS, 1))
+                    + '</cols><sheetData>'
+                    + _xlsx_row(1, BANK_EXPORT_FIELDS, 1)
+                ).encode("utf-8"))
+                for row_number, question in enumerate(questions, 2):
+                    values = [_bank_cell(question, field) for field in BANK_EXPORT_FIELDS]
+                    sheet.write(_xlsx_row(row_number, values, 2).encode("utf-8"))
+                sheet.write(b'</sheetData></worksheet>')
+
+        if not sheet_names:
+            # A workbook needs at least one sheet
+            sheet_names.append("Question Bank")
+            archive.writestr("xl/worksheets/sheet1.xml", (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + _xlsx_row(1, BANK_EXPORT_FIELDS, 1) + '</sheetData></worksheet>'
+            ))
+
+        archive.writestr("[Content_Types].xml", _XLSX_CONTENT_TYPES.format(sheets="".join(
+            f'<Override PartName="/xl/worksheets/sheet{n}.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for n in range(1, len(sheet_names) + 1)
+        )))
+        archive.writestr("_rels/.rels", _XLSX_ROOT_RELS)
+        archive.writestr("xl/workbook.xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+            + "".join(f'<sheet name="{escape(name, {chr(34): "&quot;"})}" sheetId="{n}" r:id="rId{n}"/>'
+                      for n, name in enumerate(sheet_names, 1))
+            + '</sheets></workbook>'
+        ))
+        archive.writestr("xl/_rels/workbook.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + "".join(f'<Relationship Id="rId{n}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                      f'Target="worksheets/sheet{n}.xml"/>' for n in range(1, len(sheet_names) + 1))
+            + f'<Relationship Id="rId{len(sheet_names) + 1}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+            'Target="styles.xml"/></Relationships>'
+        ))
+        archive.writestr("xl/styles.xml", _XLSX_STYLES)
+
+def write_bank_csv(sections, fileobj):
+    """Write a question bank as one CSV, with the section in the first column; streamed row by row
+
+    Encoded as UTF-8 with a BOM so Excel opens symbols and non-ASCII text correctly.
+    """
+    text = TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(("section_id",) + BANK_EXPORT_FIELDS)
+    for section_id, questions in sections:
+        for question in questions:
+            writer.writerow([section_id] + [_bank_cell(question, field) for field in BANK_EXPORT_FIELDS])
+    text.flush()
+    text.detach()
+
+def export_question_bank(sections, file_format="xlsx"):
+    """Question bank file bytes in file_format ("xlsx" or "csv")
+
+    The file is built in a temporary file on disk, so only the finished,
+    compressed result is ever held in memory.
+    """
+    writers = {"xlsx": write_bank_xlsx, "csv": write_bank_csv}
+    if file_format not in writers:
+        raise ValueError(f"Unknown question bank export format: {file_format}")
+    with tempfile.TemporaryFile() as spool:
+        writers[file_format](sections, spool)
+        spool.seek(0)
+        return spool.read()
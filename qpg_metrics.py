@@ -0,0 +1,285 @@
+"""Latency, token and cost instrumentation for the pipeline
+
+Pipeline entry points run inside a stage ("extraction", "analysis",
+"question_bank", "papers", ...). Every OpenAI and Textract call made while
+a stage is active, on any worker thread, is added to that stage's record:
+wall time, calls, LLM cache hits, prompt/completion/cached tokens and the
+estimated cost. Finished stages go to the RunMetrics of the current run
+(a browser session or a batch subject) and, like every call, are appended
+as one JSON line to METRICS_PATH. That file is shared by all sessions and
+processes, so it is the source for latency percentiles across users:
+
+    python qpg_metrics.py                      # p50/p95 per stage
+    python qpg_metrics.py --prometheus > qpg.prom
+
+The second form writes the Prometheus text exposition format, e.g. for
+node_exporter's textfile collector.
+"""
+import argparse
+import contextvars
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Append-only JSONL of stage and call events; empty disables the sink
+METRICS_PATH = os.getenv("METRICS_PATH", os.path.join(".qpg_data", "metrics.jsonl"))
+
+# USD per million tokens: (input, cached input, output); OPENAI_PRICES_JSON overrides or adds models
+MODEL_PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60)
+}
+MODEL_PRICES.update({model: tuple(prices) for model, prices in json.loads(os.getenv("OPENAI_PRICES_JSON", "{}")).items()})
+
+# Upper bounds of the Prometheus latency histograms, in seconds
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600)
+
+_COUNTERS = ("calls", "cache_hits", "prompt_tokens", "completion_tokens", "cached_tokens", "cost_usd",
+             "textract_calls", "textract_seconds")
+
+# The run (RunMetrics) and the open stage record; copied into worker threads with the context
+current_run = contextvars.ContextVar("metrics_run", default=None)
+_current_stage = contextvars.ContextVar("metrics_stage", default=None)
+
+_sink_lock = threading.Lock()
+
+def _write_event(event):
+    """Append one event to METRICS_PATH; metrics must never break a run"""
+    if not METRICS_PATH:
+        return
+    line = json.dumps(event, ensure_ascii=False, default=str) + "\n"
+    try:
+        with _sink_lock:
+            directory = os.path.dirname(METRICS_PATH)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(METRICS_PATH, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError:
+        pass
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """Estimated USD cost of a call; 0 for models without a price"""
+    prices = MODEL_PRICES.get(model)
+    if not prices:
+        return 0.0
+    input_price, cached_price, output_price = prices
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + completion_tokens * output_price) / 1_000_000
+
+class RunMetrics:
+    """Finished stage records of one run: a browser session or a batch subject"""
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self):
+        """{stage: totals} in first-run order, plus "total"; each has count, seconds, failures and _COUNTERS"""
+        with self._lock:
+            records = list(self.records)
+        stages = {}
+        for record in records + [dict(record, stage="total") for record in records]:
+            totals = stages.setdefault(record['stage'], dict.fromkeys(("count", "seconds", "failures") + _COUNTERS, 0))
+            totals['count'] += 1
+            totals['seconds'] += record['seconds']
+            totals['failures'] += 0 if record['ok'] else 1
+            for counter in _COUNTERS:
+                totals[counter] += record.get(counter, 0)
+        return stages
+
+def _add(**amounts):
+    record = _current_stage.get()
+    if record is None:
+        return
+    with record['_lock']:
+        for name, amount in amounts.items():
+            record[name] += amount
+
+@contextmanager
+def stage(name):
+    """Record the enclosed work as a stage; a stage opened inside another is counted in the outer one"""
+    if _current_stage.get() is not None:
+        yield
+        return
+    run = current_run.get()
+    record = {"kind": "stage", "ts": time.time(), "stage": name, "run_id": run.run_id if run else None}
+    record.update(dict.fromkeys(_COUNTERS, 0), _lock=threading.Lock())
+    token = _current_stage.set(record)
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        _current_stage.reset(token)
+        del record['_lock']
+        record.update(seconds=round(time.perf_counter() - started, 3), ok=ok,
+                      cost_usd=round(record['cost_usd'], 6), textract_seconds=round(record['textract_seconds'], 3))
+        if run:
+            run.add(record)
+        _write_event(record)
+
+def timed_stage(name):
+    """Decorator: run the function as stage(name)"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _event_base(kind):
+    record = _current_stage.get()
+    run = current_run.get()
+    return {"kind": kind, "ts": time.time(), "stage": record['stage'] if record else None,
+            "run_id": run.run_id if run else None}
+
+def record_llm_call(model, seconds, queue_seconds, first_token_seconds, prompt_tokens, completion_tokens,
+                    cached_tokens=0, estimated=False):
+    """One completed OpenAI call; estimated is True when the API sent no usage and tokens were counted locally"""
+    cost = estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens)
+    _add(calls=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cached_tokens=cached_tokens, cost_usd=cost)
+    _write_event(dict(
+        _event_base("llm"), model=model, seconds=round(seconds, 3), queue_seconds=round(queue_seconds, 3),
+        first_token_seconds=None if first_token_seconds is None else round(first_token_seconds, 3),
+        prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cached_tokens=cached_tokens,
+        cost_usd=round(cost, 6), estimated=estimated
+    ))
+
+def record_llm_cache_hit(model):
+    _add(cache_hits=1)
+    _write_event(dict(_event_base("llm_cache_hit"), model=model))
+
+def record_textract_call(seconds, size_bytes, ok):
+    _add(textract_calls=1, textract_seconds=seconds)
+    _write_event(dict(_event_base("textract"), seconds=round(seconds, 3), bytes=size_bytes, ok=ok))
+
+def read_events(path=None, since=None):
+    """Events of the JSONL sink, optionally only those at or after the since timestamp; bad lines are skipped"""
+    path = path or METRICS_PATH
+    if not path or not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if since is None or event.get('ts', 0) >= since:
+                yield event
+
+def _percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def latency_summary(events):
+    """{name: {count, p50, p95, max}} for stages and for LLM/Textract calls, in seconds"""
+    samples = {}
+    for event in events:
+        if event.get('kind') == "stage":
+            samples.setdefault(f"stage:{event['stage']}", []).append(event['seconds'])
+        elif event.get('kind') in ("llm", "textract"):
+            samples.setdefault(event['kind'], []).append(event['seconds'])
+    summary = {}
+    for name, values in sorted(samples.items()):
+        values.sort()
+        summary[name] = {"count": len(values), "p50": _percentile(values, 0.5), "p95": _percentile(values, 0.95), "max": values[-1]}
+    return summary
+
+_COUNTER_HELP = {
+    "qpg_tokens_total": "OpenAI tokens by stage, model and type (prompt, completion, cached)",
+    "qpg_cost_usd_total": "Estimated OpenAI cost in USD",
+    "qpg_llm_cache_hits_total": "Completions served from the LLM response cache",
+    "qpg_stage_failures_total": "Stages that raised"
+}
+
+def _labels(labels, **extra):
+    """{name="value",...} with Prometheus label escaping"""
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def render_prometheus(events):
+    """Prometheus text exposition of the events: latency histograms and token, cost and cache counters"""
+    histograms = {"qpg_stage_duration_seconds": {}, "qpg_llm_call_duration_seconds": {}, "qpg_textract_call_duration_seconds": {}}
+    counters = {name: {} for name in _COUNTER_HELP}
+
+    def count(metric, labels, amount=1):
+        counters[metric][labels] = counters[metric].get(labels, 0) + amount
+
+    for event in events:
+        kind = event.get('kind')
+        if kind == "stage":
+            histograms["qpg_stage_duration_seconds"].setdefault((("stage", event['stage']),), []).append(event['seconds'])
+            if not event.get('ok', True):
+                count("qpg_stage_failures_total", (("stage", event['stage']),))
+        elif kind == "llm":
+            model = event.get('model') or "unknown"
+            histograms["qpg_llm_call_duration_seconds"].setdefault((("model", model),), []).append(event['seconds'])
+            for token_type in ("prompt", "completion", "cached"):
+                count("qpg_tokens_total", (("stage", event.get('stage')), ("model", model), ("type", token_type)),
+                      event.get(f"{token_type}_tokens", 0))
+            count("qpg_cost_usd_total", (("stage", event.get('stage')), ("model", model)), event.get('cost_usd', 0))
+        elif kind == "llm_cache_hit":
+            count("qpg_llm_cache_hits_total", (("stage", event.get('stage')),))
+        elif kind == "textract":
+            histograms["qpg_textract_call_duration_seconds"].setdefault((), []).append(event['seconds'])
+
+    lines = []
+    for metric, series in histograms.items():
+        lines += [f"# HELP {metric} Duration in seconds", f"# TYPE {metric} histogram"]
+        for labels, values in sorted(series.items(), key=lambda item: str(item[0])):
+            for bound in LATENCY_BUCKETS:
+                lines.append(f"{metric}_bucket{_labels(labels, le=bound)} {sum(1 for v in values if v <= bound)}")
+            lines.append(f"{metric}_bucket{_labels(labels, le='+Inf')} {len(values)}")
+            lines.append(f"{metric}_sum{_labels(labels)} {round(sum(values), 3)}")
+            lines.append(f"{metric}_count{_labels(labels)} {len(values)}")
+    for metric, series in counters.items():
+        lines += [f"# HELP {metric} {_COUNTER_HELP[metric]}", f"# TYPE {metric} counter"]
+        for labels, value in sorted(series.items(), key=lambda item: str(item[0])):
+            lines.append(f"{metric}{_labels(labels)} {round(value, 6)}")
+    return "\n".join(lines) + "\n"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the pipeline metrics log")
+    parser.add_argument("path", nargs="?", default=METRICS_PATH, help=f"JSONL metrics file (default: {METRICS_PATH})")
+    parser.add_argument("--since-hours", type=float, help="only events from the last N hours")
+    parser.add_argument("--prometheus", action="store_true", help="print the Prometheus text format instead of a table")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.since_hours * 3600 if args.since_hours else None
+    events = list(read_events(args.path, since))
+    if args.prometheus:
+        sys.stdout.write(render_prometheus(events))
+        return 0
+    if not events:
+        print(f"No events in {args.path}")
+        return 1
+    print(f"{'':28} {'count':>7} {'p50 s':>8} {'p95 s':>8} {'max s':>8}")
+    for name, stats in latency_summary(events).items():
+        print(f"{name:28} {stats['count']:>7} {stats['p50']:>8.2f} {stats['p95']:>8.2f} {stats['max']:>8.2f}")
+    llm_events = [event for event in events if event.get('kind') == "llm"]
+    print(f"LLM calls: {len(llm_events)}, tokens: {sum(e.get('prompt_tokens', 0) + e.get('completion_tokens', 0) for e in llm_events):,}, "
+          f"cost: ${sum(e.get('cost_usd', 0) for e in llm_events):.4f}, "
+          f"cache hits: {sum(1 for event in events if event.get('kind') == 'llm_cache_hit')}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
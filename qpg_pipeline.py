@@ -0,0 +1,3536 @@
+"""Question paper generation pipeline, independent of the Streamlit UI
+
+Textract extraction, structure analysis, calibration, question bank and
+paper generation and the local bank/paper tooling. Used by
+qpg_streamlit_app.py and by the qpg_batch.py command line runner.
+Stages raise PipelineError when they produce nothing usable; partial
+failures are returned as messages under "warnings".
+"""
+import contextvars
+import functools
+import hashlib
+import importlib
+import json
+import queue
+import random
+import re
+import sqlite3
+import sys
+import time
+import uuid
+import math
+import threading
+import zlib
+from collections import Counter, deque
+from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+import os
+
+from qpg_metrics import record_llm_cache_hit, record_llm_call, record_textract_call, timed_stage
+
+try:
+    import tiktoken
+except ImportError:  # token counts fall back to a characters-per-token estimate
+    tiktoken = None
+
+# Seconds spent importing each heavy module, on first use rather than at startup
+IMPORT_TIMINGS = {}
+_import_lock = threading.Lock()
+_lazy_modules = {}
+
+def _lazy_import(name, optional=False):
+    """Import a heavy module (openai, numpy, requests, pypdf) the first time it is needed
+
+    openai alone takes most of a second to import, which every Streamlit
+    worker and batch process used to pay up front. optional=True returns
+    None when the module is not installed.
+    """
+    # Not sys.modules: a module another thread is still importing is already listed there, half initialized
+    module = _lazy_modules.get(name)
+    if module is not None:
+        return module
+    with _import_lock:
+        preloaded = name in sys.modules
+        started = time.perf_counter()
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            if optional:
+                return None
+            raise
+        if not preloaded:
+            IMPORT_TIMINGS.setdefault(name, time.perf_counter() - started)
+        _lazy_modules[name] = module
+        return module
+
+openai_api_key = os.getenv("OPENAI_API_KEY")
+# Built by get_openai_client on first use; tests may assign a stand-in
+client = None
+_openai_http_client = None
+_client_lock = threading.Lock()
+
+def _pooled_transport(httpx, limits):
+    """HTTP transport whose streamed completions hand their connection back to the pool
+    
+    The SDK stops reading a stream at its "data: [DONE]" event and closes the
+    response before the end of the chunked body has been read, which makes
+    the pool discard the connection: every completion then paid for a new
+    TCP and TLS handshake. Once [DONE] has arrived, closing first reads the
+    few bytes that remain. Streams abandoned earlier are closed as before.
+    """
+    class DrainingStream(httpx.SyncByteStream):
+        def __init__(self, stream):
+            self._stream = stream
+            self._chunks = iter(stream)
+            self._finished = False
+
+        def __iter__(self):
+            for chunk in self._chunks:
+                self._finished = chunk.rstrip().endswith(b"data: [DONE]")
+                yield chunk
+
+        def close(self):
+            if self._finished:
+                try:
+                    for _ in self._chunks:
+                        pass
+                except Exception:
+                    pass
+            self._stream.close()
+
+    class DrainingTransport(httpx.HTTPTransport):
+        def handle_request(self, request):
+            response = super().handle_request(request)
+            response.stream = DrainingStream(response.stream)
+            return response
+
+    return DrainingTransport(limits=limits)
+
+def get_openai_client():
+    """The process-wide OpenAI client, created on first use
+    
+    Its connection pool holds OPENAI_POOL_SIZE keep-alive connections for
+    OPENAI_KEEPALIVE_SECONDS, so concurrent sessions reuse open TLS
+    connections instead of handshaking per request.
+    """
+    global client, _openai_http_client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                openai = _lazy_import("openai")
+                # Current SDKs are built on httpx2, older ones on httpx; both take the same Limits
+                httpx = _lazy_import("httpx2", optional=True) or _lazy_import("httpx")
+                _openai_http_client = openai.DefaultHttpxClient(transport=_pooled_transport(httpx, httpx.Limits(
+                    max_connections=OPENAI_POOL_SIZE,
+                    max_keepalive_connections=OPENAI_POOL_SIZE,
+                    keepalive_expiry=OPENAI_KEEPALIVE_SECONDS
+                )))
+                # Retries are done by the shared scheduler so they are paced across sessions
+                client = openai.OpenAI(
+                    api_key=openai_api_key,
+                    max_retries=0,
+                    timeout=openai.Timeout(OPENAI_READ_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+                    http_client=_openai_http_client
+                )
+    return client
+
+# API Endpoints
+TEXTRACT_API_URL = os.getenv("TEXTRACT_API_URL")
+TEXTRACT_MODE = '1'
+TEXTRACT_TIMEOUT_SECONDS = int(os.getenv("TEXTRACT_TIMEOUT_SECONDS", "500"))
+TEXTRACT_CONNECT_TIMEOUT_SECONDS = float(os.getenv("TEXTRACT_CONNECT_TIMEOUT_SECONDS", "10"))
+TEXTRACT_MAX_WORKERS = int(os.getenv("TEXTRACT_MAX_WORKERS", "4"))
+TEXTRACT_POOL_SIZE = int(os.getenv("TEXTRACT_POOL_SIZE", str(TEXTRACT_MAX_WORKERS)))
+TEXTRACT_POLL_SECONDS = 1.0
+TEXTRACT_JOB_RETENTION_SECONDS = 3600
+
+# Minimum visible characters for a page's own text layer to be used instead of OCR
+LOCAL_TEXT_MIN_CHARS = int(os.getenv("LOCAL_TEXT_MIN_CHARS", "40"))
+
+# Per-file cache of Textract results, keyed by PDF content
+TEXTRACT_CACHE_DIR = os.getenv("TEXTRACT_CACHE_DIR", os.path.join(".qpg_cache", "textract"))
+TEXTRACT_CACHE_MAX_MB = int(os.getenv("TEXTRACT_CACHE_MAX_MB", "200"))
+
+# Concurrency limits for section-parallel generation
+LLM_MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", "4"))
+BANK_QUESTIONS_PER_CALL = int(os.getenv("BANK_QUESTIONS_PER_CALL", "15"))
+
+# Process-wide OpenAI limits shared by every session; match them to the account's tier
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+OPENAI_MAX_CONCURRENT = int(os.getenv("OPENAI_MAX_CONCURRENT", "8"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+OPENAI_RETRY_BASE_SECONDS = 1.0
+OPENAI_RETRY_MAX_SECONDS = 60.0
+
+# Keep-alive connection pool of the OpenAI client; idle connections are closed after OPENAI_KEEPALIVE_SECONDS
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", str(OPENAI_MAX_CONCURRENT)))
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_SECONDS", "60"))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "10"))
+OPENAI_READ_TIMEOUT_SECONDS = float(os.getenv("OPENAI_READ_TIMEOUT_SECONDS", "600"))
+
+# Connections per service opened in the background by warm_up_connections; 0 disables warm-up
+HTTP_WARM_CONNECTIONS = int(os.getenv("HTTP_WARM_CONNECTIONS", "2"))
+
+# Token budget for one structure analysis request (system + user prompt);
+# OCR text and syllabus are normalized and compacted to fit it
+ANALYSIS_PROMPT_TOKEN_BUDGET = int(os.getenv("ANALYSIS_PROMPT_TOKEN_BUDGET", "24000"))
+
+# LLM response cache shared across sessions
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(".qpg_cache", "llm_cache.sqlite3"))
+LLM_CACHE_TTL_HOURS = float(os.getenv("LLM_CACHE_TTL_HOURS", "168"))
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", "500"))
+
+# Persistent question bank; generated questions accumulate here per subject code
+QUESTION_STORE_PATH = os.getenv("QUESTION_STORE_PATH", os.path.join(".qpg_data", "question_bank.sqlite3"))
+
+# Background generation jobs: one pool for every session, with state and results kept on disk
+GENERATION_MAX_WORKERS = int(os.getenv("GENERATION_MAX_WORKERS", "2"))
+GENERATION_JOBS_DIR = os.getenv("GENERATION_JOBS_DIR", os.path.join(".qpg_data", "jobs"))
+GENERATION_JOB_RETENTION_HOURS = float(os.getenv("GENERATION_JOB_RETENTION_HOURS", "24"))
+GENERATION_POLL_SECONDS = 1.0
+
+class IncrementalJSONParser:
+    """Pick completed objects out of a JSON document while it is still streaming in
+
+    Paths are tuples of object keys and array indexes, e.g.
+    ("question_bank", "UNIT-I", 3); "*" in a watched pattern matches any key
+    or index. feed() returns the (path, value) pairs completed by the chunk;
+    partial() parses a document that was cut off.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [tuple(pattern) for pattern in patterns]
+        self.text = ""
+        self._pos = 0
+        # [container_char, start_offset, current_key_or_index, end_of_last_complete_member, value_expected]
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+
+    def _matches(self, path):
+        return any(
+            len(pattern) == len(path) and all(p == "*" or p == k for p, k in zip(pattern, path))
+            for pattern in self.patterns
+        )
+
+    def feed(self, chunk):
+        self.text += chunk
+        completed = []
+        text = self.text
+
+        for i in range(self._pos, len(text)):
+            char = text[i]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = json.loads(text[self._string_start:i + 1])
+                    if self._stack and (self._stack[-1][0] == "[" or self._stack[-1][4]):
+                        self._stack[-1][3] = i + 1
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in "{[":
+                self._stack.append([char, i, 0 if char == "[" else None, i + 1, False])
+            elif char in "}]":
+                if not self._stack:
+                    continue
+                start = self._stack.pop()[1]
+                path = tuple(entry[2] for entry in self._stack)
+                if self._stack:
+                    self._stack[-1][3] = i + 1
+                if self._matches(path):
+                    completed.append((path, json.loads(text[start:i + 1])))
+            elif char == ":" and self._stack and self._stack[-1][0] == "{":
+                self._stack[-1][2] = self._last_string
+                self._stack[-1][4] = True
+            elif char == "," and self._stack:
+                # Whatever came before the comma (numbers and literals included) is complete
+                self._stack[-1][3] = i
+                self._stack[-1][4] = False
+                if self._stack[-1][0] == "[":
+                    self._stack[-1][2] += 1
+
+        self._pos = len(text)
+        return completed
+
+    def partial(self):
+        """Parse the text received so far, dropping the member that was being written
+
+        Every open container is closed right after its last complete member,
+        so a response cut off mid-way still yields all of its finished parts.
+        """
+        if not self._stack:
+            return json.loads(self.text)
+        closers = "".join("}" if entry[0] == "{" else "]" for entry in reversed(self._stack))
+        return json.loads(self.text[:self._stack[-1][3]] + closers)
+
+class LLMResponseCache:
+    """SQLite cache of raw completion text shared by every session on this host
+
+    Entries expire after ttl_seconds; when the stored text grows past
+    max_bytes the least recently used entries are dropped. Hit/miss counters
+    live in the same database so the reported hit rate covers all sessions.
+    """
+
+    def __init__(self, path, ttl_seconds, max_bytes):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._initialized = False
+
+    def _connect(self):
+        if not self._initialized:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, last_access REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    @staticmethod
+    def make_key(request_kwargs):
+        payload = json.dumps(request_kwargs, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _count(self, conn, name):
+        conn.execute(
+            "INSERT INTO llm_cache_stats (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,)
+        )
+
+    def get(self, key):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT response FROM llm_cache WHERE key = ? AND created_at >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self._count(conn, "misses")
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            self._count(conn, "hits")
+            return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), now, now)
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale_keys = []
+        for key, size in conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            stale_keys.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM llm_cache WHERE key = ?", stale_keys)
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            counters = dict(conn.execute("SELECT name, value FROM llm_cache_stats"))
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size
+        }
+
+llm_cache = LLMResponseCache(LLM_CACHE_PATH, LLM_CACHE_TTL_HOURS * 3600, LLM_CACHE_MAX_MB * 1024 * 1024)
+
+class QuestionBankStore:
+    """SQLite store of question bank entries, accumulated across sessions
+
+    Every filterable field has its own (subject_code, field) index and
+    question_text is indexed with FTS5, so filtering and searching stay fast
+    with tens of thousands of questions. A question is stored once per
+    subject (compared by normalized text); the full question dict is kept
+    as JSON.
+    """
+
+    FILTER_COLUMNS = ("section_id", "difficulty", "bloom_level", "co", "topic", "question_type")
+
+    def __init__(self, path):
+        self.path = path
+        self._initialized = False
+
+    def _connect(self):
+        if not self._initialized:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS bank_questions ("
+                "id INTEGER PRIMARY KEY, subject_code TEXT NOT NULL, subject_name TEXT, section_id TEXT NOT NULL, "
+                "question_text TEXT NOT NULL, difficulty TEXT, bloom_level TEXT, co TEXT, topic TEXT, question_type TEXT, "
+                "marks REAL, data TEXT NOT NULL, text_hash TEXT NOT NULL, created_at REAL NOT NULL, "
+                "UNIQUE (subject_code, text_hash))"
+            )
+            for column in self.FILTER_COLUMNS:
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_bank_questions_{column} ON bank_questions (subject_code, {column})"
+                )
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS bank_questions_fts USING fts5("
+                "question_text, content='bank_questions', content_rowid='id')"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS bank_questions_ai AFTER INSERT ON bank_questions BEGIN "
+                "INSERT INTO bank_questions_fts (rowid, question_text) VALUES (new.id, new.question_text); END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS bank_questions_ad AFTER DELETE ON bank_questions BEGIN "
+                "INSERT INTO bank_questions_fts (bank_questions_fts, rowid, question_text) "
+                "VALUES ('delete', old.id, old.question_text); END"
+            )
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    @staticmethod
+    def _text_hash(text):
+        normalized = _normalize_question_text(text)
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest() if normalized else None
+
+    def add(self, subject_code, subject_name, question_bank):
+        """Store {section_id: [question, ...]}; returns the number of questions that were new"""
+        now = time.time()
+        rows = []
+        for section_id, questions in question_bank.items():
+            for question in questions:
+                text = question.get('question_text', '')
+                text_hash = self._text_hash(text)
+                if not text_hash:
+                    continue
+                rows.append((
+                    subject_code, subject_name, section_id, text,
+                    question.get('difficulty'), question.get('bloom_level'), question.get('co'),
+                    question.get('topic'), question.get('question_type'), _as_number(question.get('marks', 0)),
+                    json.dumps(question, ensure_ascii=False), text_hash, now
+                ))
+        with closing(self._connect()) as conn, conn:
+            count_sql = "SELECT COUNT(*) FROM bank_questions WHERE subject_code = ?"
+            before = conn.execute(count_sql, (subject_code,)).fetchone()[0]
+            conn.executemany(
+                "INSERT OR IGNORE INTO bank_questions (subject_code, subject_name, section_id, question_text, "
+                "difficulty, bloom_level, co, topic, question_type, marks, data, text_hash, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            return conn.execute(count_sql, (subject_code,)).fetchone()[0] - before
+
+    def remove(self, subject_code, question_texts):
+        """Delete questions of a subject by text, e.g. ones that were regenerated; returns the number removed"""
+        hashes = [(subject_code, text_hash) for text_hash in map(self._text_hash, question_texts) if text_hash]
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.executemany("DELETE FROM bank_questions WHERE subject_code = ? AND text_hash = ?", hashes)
+            return cursor.rowcount
+
+    def _where(self, subject_code, filters, search):
+        clauses, params = ["q.subject_code = ?"], [subject_code]
+        for column, value in (filters or {}).items():
+            if column not in self.FILTER_COLUMNS:
+                raise ValueError(f"Unknown filter column: {column}")
+            clauses.append(f"q.{column} = ?")
+            params.append(value)
+        terms = re.findall(r'\w+', search or '')
+        if terms:
+            # Every word must appear, as a prefix; quoting keeps FTS5 syntax out of user input
+            clauses.append("q.id IN (SELECT rowid FROM bank_questions_fts WHERE bank_questions_fts MATCH ?)")
+            params.append(" ".join(f'"{term}"*' for term in terms))
+        return " AND ".join(clauses), params
+
+    def iter_query(self, subject_code, filters=None, search=None, limit=None, offset=0):
+        """Matching questions (dicts with section_id added), oldest first, read from the cursor as they are consumed"""
+        where, params = self._where(subject_code, filters, search)
+        sql = f"SELECT section_id, data FROM bank_questions q WHERE {where} ORDER BY q.id"
+        if limit or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([limit or -1, offset])
+        with closing(self._connect()) as conn:
+            for section_id, data in conn.execute(sql, params):
+                yield dict(json.loads(data), section_id=section_id)
+
+    def query(self, subject_code, filters=None, search=None, limit=None, offset=0):
+        """Matching questions (dicts with section_id added), oldest first"""
+        return list(self.iter_query(subject_code, filters, search, limit, offset))
+
+    def count(self, subject_code, filters=None, search=None):
+        where, params = self._where(subject_code, filters, search)
+        with closing(self._connect()) as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM bank_questions q WHERE {where}", params).fetchone()[0]
+
+    def facets(self, subject_code):
+        """{column: [(value, count), ...]} of every filter column for the subject"""
+        with closing(self._connect()) as conn:
+            return {
+                column: conn.execute(
+                    f"SELECT {column}, COUNT(*) FROM bank_questions WHERE subject_code = ? AND {column} IS NOT NULL "
+                    f"GROUP BY {column} ORDER BY {column}",
+                    (subject_code,)
+                ).fetchall()
+                for column in self.FILTER_COLUMNS
+            }
+
+question_store = QuestionBankStore(QUESTION_STORE_PATH)
+
+class TokenBucket:
+    """Budget of per_minute units, refilled continuously"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount is available; requests larger than the bucket wait for a full one"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60 / self.capacity
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+class OpenAIScheduler:
+    """Admission control for every chat completion made by this process
+
+    A request is admitted once a concurrency slot, one request from the
+    requests-per-minute bucket and its estimated tokens (prompt plus
+    max_tokens, as the API counts them) from the tokens-per-minute bucket are
+    free. Waiting requests queue per tenant (a browser session or a batch
+    subject) and tenants take turns, so a ten-paper job cannot starve
+    everyone else. A 429 pauses admission for all tenants until its delay
+    has passed. Unused reserved tokens are returned when a request ends.
+    """
+
+    def __init__(self, rpm, tpm, max_concurrent):
+        self.max_concurrent = max_concurrent
+        self._condition = threading.Condition()
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._queues = {}  # tenant -> waiting tickets; insertion order is the turn order
+        self._running = 0
+        self._paused_until = 0.0
+        self._waits = deque(maxlen=500)
+        self._counters = Counter()
+
+    def _admission_delay(self, ticket, tokens, now):
+        """0 when ticket may start now, seconds to wait, or None to wait for a release"""
+        head = next(iter(self._queues.values()))[0]
+        if head is not ticket or self._running >= self.max_concurrent:
+            return None
+        return max(self._paused_until - now, self._requests.wait_time(1, now), self._tokens.wait_time(tokens, now))
+
+    def acquire(self, tenant, tokens):
+        """Block until the request may be sent; returns the seconds spent waiting"""
+        ticket = object()
+        enqueued = time.monotonic()
+        with self._condition:
+            self._queues.setdefault(tenant, deque()).append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._admission_delay(ticket, tokens, now)
+                    if delay is not None and delay <= 0:
+                        break
+                    self._condition.wait(delay)
+            except BaseException:
+                self._queues[tenant].remove(ticket)
+                if not self._queues[tenant]:
+                    del self._queues[tenant]
+                self._condition.notify_all()
+                raise
+            
+            # Move the tenant to the back of the turn order
+            tickets = self._queues.pop(tenant)
+            tickets.popleft()
+            if tickets:
+                self._queues[tenant] = tickets
+            self._running += 1
+            self._requests.take(1, now)
+            self._tokens.take(tokens, now)
+            waited = now - enqueued
+            self._waits.append(waited)
+            self._counters['requests'] += 1
+            self._condition.notify_all()
+        return waited
+
+    def release(self, reserved_tokens, used_tokens):
+        with self._condition:
+            self._running -= 1
+            self._tokens.give_back(max(0, reserved_tokens - used_tokens), time.monotonic())
+            self._condition.notify_all()
+
+    def pause(self, seconds):
+        """Hold back every tenant after a 429"""
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._counters['rate_limited'] += 1
+
+    def record_retry(self):
+        with self._condition:
+            self._counters['retries'] += 1
+
+    def stats(self):
+        with self._condition:
+            waits = sorted(self._waits)
+            return {
+                "queued": sum(len(tickets) for tickets in self._queues.values()),
+                "queued_by_tenant": {tenant: len(tickets) for tenant, tickets in self._queues.items()},
+                "in_flight": self._running,
+                "paused_seconds": max(0.0, self._paused_until - time.monotonic()),
+                "mean_wait_seconds": sum(waits) / len(waits) if waits else 0.0,
+                "p95_wait_seconds": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                "max_wait_seconds": waits[-1] if waits else 0.0,
+                "requests": self._counters['requests'],
+                "retries": self._counters['retries'],
+                "rate_limited": self._counters['rate_limited']
+            }
+
+openai_scheduler = OpenAIScheduler(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT, OPENAI_MAX_CONCURRENT)
+
+# Set from the sidebar toggle; copied into worker threads by _run_concurrently
+_llm_cache_bypass = contextvars.ContextVar("llm_cache_bypass", default=False)
+
+# Who a request is queued for in openai_scheduler: the browser session or batch subject
+_llm_tenant = contextvars.ContextVar("llm_tenant", default="default")
+
+# Set by a generation job's worker; once it is set, the job's requests stop at the next chunk
+_cancel_event = contextvars.ContextVar("cancel_event", default=None)
+
+def _cancelled():
+    event = _cancel_event.get()
+    return event is not None and event.is_set()
+
+def _is_retryable(error):
+    openai = _lazy_import("openai")
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+def _retry_delay(error, attempt):
+    """The server's Retry-After if given, otherwise exponential backoff with jitter"""
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), OPENAI_RETRY_MAX_SECONDS)
+        except ValueError:
+            pass
+    ceiling = min(OPENAI_RETRY_MAX_SECONDS, OPENAI_RETRY_BASE_SECONDS * 2 ** attempt)
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+def _prompt_tokens(create_kwargs):
+    return sum(count_tokens(message.get('content') or '') for message in create_kwargs.get('messages', []))
+
+def _record_completion(create_kwargs, usage, prompt_tokens, text, seconds, queue_seconds, first_token_seconds):
+    """Report a finished completion to qpg_metrics, with the API's token usage if it sent one"""
+    model = create_kwargs.get('model')
+    if usage is None:
+        record_llm_call(model, seconds, queue_seconds, first_token_seconds, prompt_tokens, count_tokens(text), estimated=True)
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    record_llm_call(
+        model, seconds, queue_seconds, first_token_seconds, usage.prompt_tokens, usage.completion_tokens,
+        getattr(details, 'cached_tokens', None) or 0
+    )
+
+def _scheduled_completion(create_kwargs, on_delta):
+    """Stream a completion through openai_scheduler, retrying 429s, 5xx and connection errors
+    
+    Only failures before the first streamed token are retried; after that the
+    caller has already seen part of the response and the error is raised.
+    Returns the finish_reason of the completion.
+    """
+    prompt_tokens = _prompt_tokens(create_kwargs)
+    reserved = prompt_tokens + create_kwargs.get('max_tokens', 0)
+    
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        if _cancelled():
+            raise GenerationCancelled("the job was cancelled")
+        queued = time.perf_counter()
+        openai_scheduler.acquire(_llm_tenant.get(), reserved)
+        started = time.perf_counter()
+        received = []
+        finish_reason = usage = first_token_seconds = None
+        try:
+            stream = get_openai_client().chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **create_kwargs
+            )
+            for chunk in stream:
+                if _cancelled():
+                    stream.close()
+                    raise GenerationCancelled("the job was cancelled")
+                # The last chunk carries the token usage and no choices
+                usage = getattr(chunk, 'usage', None) or usage
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token_seconds is None:
+                        first_token_seconds = time.perf_counter() - started
+                    received.append(delta)
+                    on_delta(delta)
+            _record_completion(
+                create_kwargs, usage, prompt_tokens, ''.join(received),
+                time.perf_counter() - started, started - queued, first_token_seconds
+            )
+            return finish_reason
+        except Exception as e:
+            if received or attempt == OPENAI_MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = _retry_delay(e, attempt)
+            rate_limited = isinstance(e, _lazy_import("openai").RateLimitError)
+        finally:
+            openai_scheduler.release(reserved, prompt_tokens + count_tokens(''.join(received)))
+        
+        openai_scheduler.record_retry()
+        if rate_limited:
+            openai_scheduler.pause(delay)
+        else:
+            time.sleep(delay)
+
+def _stream_json_completion(emit=None, stream_paths=(), **create_kwargs):
+    """Run a streaming chat completion and return the parsed JSON response
+
+    emit(path, value) is called for every object matching stream_paths as
+    soon as it has been received in full. Responses are served from and
+    stored in llm_cache unless the cache is bypassed for this run.
+    
+    A response cut off at max_tokens raises TruncatedResponseError carrying
+    the objects that did arrive, so callers can ask for only the rest.
+    """
+    parser = IncrementalJSONParser(stream_paths)
+    completed = []
+    use_cache = not _llm_cache_bypass.get()
+    cache_key = LLMResponseCache.make_key(create_kwargs)
+
+    cached_text = None
+    if use_cache:
+        try:
+            cached_text = llm_cache.get(cache_key)
+        except sqlite3.Error:
+            # A broken or locked cache must not block generation
+            use_cache = False
+    if cached_text is not None:
+        record_llm_cache_hit(create_kwargs.get('model'))
+        for path, value in parser.feed(cached_text):
+            if emit:
+                emit(path, value)
+        return json.loads(parser.text)
+
+    def feed(delta):
+        for path, value in parser.feed(delta):
+            completed.append((path, value))
+            if emit:
+                emit(path, value)
+
+    finish_reason = _scheduled_completion(create_kwargs, feed)
+    if finish_reason == "length":
+        raise TruncatedResponseError(parser, completed)
+
+    result = json.loads(parser.text)
+    if use_cache:
+        try:
+            llm_cache.put(cache_key, parser.text)
+        except sqlite3.Error:
+            pass
+    return result
+
+def _run_concurrently(jobs, max_workers, on_progress=None):
+    """Run {key: (fn, args)} jobs on a bounded thread pool
+
+    Every job receives an emit(kind, data) keyword argument. Events are queued
+    and handed to on_progress on the calling (script) thread, because
+    Streamlit elements cannot be updated from worker threads. Jobs run in a
+    copy of the caller's context so per-run settings reach the workers.
+    Returns (results, errors), both keyed like jobs.
+    """
+    events = queue.Queue()
+    results, errors = {}, {}
+
+    def drain():
+        while True:
+            try:
+                kind, data = events.get_nowait()
+            except queue.Empty:
+                return
+            if on_progress:
+                on_progress(kind, data)
+
+    emit = lambda kind, data: events.put((kind, data))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as executor:
+        futures = {
+            executor.submit(contextvars.copy_context().run, fn, *args, emit=emit): key
+            for key, (fn, args) in jobs.items()
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            drain()
+            for future in done:
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    errors[futures[future]] = e
+    drain()
+
+    return results, errors
+
+ANALYSIS_SYSTEM_PROMPT = """You are an expert educational assessment analyst. Your task is to analyze question papers against a given syllabus and course objectives.
+
+CRITICAL: Your job is to EXTRACT and ANALYZE the exact patterns from the sample papers, then use the FULL SYLLABUS scope for generation planning.
+
+Analyze the papers for:
+1. Structural compatibility and format consistency
+2. EXACT question type distribution observed in papers (numerical vs theoretical vs mixed)
+3. Internal choice patterns (1a/1b format recognition)
+4. Bloom's taxonomy distribution (CRITICAL for engineering education)
+5. Difficulty distribution as observed
+6. Topic coverage analysis: Sample papers vs Complete syllabus
+7. Generate detailed structure for FULL SYLLABUS coverage
+
+Return analysis in this EXACT JSON format:
+
+{
+    "are_compatible": true/false,
+    "compatibility_reason": "detailed explanation",
+    "compatibility_score": 85,
+    "subject_analysis": {
+        "subject_name": "extracted subject name",
+        "syllabus_coverage": {
+            "total_topics_in_syllabus": 12,
+            "topics_in_sample_papers": 6,
+            "sample_coverage_percentage": 50,
+            "uncovered_topics_in_samples": ["Topic A", "Topic B"],
+            "topics_in_sample_papers": ["Topic C", "Topic D"],
+            "full_syllabus_topics": ["All extracted topics from complete syllabus"]
+        },
+        "question_style_analysis": {
+            "numerical_problems_percentage": 65,
+            "theoretical_questions_percentage": 25,
+            "mixed_questions_percentage": 10,
+            "internal_choice_pattern": "1a/1b format in each section",
+            "typical_question_formats": ["State and prove...", "Calculate the...", "Determine the..."]
+        },
+        "co_alignment": {
+            "total_cos": 4,
+            "cos_covered_in_samples": ["CO1", "CO2", "CO3"],
+            "co_distribution_observed": {
+                "CO1": 35,
+                "CO2": 30,
+                "CO3": 25,
+                "CO4": 10
+            },
+            "co_alignment_score": 78
+        }
+    },
+    "common_structure": {
+        "exam_info": {
+            "exam_type": "midterm_exam",
+            "subject_name": "Engineering Mechanics",
+            "total_marks": 40,
+            "exam_duration_minutes": 120,
+            "total_questions": 8,
+            "instruction_text": "Answer any ONE question from each unit"
+        },
+        "sections": [
+            {
+                "section_id": "UNIT-I",
+                "section_name": "Unit I Questions", 
+                "section_instruction": "Answer any ONE question from this unit",
+                "question_count": 2,
+                "marks_per_question": 20,
+                "total_section_marks": 20,
+                "question_type": "long_answer",
+                "is_compulsory": false,
+                "has_internal_choice": true,
+                "internal_choice_format": "1a/1b - student picks ONE complete question",
+                "questions_to_answer": 1,
+                "observed_topics": ["Statics", "Force Systems"],
+                "question_style_distribution": {
+                    "numerical_problems": 70,
+                    "theoretical": 20,
+                    "mixed": 10
+                },
+                "difficulty_distribution": {
+                    "easy": 20,
+                    "medium": 60,
+                    "hard": 20
+                },
+                "bloom_distribution": {
+                    "Remember": 10,
+                    "Understand": 20,
+                    "Apply": 50,
+                    "Analyze": 20,
+                    "Evaluate": 0,
+                    "Create": 0
+                },
+                "co_distribution": {
+                    "CO1": 70,
+                    "CO2": 30
+                }
+            }
+        ],
+        "overall_distributions": {
+            "difficulty_distribution": {
+                "easy": 25,
+                "medium": 55,
+                "hard": 20
+            },
+            "bloom_distribution": {
+                "Remember": 15,
+                "Understand": 25,
+                "Apply": 35,
+                "Analyze": 25,
+                "Evaluate": 0,
+                "Create": 0
+            },
+            "co_distribution": {
+                "CO1": 30,
+                "CO2": 25,
+                "CO3": 25,
+                "CO4": 20
+            },
+            "question_type_distribution": {
+                "numerical_problems": 65,
+                "theoretical": 25,
+                "mixed": 10
+            }
+        }
+    },
+    "generation_ready": {
+        "can_generate": true,
+        "generation_confidence": 85,
+        "recommended_adjustments": ["Balance CO4 coverage", "Add more analytical questions"],
+        "full_syllabus_utilization": "ready to use complete syllabus for topic diversity"
+    }
+}
+
+Analysis Rules:
+- Extract EXACT patterns from sample papers (don't impose artificial distributions)
+- Use sample papers for FORMAT/STRUCTURE learning
+- Identify complete syllabus scope for CONTENT generation
+- Recognize internal choice patterns precisely
+- Analyze actual question styles and formats used"""
+
+_token_encoder = None
+_token_encoder_lock = threading.Lock()
+
+def count_tokens(text):
+    """Count prompt tokens locally (tiktoken if available, else ~4 characters per token)"""
+    global _token_encoder
+    if _token_encoder is None:
+        with _token_encoder_lock:
+            if _token_encoder is None:
+                try:
+                    _token_encoder = tiktoken.get_encoding("o200k_base") if tiktoken else False
+                except Exception:  # the encoding file could not be loaded (e.g. offline)
+                    _token_encoder = False
+    if _token_encoder:
+        return len(_token_encoder.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / 4)
+
+_PAGE_NUMBER_LINE = re.compile(r'^(page\s*(no\.?)?\s*:?\s*\d+(\s*(of|/)\s*\d+)?|[-–]\s*\d+\s*[-–]|\d+\s*(of|/)\s*\d+)$', re.IGNORECASE)
+_STRUCTURAL_LINE = re.compile(r'\b(marks?|time|duration|hours?|hrs|answer|attempt|unit|section|part|module|questions?|or)\b')
+_BOOK_LIST_HEADING = re.compile(r'^(text\s*books?|reference\s*books?|references|suggested\s*readings?|e-?\s*resources|web\s*links)\b', re.IGNORECASE)
+_QUESTION_START = re.compile(r'^\s*(q(uestion)?\.?\s*)?\d+\s*[.)]|^\s*\(?[a-z]\)', re.IGNORECASE)
+_UNIT_HEADING = re.compile(r'^(unit|module)\b', re.IGNORECASE)
+_BOOK_REFERENCE = re.compile(r'\s*[(\[][^()\[\]]*\b(text\s*books?|ref(erence)?s?|chapters?|ch\.|[TR]\d)\b[^()\[\]]*[)\]]', re.IGNORECASE)
+BOILERPLATE_MIN_CHARS = 12
+HEADER_REGION_LINES = 10
+ANALYSIS_MAX_LINE_CHARS = 240
+
+def _line_key(line):
+    """Comparison key for OCR lines: case, spacing and punctuation ignored"""
+    return re.sub(r'[^a-z0-9]+', ' ', line.lower()).strip()
+
+def _is_boilerplate_key(key):
+    return len(key) >= BOILERPLATE_MIN_CHARS and not _STRUCTURAL_LINE.search(key)
+
+def _shared_header_keys(texts):
+    """Header lines (university, regulation, course code, ...) found at the top of every sample paper"""
+    if len(texts) < 2:
+        return frozenset()
+    headers = [
+        {
+            _line_key(line) for line in [l for l in text.splitlines() if l.strip()][:HEADER_REGION_LINES]
+            if not _QUESTION_START.match(line)
+        }
+        for text in texts
+    ]
+    return frozenset(key for key in set.intersection(*headers) if _is_boilerplate_key(key))
+
+def normalize_ocr_text(text, drop_keys=frozenset()):
+    """Clean OCR text before it is sent to the model
+    
+    Collapses whitespace, re-joins words hyphenated across line breaks, drops
+    page-number lines, keeps only the first copy of running headers/footers and
+    removes lines in drop_keys (boilerplate already sent with another paper).
+    """
+    text = re.sub(r'([a-z])-\n\s*([a-z])', r'\1\2', text.replace('\r\n', '\n'))
+    counts = Counter(_line_key(line) for line in text.split('\n'))
+    lines, seen = [], set()
+    for raw in text.split('\n'):
+        line = re.sub(r'\s+', ' ', raw).strip()
+        key = _line_key(line)
+        if line and (_PAGE_NUMBER_LINE.match(line) or key in drop_keys):
+            continue
+        if counts[key] > 1 and _is_boilerplate_key(key):
+            if key in seen:
+                continue
+            seen.add(key)
+        lines.append(line)
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+def _is_noise_line(line):
+    """OCR debris: rules, stray symbols and garbled runs with almost no letters or digits"""
+    if not line:
+        return False
+    alnum = sum(ch.isalnum() for ch in line)
+    return alnum == 0 or (len(line) > 8 and alnum / len(line) < 0.25)
+
+def _drop_book_lists(syllabus):
+    """Remove text book / reference lists, which say nothing about paper structure"""
+    lines, skipping = [], False
+    for line in syllabus.split('\n'):
+        stripped = line.strip()
+        if _BOOK_LIST_HEADING.match(stripped):
+            skipping = True
+            continue
+        if skipping and _UNIT_HEADING.match(stripped):
+            skipping = False
+        if not skipping:
+            lines.append(line)
+    return '\n'.join(lines).strip()
+
+def _shorten_line(line):
+    if len(line) <= ANALYSIS_MAX_LINE_CHARS:
+        return line
+    return line[:ANALYSIS_MAX_LINE_CHARS].rsplit(' ', 1)[0] + ' …'
+
+# Applied in order, only while the prompt is still over budget: (description, part, transform)
+_ANALYSIS_COMPACTION_STEPS = (
+    ("dropped OCR noise lines", "paper", lambda text: '\n'.join(l for l in text.split('\n') if not _is_noise_line(l))),
+    ("dropped syllabus book lists", "syllabus", _drop_book_lists),
+    ("dropped syllabus chapter references", "syllabus", lambda text: _BOOK_REFERENCE.sub('', text)),
+    ("shortened long OCR lines", "paper", lambda text: '\n'.join(_shorten_line(l) for l in text.split('\n'))),
+)
+
+def _trim_to_tokens(text, max_tokens, tail_fraction=0.0):
+    """Cut whole lines out of text (from the end, or from the middle when keeping a tail) until it fits"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    lines = text.split('\n')
+    keep = len(lines)
+    while keep > 0:
+        keep = min(keep - 1, int(keep * max_tokens / max(count_tokens(text), 1)))
+        tail = int(keep * tail_fraction)
+        head = keep - tail
+        omitted = len(lines) - keep
+        marker = f"[... {omitted} lines omitted to fit the prompt ...]"
+        text = '\n'.join(lines[:head] + [marker] + (lines[-tail:] if tail else []))
+        if count_tokens(text) <= max_tokens:
+            return text
+    return f"[... {len(lines)} lines omitted to fit the prompt ...]"
+
+def _render_analysis_prompt(paper, paper_text, paper_index, num_papers, subject_name, syllabus, course_objectives):
+    return f"""Analyze this question paper against the subject syllabus and course objectives:
+
+SUBJECT: {subject_name}
+
+COMPLETE SYLLABUS (for full topic scope):
+{syllabus}
+
+COURSE OBJECTIVES:
+{course_objectives}
+
+PAPER {paper_index + 1} of {num_papers} ({paper['filename']}) - {paper['text_length']} characters:
+=== OCR EXTRACTED TEXT START ===
+{paper_text}
+=== OCR EXTRACTED TEXT END ===
+
+NOTE: Each sample paper is analyzed separately and the results are merged afterwards.
+Describe THIS paper's structure in "common_structure"; set "are_compatible" to whether it is a usable, complete sample paper.
+
+CRITICAL ANALYSIS POINTS:
+1. Extract EXACT question format patterns from the sample paper
+2. Identify actual question type distributions (numerical vs theoretical)
+3. Recognize internal choice structures (1a/1b patterns)
+4. Compare sample paper topics vs COMPLETE syllabus scope
+5. Plan for using FULL SYLLABUS in generation (not just sample topics)
+6. Maintain observed Bloom's taxonomy emphasis
+
+Provide comprehensive analysis for generating papers that follow sample STRUCTURE but cover FULL SYLLABUS."""
+
+def _assemble_analysis_prompt(paper, paper_index, num_papers, subject_name, syllabus, course_objectives,
+                              drop_keys=frozenset(), budget=ANALYSIS_PROMPT_TOKEN_BUDGET):
+    """Build the user prompt for one paper within the token budget
+    
+    OCR text is always normalized; if the prompt is still too large the
+    lowest-value parts are compacted step by step, and only as a last resort
+    is the middle of the paper (then the end of the syllabus) cut. Returns
+    (user_prompt, stats) with the token counts before and after.
+    """
+    def render(paper_text, syllabus_text):
+        return _render_analysis_prompt(paper, paper_text, paper_index, num_papers, subject_name, syllabus_text, course_objectives)
+    
+    system_tokens = count_tokens(ANALYSIS_SYSTEM_PROMPT)
+    parts = {"paper": paper['extracted_text'], "syllabus": syllabus or ''}
+    tokens_before = system_tokens + count_tokens(render(parts["paper"], parts["syllabus"]))
+    
+    parts["paper"] = normalize_ocr_text(parts["paper"], drop_keys)
+    parts["syllabus"] = re.sub(r'\n{3,}', '\n\n', re.sub(r'[ \t]+', ' ', parts["syllabus"])).strip()
+    steps = ["normalized OCR text"]
+    
+    def total():
+        return system_tokens + count_tokens(render(parts["paper"], parts["syllabus"]))
+    
+    for description, part, transform in _ANALYSIS_COMPACTION_STEPS:
+        if total() <= budget:
+            break
+        compacted = transform(parts[part])
+        if compacted != parts[part]:
+            parts[part] = compacted
+            steps.append(description)
+    
+    if total() > budget:
+        # Whatever is left over goes to the paper first, but it keeps at least half of it
+        available = budget - system_tokens - count_tokens(render('', ''))
+        syllabus_tokens = count_tokens(parts["syllabus"])
+        paper_allowance = max(available - syllabus_tokens, available // 2)
+        if count_tokens(parts["paper"]) > paper_allowance:
+            parts["paper"] = _trim_to_tokens(parts["paper"], paper_allowance, tail_fraction=0.25)
+            steps.append("cut the middle of the OCR text")
+        if total() > budget:
+            parts["syllabus"] = _trim_to_tokens(parts["syllabus"], max(available - count_tokens(parts["paper"]), 0))
+            steps.append("cut the end of the syllabus")
+    
+    user_prompt = render(parts["paper"], parts["syllabus"])
+    return user_prompt, {
+        "filename": paper['filename'],
+        "tokens_before": tokens_before,
+        "tokens_after": system_tokens + count_tokens(user_prompt),
+        "budget": budget,
+        "steps": steps
+    }
+
+def _analyze_single_paper(paper, paper_index, user_prompt, emit=None):
+    """Map step: analyze one sample paper on its own (runs on a worker thread)
+    
+    A response cut off at the token limit is used as far as it got, provided
+    at least one section arrived complete; it is flagged with "truncated".
+    """
+    def emit_section(path, section):
+        if emit:
+            emit("section", {"paper_index": paper_index, "filename": paper['filename'], "section": section})
+    
+    try:
+        return _stream_json_completion(
+            emit=emit_section,
+            stream_paths=[("common_structure", "sections", "*")],
+            model="gpt-4.1-mini",
+            messages=[
+                {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.1,
+            max_tokens=8000,
+            response_format={"type": "json_object"}
+        )
+    except TruncatedResponseError as e:
+        if not e.completed:
+            raise
+        analysis = e.partial
+        analysis.setdefault('common_structure', {})['sections'] = [section for _, section in e.completed]
+        analysis['truncated'] = True
+        return analysis
+
+def _normalize_percentages(distribution):
+    """Round a distribution to whole percentages that still add up to 100 (largest remainder)"""
+    total = sum(distribution.values())
+    if not total:
+        return {key: 0 for key in distribution}
+    scaled = {key: 100 * value / total for key, value in distribution.items()}
+    rounded = {key: math.floor(value) for key, value in scaled.items()}
+    shortfall = 100 - sum(rounded.values())
+    for key in sorted(scaled, key=lambda k: scaled[k] - rounded[k], reverse=True)[:shortfall]:
+        rounded[key] += 1
+    return rounded
+
+def _average_distributions(distributions):
+    """Average percentage dicts key-wise (missing keys count as 0)"""
+    distributions = [d for d in distributions if isinstance(d, dict) and d]
+    if not distributions:
+        return {}
+    keys = list(dict.fromkeys(key for d in distributions for key in d))
+    averaged = {key: sum(_as_number(d.get(key, 0)) for d in distributions) / len(distributions) for key in keys}
+    return _normalize_percentages(averaged)
+
+def _as_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _most_common(values, default=None):
+    values = [v for v in values if v not in (None, '', [])]
+    if not values:
+        return default
+    return Counter(json.dumps(v, sort_keys=True) if isinstance(v, (dict, list)) else v for v in values).most_common(1)[0][0]
+
+def _mean(values, default=0):
+    values = [_as_number(v) for v in values if v is not None]
+    return round(sum(values) / len(values)) if values else default
+
+def _union(lists):
+    return list(dict.fromkeys(item for items in lists for item in (items or [])))
+
+def _merge_sections(section_lists):
+    """Combine the aligned sections (same position) of several papers into one"""
+    merged = []
+    for aligned in zip(*section_lists):
+        first = aligned[0]
+        merged.append({
+            "section_id": _most_common([s.get('section_id') for s in aligned], first.get('section_id')),
+            "section_name": _most_common([s.get('section_name') for s in aligned], ''),
+            "section_instruction": _most_common([s.get('section_instruction') for s in aligned], ''),
+            "question_count": _most_common([s.get('question_count') for s in aligned], 2),
+            "marks_per_question": _most_common([s.get('marks_per_question') for s in aligned], 0),
+            "total_section_marks": _most_common([s.get('total_section_marks') for s in aligned], 20),
+            "question_type": _most_common([s.get('question_type') for s in aligned], 'long_answer'),
+            "is_compulsory": _most_common([bool(s.get('is_compulsory')) for s in aligned], False),
+            "has_internal_choice": _most_common([bool(s.get('has_internal_choice')) for s in aligned], True),
+            "internal_choice_format": _most_common([s.get('internal_choice_format') for s in aligned], '1a/1b'),
+            "questions_to_answer": _most_common([s.get('questions_to_answer') for s in aligned], 1),
+            "observed_topics": _union(s.get('observed_topics') for s in aligned),
+            "question_style_distribution": _average_distributions(s.get('question_style_distribution') for s in aligned),
+            "difficulty_distribution": _average_distributions(s.get('difficulty_distribution') for s in aligned),
+            "bloom_distribution": _average_distributions(s.get('bloom_distribution') for s in aligned),
+            "co_distribution": _average_distributions(s.get('co_distribution') for s in aligned)
+        })
+    return merged
+
+def _merge_paper_analyses(analyses, papers):
+    """Reduce step: combine per-paper analyses into one structure analysis, without an LLM call
+    
+    The structure shared by most papers (same section count) becomes the
+    common_structure; papers that disagree lower the compatibility score.
+    """
+    structures = [a.get('common_structure', {}) for a in analyses]
+    section_counts = [len(s.get('sections', [])) for s in structures]
+    template_count = Counter(section_counts).most_common(1)[0][0]
+    conforming = [i for i, count in enumerate(section_counts) if count == template_count]
+    
+    exam_infos = [structures[i].get('exam_info', {}) for i in conforming]
+    total_marks = [info.get('total_marks') for info in exam_infos]
+    
+    issues = []
+    for i, analysis in enumerate(analyses):
+        name = papers[i]['filename']
+        if not analysis.get('are_compatible', True):
+            issues.append(f"{name}: {analysis.get('compatibility_reason', 'not a usable sample')}")
+        elif i not in conforming:
+            issues.append(f"{name} has {section_counts[i]} sections instead of {template_count}")
+        elif structures[i].get('exam_info', {}).get('total_marks') != _most_common(total_marks):
+            issues.append(f"{name} is marked out of {structures[i].get('exam_info', {}).get('total_marks')}")
+    
+    usable = [i for i in conforming if analyses[i].get('are_compatible', True)]
+    are_compatible = bool(usable) and len(usable) * 2 > len(analyses)
+    compatibility_score = round(_mean([analyses[i].get('compatibility_score', 100) for i in usable]) * len(usable) / len(analyses)) if usable else 0
+    if issues:
+        compatibility_reason = f"{len(usable)} of {len(analyses)} papers share a common structure. " + "; ".join(issues)
+    else:
+        compatibility_reason = f"All {len(analyses)} papers share the same structure"
+    
+    subject_analyses = [a.get('subject_analysis', {}) for a in analyses]
+    coverages = [s.get('syllabus_coverage', {}) for s in subject_analyses]
+    styles = [s.get('question_style_analysis', {}) for s in subject_analyses]
+    co_alignments = [s.get('co_alignment', {}) for s in subject_analyses]
+    readiness = [a.get('generation_ready', {}) for a in analyses]
+    
+    full_syllabus_topics = _union(c.get('full_syllabus_topics') for c in coverages)
+    sample_topics = _union(c.get('topics_in_sample_papers') for c in coverages)
+    sample_lower = {topic.lower() for topic in sample_topics}
+    uncovered = [topic for topic in full_syllabus_topics if topic.lower() not in sample_lower]
+    sample_coverage = round(100 * (len(full_syllabus_topics) - len(uncovered)) / len(full_syllabus_topics)) if full_syllabus_topics else 0
+    
+    merged_sections = _merge_sections([structures[i].get('sections', []) for i in usable or conforming])
+    subject_name = _most_common([s.get('subject_name') for s in subject_analyses], '')
+    
+    return {
+        "are_compatible": are_compatible,
+        "compatibility_reason": compatibility_reason,
+        "compatibility_score": compatibility_score,
+        "subject_analysis": {
+            "subject_name": subject_name,
+            "syllabus_coverage": {
+                "total_topics_in_syllabus": len(full_syllabus_topics),
+                "sample_coverage_percentage": sample_coverage,
+                "uncovered_topics_in_samples": uncovered,
+                "topics_in_sample_papers": sample_topics,
+                "full_syllabus_topics": full_syllabus_topics
+            },
+            "question_style_analysis": {
+                "numerical_problems_percentage": _mean(s.get('numerical_problems_percentage') for s in styles),
+                "theoretical_questions_percentage": _mean(s.get('theoretical_questions_percentage') for s in styles),
+                "mixed_questions_percentage": _mean(s.get('mixed_questions_percentage') for s in styles),
+                "internal_choice_pattern": _most_common([s.get('internal_choice_pattern') for s in styles], 'Not detected'),
+                "typical_question_formats": _union(s.get('typical_question_formats') for s in styles)
+            },
+            "co_alignment": {
+                "total_cos": int(max([_as_number(c.get('total_cos', 0)) for c in co_alignments] or [0])),
+                "cos_covered_in_samples": _union(c.get('cos_covered_in_samples') for c in co_alignments),
+                "co_distribution_observed": _average_distributions(c.get('co_distribution_observed') for c in co_alignments),
+                "co_alignment_score": _mean(c.get('co_alignment_score') for c in co_alignments)
+            }
+        },
+        "common_structure": {
+            "exam_info": {
+                "exam_type": _most_common([info.get('exam_type') for info in exam_infos], ''),
+                "subject_name": _most_common([info.get('subject_name') for info in exam_infos], subject_name),
+                "total_marks": _most_common(total_marks, 40),
+                "exam_duration_minutes": _most_common([info.get('exam_duration_minutes') for info in exam_infos], 120),
+                "total_questions": _most_common([info.get('total_questions') for info in exam_infos], 0),
+                "instruction_text": _most_common([info.get('instruction_text') for info in exam_infos], '')
+            },
+            "sections": merged_sections,
+            "overall_distributions": {
+                name: _average_distributions(s.get('overall_distributions', {}).get(name) for s in structures)
+                for name in ('difficulty_distribution', 'bloom_distribution', 'co_distribution', 'question_type_distribution')
+            }
+        },
+        "generation_ready": {
+            "can_generate": are_compatible and all(r.get('can_generate', True) for r in (readiness[i] for i in usable)),
+            "generation_confidence": _mean([readiness[i].get('generation_confidence') for i in usable]),
+            "recommended_adjustments": _union(r.get('recommended_adjustments') for r in readiness),
+            "full_syllabus_utilization": _most_common([r.get('full_syllabus_utilization') for r in readiness], '')
+        },
+        "paper_analyses": [
+            {"filename": papers[i]['filename'], "sections": section_counts[i], "are_compatible": analyses[i].get('are_compatible', True)}
+            for i in range(len(analyses))
+        ]
+    }
+
+@timed_stage("analysis")
+def analyze_papers_with_syllabus(paper_texts, subject_name, syllabus, course_objectives, on_progress=None, max_workers=LLM_MAX_WORKERS):
+    """Enhanced GPT analysis with syllabus and COs
+    
+    Map-reduce over any number of sample papers: each paper is analyzed in
+    its own request, concurrently, and _merge_paper_analyses combines the
+    results locally, so latency and prompt size do not grow with the number
+    of papers.
+    
+    Each prompt is assembled locally within ANALYSIS_PROMPT_TOKEN_BUDGET:
+    OCR text is normalized, header boilerplate shared by all papers is sent
+    only with the first one, and the token counts before and after are
+    returned under "prompt_stats".
+    
+    on_progress("section", {"paper_index", "filename", "section"}) is called
+    for each detected section while the responses stream in.
+    """
+    shared_keys = _shared_header_keys([paper['extracted_text'] for paper in paper_texts])
+    prompts, prompt_stats = [], []
+    for i, paper in enumerate(paper_texts):
+        user_prompt, stats = _assemble_analysis_prompt(
+            paper, i, len(paper_texts), subject_name, syllabus, course_objectives,
+            drop_keys=shared_keys if i else frozenset()
+        )
+        prompts.append(user_prompt)
+        prompt_stats.append(stats)
+    
+    analyses, errors = _run_concurrently(
+        {
+            i: (_analyze_single_paper, (paper, i, prompts[i]))
+            for i, paper in enumerate(paper_texts)
+        },
+        max_workers,
+        on_progress
+    )
+    
+    warnings = []
+    if errors:
+        warnings.append("Some papers could not be analyzed: " + "; ".join(
+            f"{paper_texts[i]['filename']}: {str(errors[i])}" for i in sorted(errors)
+        ))
+    truncated = [paper_texts[i]['filename'] for i in sorted(analyses) if analyses[i].pop('truncated', False)]
+    if truncated:
+        warnings.append(f"The analysis of {', '.join(truncated)} was cut off at the token limit; only its complete sections were used")
+    if not analyses:
+        raise PipelineError("no paper could be analyzed" + (f" ({warnings[0]})" if warnings else ""))
+    
+    indexes = sorted(analyses)
+    structure_analysis = _merge_paper_analyses([analyses[i] for i in indexes], [paper_texts[i] for i in indexes])
+    structure_analysis['prompt_stats'] = prompt_stats
+    structure_analysis['warnings'] = warnings
+    
+    return structure_analysis
+
+DEFAULT_CO_DISTRIBUTION = {'CO1': 25, 'CO2': 25, 'CO3': 25, 'CO4': 25}
+
+def _section_calibration(section, index):
+    """Calibration of one analyzed section, with the calibration form's defaults"""
+    difficulty = section.get('difficulty_distribution', {})
+    bloom = section.get('bloom_distribution', {})
+    style = section.get('question_style_distribution', {})
+    return {
+        'section_id': section.get('section_id', f'Section {index+1}'),
+        'question_count': section.get('question_count', 2),
+        'total_section_marks': section.get('total_section_marks', 20),
+        'has_internal_choice': section.get('has_internal_choice', True),
+        'internal_choice_format': section.get('internal_choice_format', '1a/1b'),
+        'topics_covered': section.get('observed_topics', []),
+        'difficulty_distribution': {
+            'easy': difficulty.get('easy', 25),
+            'medium': difficulty.get('medium', 55),
+            'hard': difficulty.get('hard', 20)
+        },
+        'bloom_distribution': {
+            'Remember': bloom.get('Remember', 10),
+            'Understand': bloom.get('Understand', 20),
+            'Apply': bloom.get('Apply', 40),
+            'Analyze': bloom.get('Analyze', 30)
+        },
+        'question_style_distribution': {
+            'numerical_problems': style.get('numerical_problems', 60),
+            'theoretical': style.get('theoretical', 30),
+            'mixed': style.get('mixed', 10)
+        }
+    }
+
+def calibrate_structure(analysis_result, overrides=None):
+    """Build the calibrated structure used for generation from an analysis
+    
+    Defaults are the ones the calibration form starts from. overrides may
+    set total_marks, exam_duration_minutes, instruction_text, num_papers and
+    co_distribution, and section settings under "sections", either as a list
+    in section order or as {section_id: {...}}; nested distributions are
+    merged key by key.
+    """
+    overrides = overrides or {}
+    subject_analysis = analysis_result.get('subject_analysis', {})
+    syllabus_coverage = subject_analysis.get('syllabus_coverage', {})
+    question_style = subject_analysis.get('question_style_analysis', {})
+    common_structure = analysis_result.get('common_structure', {})
+    exam_info = common_structure.get('exam_info', {})
+    
+    section_overrides = overrides.get('sections', {})
+    sections = []
+    for i, section in enumerate(common_structure.get('sections', [])):
+        config = _section_calibration(section, i)
+        if isinstance(section_overrides, list):
+            override = section_overrides[i] if i < len(section_overrides) else {}
+        else:
+            override = section_overrides.get(config['section_id'], {})
+        for key, value in override.items():
+            if isinstance(value, dict) and isinstance(config.get(key), dict):
+                config[key] = {**config[key], **value}
+            else:
+                config[key] = value
+        sections.append(config)
+    
+    co_distribution = dict(
+        overrides.get('co_distribution')
+        or common_structure.get('overall_distributions', {}).get('co_distribution')
+        or DEFAULT_CO_DISTRIBUTION
+    )
+    
+    return {
+        "exam_info": {
+            "total_marks": overrides.get('total_marks', exam_info.get('total_marks', 40)),
+            "exam_duration_minutes": overrides.get('exam_duration_minutes', exam_info.get('exam_duration_minutes', 120)),
+            "instruction_text": overrides.get('instruction_text', exam_info.get('instruction_text', 'Answer any ONE question from each unit')),
+            "subject_name": exam_info.get('subject_name', 'Unknown Subject')
+        },
+        "sections": sections,
+        "overall_distributions": {
+            "co_distribution": co_distribution
+        },
+        "generation_params": {
+            "num_papers": overrides.get('num_papers', 5),
+            "full_syllabus_topics": syllabus_coverage.get('full_syllabus_topics', []),
+            "sample_paper_topics": syllabus_coverage.get('topics_in_sample_papers', []),
+            "course_objectives": list(co_distribution.keys()),
+            "question_style_patterns": question_style.get('typical_question_formats', []),
+            "use_full_syllabus_scope": True
+        }
+    }
+
+QUESTION_BANK_SYSTEM_PROMPT = """You are an expert question bank generator. Create a comprehensive pool of questions organized by sections.
+
+Generate question banks that:
+1. Cover COMPLETE SYLLABUS topics extensively
+2. Provide variety in question formats and approaches
+3. Include proper difficulty distribution per section
+4. Maintain Bloom's taxonomy and CO coverage
+5. Zero duplication within the question bank
+6. Include proper numerical values and visual aids
+7. Create questions suitable for mix-and-match paper assembly
+
+VISUAL HANDLING (same as paper generation):
+- ASCII diagrams for simple geometries
+- Detailed descriptions for complex cases
+- Complete numerical data with units
+- Professional question formatting
+
+Return response in this JSON format:
+
+{
+    "question_bank": {
+        "UNIT-I": [
+            {
+                "question_id": "U1_Q001",
+                "question_text": "A cantilever beam of length 4m carries a point load of 15kN at free end...",
+                "visual_aid": {
+                    "type": "ascii",
+                    "content": "ASCII diagram here",
+                    "visualization_guide": "Description for visualization"
+                },
+                "given_data": ["Length L = 4m", "Load P = 15kN", "E = 200 GPa"],
+                "find": "Maximum deflection and slope",
+                "marks": 10,
+                "difficulty": "easy",
+                "bloom_level": "Apply",
+                "co": "CO1",
+                "topic": "Deflection of Beams",
+                "question_type": "numerical_problem",
+                "solution_approach": "Use double integration method or standard formulas"
+            }
+        ]
+    },
+    "bank_summary": {
+        "total_questions_generated": 50,
+        "questions_per_section": {"UNIT-I": 25, "UNIT-II": 25},
+        "difficulty_distribution": {"easy": 40, "medium": 40, "hard": 20},
+        "bloom_distribution": {"Remember": 15, "Understand": 25, "Apply": 35, "Analyze": 25},
+        "co_distribution": {"CO1": 25, "CO2": 25, "CO3": 25, "CO4": 25},
+        "question_type_distribution": {"numerical": 60, "theoretical": 30, "mixed": 10},
+        "topics_covered": ["Complete list of all topics covered"],
+        "syllabus_utilization": "85% of complete syllabus covered"
+    }
+}"""
+
+def _avoid_note(avoid_texts):
+    """Prompt line listing questions already written elsewhere, for continuation requests"""
+    if not avoid_texts:
+        return ""
+    return "\n- These questions are already written; do not repeat or reword any of them:\n" + "\n".join(f"  - {text}" for text in avoid_texts)
+
+def _generate_question_bank_single(calibrated_structure, questions_per_section, emit=None):
+    """Generate the whole question bank with a single completion"""
+    user_prompt = f"""Generate a comprehensive question bank based on this calibrated structure:
+
+CALIBRATED STRUCTURE:
+{json.dumps(calibrated_structure, indent=2)}
+
+QUESTION BANK REQUIREMENTS:
+- Generate {questions_per_section} questions per section
+- Cover MAXIMUM topics from complete syllabus
+- Difficulty distribution per section: 40% Easy, 40% Medium, 20% Hard
+- Follow calibrated Bloom's and CO distributions
+- Include variety: numerical problems, theoretical questions, mixed types
+- Ensure zero duplication across entire question bank
+- Maintain professional engineering question format
+
+QUALITY STANDARDS:
+- Each question must be complete and solvable
+- Include proper visual aids (ASCII/descriptions) where needed
+- Provide realistic numerical values with units
+- Cover diverse topics within each section
+- Suitable for educators to pick and choose for paper assembly"""
+
+    def emit_question(path, question):
+        if emit:
+            emit("question", {"section_id": path[1], "question": question})
+    
+    try:
+        return _stream_json_completion(
+            emit=emit_question,
+            stream_paths=[("question_bank", "*", "*")],
+            model="gpt-4.1-mini",
+            messages=[
+                {"role": "system", "content": QUESTION_BANK_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.4,
+            max_tokens=16000,
+            response_format={"type": "json_object"}
+        )
+    except TruncatedResponseError as e:
+        by_key = {}
+        for path, question in e.completed:
+            by_key.setdefault(path[1], []).append(question)
+        # The model occasionally renames section keys; a renamed key is taken
+        # for the calibrated section at its position in the response
+        section_ids = [section.get('section_id', f'Section {idx+1}') for idx, section in enumerate(calibrated_structure.get('sections', []))]
+        received = {}
+        for position, (key, questions) in enumerate(by_key.items()):
+            if key not in section_ids and position < len(section_ids) and section_ids[position] not in by_key:
+                key = section_ids[position]
+            received.setdefault(key, []).extend(questions)
+    
+    # Cut off at the token limit: keep what arrived and request only the missing questions
+    question_bank = {}
+    shortfalls = []
+    for idx, section in enumerate(calibrated_structure.get('sections', [])):
+        section_id = section.get('section_id', f'Section {idx+1}')
+        questions = received.get(section_id, [])
+        if len(questions) < questions_per_section:
+            try:
+                questions = questions + _generate_bank_chunk(calibrated_structure, {
+                    'section_index': idx,
+                    'section_id': section_id,
+                    'section': section,
+                    'chunk_index': 0,
+                    'num_chunks': 1,
+                    'count': questions_per_section - len(questions),
+                    'first_number': len(questions) + 1
+                }, emit=emit, avoid_texts=[question.get('question_text', '') for question in questions])
+            except GenerationCancelled:
+                raise
+            except Exception:
+                pass  # keep what arrived; reported as a shortfall below
+            if len(questions) < questions_per_section:
+                shortfalls.append(f"{section_id}: {len(questions)} of {questions_per_section}")
+        question_bank[section_id] = questions
+    
+    return {
+        "question_bank": question_bank,
+        "bank_summary": _summarize_question_bank(question_bank, calibrated_structure),
+        "warnings": [_bank_shortfall_warning(shortfalls)] if shortfalls else []
+    }
+
+def _bank_shortfall_warning(shortfalls):
+    """Warning for sections whose questions came back short, e.g. after a failed continuation"""
+    return "Some sections returned fewer questions than requested: " + "; ".join(shortfalls)
+
+def _section_bank_chunks(calibrated_structure, questions_per_section):
+    """Split every section into chunks small enough for one completion"""
+    chunks = []
+    num_chunks = max(1, math.ceil(questions_per_section / BANK_QUESTIONS_PER_CALL))
+    base, extra = divmod(questions_per_section, num_chunks)
+    
+    for idx, section in enumerate(calibrated_structure.get('sections', [])):
+        first_number = 1
+        for chunk_index in range(num_chunks):
+            count = base + (1 if chunk_index < extra else 0)
+            chunks.append({
+                'section_index': idx,
+                'section_id': section.get('section_id', f'Section {idx+1}'),
+                'section': section,
+                'chunk_index': chunk_index,
+                'num_chunks': num_chunks,
+                'count': count,
+                'first_number': first_number
+            })
+            first_number += count
+    
+    return chunks
+
+def _generate_bank_chunk(calibrated_structure, chunk, emit=None, avoid_texts=()):
+    """Generate the questions of one section chunk (runs on a worker thread)
+    
+    If the response is cut off at the token limit, the questions that
+    arrived are kept and the rest of the chunk is requested separately;
+    should that request fail too, the chunk comes back short and the
+    caller reports the shortfall.
+    """
+    section_structure = dict(calibrated_structure, sections=[chunk['section']])
+    section_id = chunk['section_id']
+    id_prefix = f"U{chunk['section_index'] + 1}"
+    first_id = f"{id_prefix}_Q{chunk['first_number']:03d}"
+    last_id = f"{id_prefix}_Q{chunk['first_number'] + chunk['count'] - 1:03d}"
+    
+    batch_note = ""
+    if chunk['num_chunks'] > 1:
+        batch_note = f"""
+- This is batch {chunk['chunk_index'] + 1} of {chunk['num_chunks']} for {section_id}; other batches are generated separately, so favour different topics and question setups than an obvious first pick"""
+    
+    user_prompt = f"""Generate the question bank for section {section_id} based on this calibrated structure:
+
+CALIBRATED STRUCTURE:
+{json.dumps(section_structure, indent=2)}
+
+QUESTION BANK REQUIREMENTS:
+- Generate exactly {chunk['count']} questions for {section_id}, with question_id values {first_id} to {last_id}
+- Return them under "question_bank" -> "{section_id}"
+- Cover MAXIMUM topics from complete syllabus relevant to this section
+- Difficulty distribution: 40% Easy, 40% Medium, 20% Hard
+- Follow calibrated Bloom's and CO distributions
+- Include variety: numerical problems, theoretical questions, mixed types
+- Ensure zero duplication within the section{batch_note}{_avoid_note(avoid_texts)}
+- Maintain professional engineering question format
+
+QUALITY STANDARDS:
+- Each question must be complete and solvable
+- Include proper visual aids (ASCII/descriptions) where needed
+- Provide realistic numerical values with units
+- Cover diverse topics within the section
+- Suitable for educators to pick and choose for paper assembly"""
+
+    def emit_question(path, question):
+        if emit:
+            emit("question", {"section_id": section_id, "question": question})
+    
+    try:
+        result = _stream_json_completion(
+            emit=emit_question,
+            stream_paths=[("question_bank", "*", "*")],
+            model="gpt-4.1-mini",
+            messages=[
+                {"role": "system", "content": QUESTION_BANK_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.4,
+            max_tokens=16000,
+            response_format={"type": "json_object"}
+        )
+    except TruncatedResponseError as e:
+        received = [question for _, question in e.completed][:chunk['count']]
+        if not received:
+            raise
+        if len(received) == chunk['count']:
+            return received
+        rest = dict(chunk, count=chunk['count'] - len(received), first_number=chunk['first_number'] + len(received))
+        avoid_texts = list(avoid_texts) + [question.get('question_text', '') for question in received]
+        try:
+            return received + _generate_bank_chunk(calibrated_structure, rest, emit, avoid_texts)
+        except GenerationCancelled:
+            raise
+        except Exception:
+            return received
+    
+    section_bank = result.get('question_bank', {})
+    questions = section_bank.get(section_id)
+    if questions is None:
+        # The model occasionally renames the section key; take the first list it returned
+        questions = next((value for value in section_bank.values() if isinstance(value, list)), [])
+    return questions
+
+def _summarize_question_bank(question_bank, calibrated_structure):
+    """Build a bank_summary from the merged questions instead of per-call LLM estimates"""
+    all_questions = [q for questions in question_bank.values() for q in questions]
+    total = len(all_questions)
+    
+    def distribution(field):
+        counts = Counter(q.get(field) for q in all_questions if q.get(field))
+        return {value: round(100 * count / total) for value, count in counts.items()}
+    
+    topics_covered = sorted({q['topic'] for q in all_questions if q.get('topic')})
+    syllabus_topics = calibrated_structure.get('generation_params', {}).get('full_syllabus_topics', [])
+    if syllabus_topics:
+        covered = {topic.lower() for topic in topics_covered}
+        hits = sum(1 for topic in syllabus_topics if topic.lower() in covered)
+        syllabus_utilization = f"{round(100 * hits / len(syllabus_topics))}% of complete syllabus covered"
+    else:
+        syllabus_utilization = f"{len(topics_covered)} topics covered"
+    
+    return {
+        "total_questions_generated": total,
+        "questions_per_section": {section_id: len(questions) for section_id, questions in question_bank.items()},
+        "difficulty_distribution": distribution('difficulty'),
+        "bloom_distribution": distribution('bloom_level'),
+        "co_distribution": distribution('co'),
+        "question_type_distribution": distribution('question_type'),
+        "topics_covered": topics_covered,
+        "syllabus_utilization": syllabus_utilization
+    }
+
+@timed_stage("question_bank")
+def generate_question_bank(calibrated_structure, questions_per_section=25, parallel_sections=True, max_workers=LLM_MAX_WORKERS, on_progress=None):
+    """Generate comprehensive question bank organized section-wise
+    
+    With parallel_sections every section (split into chunks of at most
+    BANK_QUESTIONS_PER_CALL questions) is requested separately on a bounded
+    thread pool and merged back, so wall-clock time follows the largest
+    section rather than the size of the whole bank.
+    
+    on_progress("question", {"section_id": ..., "question": ...}) is called
+    on the script thread for every question as soon as it has streamed in.
+    """
+    if not parallel_sections:
+        return _generate_question_bank_single(calibrated_structure, questions_per_section, emit=on_progress)
+    
+    chunks = _section_bank_chunks(calibrated_structure, questions_per_section)
+    if not chunks:
+        raise PipelineError("no sections found in the calibrated structure")
+    
+    chunk_results, chunk_errors = _run_concurrently(
+        {
+            (chunk['section_index'], chunk['chunk_index']): (_generate_bank_chunk, (calibrated_structure, chunk))
+            for chunk in chunks
+        },
+        max_workers,
+        on_progress
+    )
+    
+    # Merge in calibrated section order, independent of completion order
+    question_bank = {}
+    failures = []
+    shortfalls = []
+    for chunk in chunks:
+        key = (chunk['section_index'], chunk['chunk_index'])
+        if key in chunk_errors:
+            failures.append(f"{chunk['section_id']} (batch {chunk['chunk_index'] + 1}): {str(chunk_errors[key])}")
+        elif chunk_results.get(key):
+            question_bank.setdefault(chunk['section_id'], []).extend(chunk_results[key])
+            if len(chunk_results[key]) < chunk['count']:
+                shortfalls.append(f"{chunk['section_id']} (batch {chunk['chunk_index'] + 1}): {len(chunk_results[key])} of {chunk['count']}")
+    
+    if not question_bank:
+        raise PipelineError("no section returned questions" + (f" ({'; '.join(failures)})" if failures else ""))
+    
+    warnings = ["Some sections could not be generated: " + "; ".join(failures)] if failures else []
+    if shortfalls:
+        warnings.append(_bank_shortfall_warning(shortfalls))
+    return {
+        "question_bank": question_bank,
+        "bank_summary": _summarize_question_bank(question_bank, calibrated_structure),
+        "warnings": warnings
+    }
+
+PAPER_SYSTEM_PROMPT = """You are an expert question paper generator. Create unique, high-quality question papers based on the provided structure and specifications.
+
+Generate question papers that:
+1. Follow the EXACT structure and format patterns from sample papers
+2. Have zero duplication across papers  
+3. Use COMPLETE SYLLABUS scope for topic coverage (not just sample paper topics)
+4. Maintain observed question style distributions (numerical vs theoretical)
+5. Preserve internal choice format exactly (1a/1b where student picks ONE)
+6. Follow specified difficulty progression across papers
+7. Maintain proper Bloom's taxonomy and CO distributions
+8. Create realistic questions matching the subject's typical formats
+9. Include proper numerical values in numerical problems
+10. Handle visual requirements intelligently
+
+VISUAL HANDLING REQUIREMENTS:
+- Generate ALL question types without limitation
+- For questions needing visuals, choose appropriate method:
+
+METHOD A - ASCII DIAGRAMS (for simple cases):
+- Simple beams, basic trusses, elementary circuits, basic loading
+- Use symbols: █ (fixed support), ▲ (pinned), ○ (roller), ↑↓←→ (forces), ──── (beams), ● (point loads), ████ (distributed loads)
+- Keep clean and readable
+
+METHOD B - DETAILED DESCRIPTIONS (for complex cases):
+- Complex geometries, 3D structures, detailed mechanisms
+- Provide comprehensive visualization guidance
+- Include all dimensions, orientations, relationships
+
+NUMERICAL PROBLEM REQUIREMENTS:
+- Include specific numerical values with proper units
+- Provide complete given data
+- Use realistic engineering values
+- Format as "Given: ..., Find: ..., Calculate: ..."
+
+EXAMPLES:
+
+ASCII SUITABLE:
+"A simply supported beam carries loads as shown:
+     15kN ↓    25kN ↓
+A ────●────●──── B
+█    2m   3m   █
+|──────8m────────|
+Given: E = 200 GPa, I = 150×10⁶ mm⁴
+Find: (a) Reactions at supports (b) Maximum bending moment"
+
+DESCRIPTION SUITABLE:
+"A compound planetary gear system has: Sun gear (30 teeth) at center, three planet gears (20 teeth each) equally spaced around sun gear, ring gear (70 teeth) surrounding the system. Planet carrier rotates at 500 RPM clockwise. Sun gear is fixed. Calculate: (a) Speed of ring gear (b) Gear ratio of the system."
+
+Return response in this JSON format:
+
+{
+    "generated_papers": [
+        {
+            "paper_id": "Paper_Set_1_Easy",
+            "difficulty_level": "Easy",
+            "total_marks": 40,
+            "exam_duration": 120,
+            "instructions": "Answer any ONE question from each unit",
+            "sections": [
+                {
+                    "section_id": "UNIT-I",
+                    "section_name": "Unit I Questions",
+                    "questions": [
+                        {
+                            "question_group": "1",
+                            "internal_choice": true,
+                            "choice_instruction": "Answer any ONE question from this group",
+                            "options": [
+                                {
+                                    "question_number": "1a",
+                                    "question_text": "A steel cantilever beam AB of length 3m carries a uniformly distributed load of 20 kN/m over its entire span. Given: E = 200 GPa, I = 120×10⁶ mm⁴. Calculate: (a) Maximum deflection (b) Maximum slope",
+                                    "visual_aid": {
+                                        "type": "ascii",
+                                        "content": "████████████ ← 20 kN/m UDL\nA ────────────── B\n█               (free end)\n|─────3m───────|\nFixed support",
+                                        "visualization_guide": "Cantilever beam fixed at A, free at B, with uniform load across entire span"
+                                    },
+                                    "given_data": ["Length L = 3m", "UDL w = 20 kN/m", "E = 200 GPa", "I = 120×10⁶ mm⁴"],
+                                    "find": "Maximum deflection and slope",
+                                    "marks": 10,
+                                    "co": "CO1",
+                                    "bloom_level": "Apply",
+                                    "difficulty": "easy",
+                                    "topic": "Topic from full syllabus",
+                                    "question_type": "numerical_problem"
+                                },
+                                {
+                                    "question_number": "1b",
+                                    "question_text": "A compound gear train system consists of: Input shaft with Gear A (25 teeth, 1200 RPM clockwise), meshing with Gear B (75 teeth) on intermediate shaft. Same intermediate shaft has Gear C (20 teeth) meshing with output Gear D (80 teeth). Calculate: (a) Speed of intermediate shaft (b) Final output speed and direction (c) Overall gear ratio",
+                                    "visual_aid": {
+                                        "type": "description",
+                                        "content": "Visualize a compound gear train: Left side has input shaft (vertical) with small Gear A meshing with large Gear B on horizontal intermediate shaft. Right side of same intermediate shaft has small Gear C meshing with large output Gear D on vertical output shaft. Power flows: Input → A → B → Intermediate shaft → C → D → Output",
+                                        "visualization_guide": "Draw three parallel shafts: input (left), intermediate (center horizontal), output (right). Show gear pairs A-B and C-D with size proportional to teeth count"
+                                    },
+                                    "given_data": ["Gear A: 25 teeth, 1200 RPM CW", "Gear B: 75 teeth", "Gear C: 20 teeth", "Gear D: 80 teeth"],
+                                    "find": "Intermediate shaft speed, output speed and direction, overall gear ratio",
+                                    "marks": 10,
+                                    "co": "CO1", 
+                                    "bloom_level": "Apply",
+                                    "difficulty": "easy",
+                                    "topic": "Different topic from full syllabus",
+                                    "question_type": "numerical_problem"
+                                }
+                            ]
+                        }
+                    ]
+                }
+            ]
+        }
+    ],
+    "generation_summary": {
+        "total_papers_generated": 5,
+        "unique_questions_created": 40,
+        "topics_covered": ["Full list of topics used from complete syllabus"],
+        "cos_covered": ["CO1", "CO2", "CO3"],
+        "difficulty_progression": "Easy to Hard across papers",
+        "syllabus_utilization": "Covered X% of complete syllabus across all papers"
+    }
+}"""
+
+PAPER_DIFFICULTY_LEVELS = ["Easy", "Easy-Medium", "Medium", "Medium-Hard", "Hard"]
+
+# Continuations in a row that may be cut off again inside the section they
+# resumed; past this a paper is returned with what arrived, marked incomplete
+PAPER_STALLED_CONTINUATIONS = 2
+
+# Difficulty mix (%) each paper level leans towards when assembling from a
+# bank; blended 50/50 with the calibrated section mix (None keeps it as is)
+PAPER_DIFFICULTY_PROFILES = {
+    "Easy": {"easy": 70, "medium": 25, "hard": 5},
+    "Easy-Medium": {"easy": 45, "medium": 45, "hard": 10},
+    "Medium": None,
+    "Medium-Hard": {"easy": 10, "medium": 45, "hard": 45},
+    "Hard": {"easy": 5, "medium": 25, "hard": 70}
+}
+
+# Content-word overlap (Jaccard) above which two questions count as the same question
+DUPLICATE_SIMILARITY_THRESHOLD = 0.7
+
+# MinHash-LSH parameters for the near-duplicate index: BANDS bands of
+# PERMUTATIONS / BANDS rows each; 16 x 4 finds ~99% of pairs at 0.7 similarity
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+
+def _generate_question_papers_single(calibrated_structure, num_papers, emit=None):
+    """Generate every paper with a single completion"""
+    user_prompt = f"""Generate {num_papers} unique question papers based on this calibrated structure:
+
+CALIBRATED STRUCTURE:
+{json.dumps(calibrated_structure, indent=2)}
+
+GENERATION REQUIREMENTS:
+- Paper 1: Easy level
+- Paper 2: Easy-Medium level  
+- Paper 3: Medium level
+- Paper 4: Medium-Hard level
+- Paper 5: Hard level
+- ZERO question duplication across all papers
+- Use COMPLETE SYLLABUS for topic diversity (not just sample paper topics)
+- Maintain EXACT internal choice format from samples (1a/1b where applicable)
+- Follow observed question style patterns (numerical vs theoretical ratios)
+- Maintain proper section-wise distributions as calibrated
+- Cover maximum possible topics from the full syllabus across all papers
+
+CRITICAL VISUAL & NUMERICAL REQUIREMENTS:
+- For NUMERICAL problems: Include specific values, units, realistic engineering data
+- For questions needing visuals: Choose ASCII for simple geometries, detailed descriptions for complex cases
+- ASCII examples: Simple beams, basic trusses, elementary loading diagrams
+- Description examples: Complex 3D structures, multi-component systems, detailed mechanisms
+- Every numerical question must have: Given data, Find statement, specific numerical values
+- Ensure students can visualize and solve with provided information alone
+
+QUALITY STANDARDS:
+- Questions must be completely solvable with provided text/ASCII/descriptions
+- No missing information or ambiguous setups
+- Professional engineering question format
+- Appropriate difficulty progression across papers"""
+
+    sections = calibrated_structure.get('sections', [])
+    
+    def emit_paper_part(path, value):
+        if not emit:
+            return
+        if len(path) == 2:
+            emit("paper", {"paper_index": path[1], "paper": value})
+        else:
+            emit("question_group", {
+                "paper_index": path[1],
+                "section_id": _section_id_at(sections, path[3]),
+                "question_group": value
+            })
+    
+    try:
+        return _stream_json_completion(
+            emit=emit_paper_part,
+            stream_paths=[
+                ("generated_papers", "*"),
+                ("generated_papers", "*", "sections", "*", "questions", "*")
+            ],
+            model="gpt-4.1-mini",
+            messages=[
+                {"role": "system", "content": PAPER_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.3,
+            max_tokens=16000,
+            response_format={"type": "json_object"}
+        )
+    except TruncatedResponseError as e:
+        papers = [paper for path, paper in e.completed if len(path) == 2]
+        truncated = e
+    
+    # Cut off at the token limit: keep the finished papers, continue the one that was cut
+    # off from its received question groups and generate the missing ones one by one
+    levels = _paper_difficulty_levels(num_papers)
+    for i, paper in enumerate(papers):
+        paper['difficulty_level'] = paper.get('difficulty_level') or levels[i]
+    groups, partial_paper = _truncated_paper_parts(truncated, len(papers))
+    failures = []
+    for i in range(len(papers), num_papers):
+        avoid_texts = [question.get('question_text', '') for paper in papers for question in _iter_paper_questions(paper)]
+        try:
+            if groups and i == len(papers):
+                paper = _continue_truncated_paper(
+                    calibrated_structure, groups, partial_paper, i, num_papers, levels[i], avoid_texts, emit
+                )
+                papers.append(_finish_generated_paper(paper, i, levels[i], emit))
+            else:
+                papers.append(_generate_single_paper(calibrated_structure, i, num_papers, levels[i], emit=emit, avoid_texts=avoid_texts))
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            failures.append(f"Paper {i + 1} ({levels[i]}): {str(e)}")
+    if not papers:
+        raise PipelineError("no paper was returned" + (f" ({'; '.join(failures)})" if failures else ""))
+    
+    warnings = ["Some papers could not be generated: " + "; ".join(failures)] if failures else []
+    return {
+        "generated_papers": papers,
+        "generation_summary": _summarize_generated_papers(papers, calibrated_structure, 0, len(_find_cross_paper_duplicates(papers))),
+        "warnings": warnings + _incomplete_paper_warnings(papers)
+    }
+
+def _incomplete_paper_warnings(papers):
+    """Pop the "incomplete" notes _continue_truncated_paper leaves on papers and word them as warnings"""
+    notes = [
+        f"{paper.get('paper_id', f'Paper {i + 1}')}: {paper.pop('incomplete')}"
+        for i, paper in enumerate(papers) if 'incomplete' in paper
+    ]
+    return ["Some papers are incomplete: " + "; ".join(notes)] if notes else []
+
+def _section_id_at(sections, index):
+    """Section id of the calibrated section at index (generated papers keep calibrated order)"""
+    if isinstance(index, int) and index < len(sections):
+        return sections[index].get('section_id', f'Section {index+1}')
+    return f'Section {index+1}' if isinstance(index, int) else str(index)
+
+def _paper_difficulty_levels(num_papers):
+    """Spread the Easy -> Hard progression over num_papers papers"""
+    if num_papers == 1:
+        return ["Medium"]
+    last = len(PAPER_DIFFICULTY_LEVELS) - 1
+    return [PAPER_DIFFICULTY_LEVELS[round(i * last / (num_papers - 1))] for i in range(num_papers)]
+
+def _iter_paper_questions(paper):
+    """Yield every question dict of a paper, flattening 1a/1b internal choices"""
+    for section in paper.get('sections', []):
+        for q_group in section.get('questions', []):
+            if q_group.get('internal_choice', False):
+                yield from q_group.get('options', [])
+            else:
+                yield q_group
+
+def _normalize_question_text(text):
+    return re.sub(r'[^a-z0-9]+', ' ', (text or '').lower()).strip()
+
+_STOPWORDS = frozenset("""
+a an and are as at be by can do does for from has have how if in into is it its of on or that the their then
+there these this those to using was were what when where which while who why will with within your
+""".split())
+
+@functools.lru_cache(maxsize=65536)
+def _stem(word):
+    for suffix in ('ing', 'ed', 'es', 's'):
+        if len(word) > len(suffix) + 3 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+def _question_terms(text):
+    """Content words of a question with plural/tense endings stripped, so rewordings compare equal"""
+    return frozenset(
+        _stem(word) for word in _normalize_question_text(text).split()
+        if word not in _STOPWORDS and (len(word) > 1 or word.isdigit())
+    )
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+def find_near_duplicates(texts, threshold=DUPLICATE_SIMILARITY_THRESHOLD):
+    """Return (i, j, similarity) for every pair of texts (i < j) at or above threshold
+    
+    MinHash-LSH: each text's content words are hashed into a MinHash
+    signature (vectorized with numpy), signatures are split into bands and
+    only texts sharing a band bucket are compared exactly, so thousands of
+    questions are checked in milliseconds instead of comparing every pair.
+    """
+    terms = [_question_terms(text) for text in texts]
+    indexes = [i for i, t in enumerate(terms) if t]
+    if len(indexes) < 2:
+        return []
+    
+    np = _lazy_import("numpy")
+    hashes = np.array([zlib.crc32(term.encode()) for i in indexes for term in sorted(terms[i])], dtype=np.uint64)
+    offsets = np.cumsum([0] + [len(terms[i]) for i in indexes[:-1]])
+    rng = np.random.default_rng(1)
+    a = rng.integers(0, 2**64, MINHASH_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**64, MINHASH_PERMUTATIONS, dtype=np.uint64)
+    # Multiply-add-shift hashing of the 32-bit term hashes: wraps modulo 2**64, the high 32 bits are the hash
+    signatures = np.minimum.reduceat((hashes[:, None] * a + b) >> np.uint64(32), offsets, axis=0)
+    
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    candidates = set()
+    for band in range(MINHASH_BANDS):
+        keys = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows]).view(np.dtype((np.void, rows * 8))).ravel()
+        _, bucket_of, bucket_sizes = np.unique(keys, return_inverse=True, return_counts=True)
+        shared = np.flatnonzero(bucket_sizes[bucket_of] > 1)
+        buckets = {}
+        for position in shared.tolist():
+            buckets.setdefault(bucket_of[position], []).append(indexes[position])
+        for bucket in buckets.values():
+            for x in range(len(bucket)):
+                for y in range(x + 1, len(bucket)):
+                    candidates.add((bucket[x], bucket[y]))
+    
+    pairs = []
+    for i, j in sorted(candidates):
+        similarity = _jaccard(terms[i], terms[j])
+        if similarity >= threshold:
+            pairs.append((i, j, round(similarity, 2)))
+    return pairs
+
+def cluster_near_duplicates(texts, threshold=DUPLICATE_SIMILARITY_THRESHOLD):
+    """Group texts into clusters of near-duplicates (lists of indexes, only clusters of 2+)"""
+    parent = list(range(len(texts)))
+    
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    for i, j, _ in find_near_duplicates(texts, threshold):
+        parent[root(j)] = root(i)
+    
+    clusters = {}
+    for i in range(len(texts)):
+        clusters.setdefault(root(i), []).append(i)
+    return [members for members in clusters.values() if len(members) > 1]
+
+def _generate_single_paper(calibrated_structure, paper_index, num_papers, difficulty_level, emit=None, avoid_texts=(), stalls=0):
+    """Generate one paper at its target difficulty (runs on a worker thread)
+    
+    If the response is cut off at the token limit, the question groups that
+    arrived are kept and only the rest of the paper is requested.
+    """
+    generation_params = calibrated_structure.get('generation_params', {})
+    topics = generation_params.get('full_syllabus_topics', [])
+    topic_note = ""
+    if topics:
+        # Rotate the syllabus so each paper starts from a different part of it
+        offset = (paper_index * len(topics)) // num_papers
+        rotated = topics[offset:] + topics[:offset]
+        topic_note = f"""
+- Other papers are generated in parallel; to keep papers distinct, draw first on these topics in this order: {', '.join(rotated)}"""
+    
+    user_prompt = f"""Generate question paper {paper_index + 1} of {num_papers} based on this calibrated structure:
+
+CALIBRATED STRUCTURE:
+{json.dumps(calibrated_structure, indent=2)}
+
+GENERATION REQUIREMENTS:
+- Generate exactly ONE paper in "generated_papers"
+- Difficulty level of this paper: {difficulty_level}
+- Use paper_id "Paper_Set_{paper_index + 1}_{difficulty_level.replace('-', '_')}"
+- ZERO question duplication within the paper
+- Use COMPLETE SYLLABUS for topic diversity (not just sample paper topics){topic_note}{_avoid_note(avoid_texts)}
+- Maintain EXACT internal choice format from samples (1a/1b where applicable)
+- Follow observed question style patterns (numerical vs theoretical ratios)
+- Maintain proper section-wise distributions as calibrated
+
+CRITICAL VISUAL & NUMERICAL REQUIREMENTS:
+- For NUMERICAL problems: Include specific values, units, realistic engineering data
+- For questions needing visuals: Choose ASCII for simple geometries, detailed descriptions for complex cases
+- Every numerical question must have: Given data, Find statement, specific numerical values
+- Ensure students can visualize and solve with provided information alone
+
+QUALITY STANDARDS:
+- Questions must be completely solvable with provided text/ASCII/descriptions
+- No missing information or ambiguous setups
+- Professional engineering question format"""
+
+    sections = calibrated_structure.get('sections', [])
+    
+    def emit_question_group(path, q_group):
+        if emit:
+            emit("question_group", {
+                "paper_index": paper_index,
+                "section_id": _section_id_at(sections, path[3]),
+                "question_group": q_group
+            })
+    
+    try:
+        result = _stream_json_completion(
+            emit=emit_question_group,
+            stream_paths=[("generated_papers", 0, "sections", "*", "questions", "*")],
+            model="gpt-4.1-mini",
+            messages=[
+                {"role": "system", "content": PAPER_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.3,
+            max_tokens=16000,
+            response_format={"type": "json_object"}
+        )
+        papers = result.get('generated_papers', [])
+        if not papers:
+            raise ValueError("response contained no paper")
+        paper = papers[0]
+    except TruncatedResponseError as e:
+        groups, partial_paper = _truncated_paper_parts(e, 0)
+        if not groups:
+            raise ValueError("the response was cut off before its first question was complete")
+        paper = _continue_truncated_paper(
+            calibrated_structure, groups, partial_paper, paper_index, num_papers, difficulty_level, avoid_texts, emit, stalls
+        )
+    
+    return _finish_generated_paper(paper, paper_index, difficulty_level, emit)
+
+def _finish_generated_paper(paper, paper_index, difficulty_level, emit):
+    """Stamp a generated paper with its id and difficulty and report it as complete"""
+    paper['paper_id'] = f"Paper_Set_{paper_index + 1}_{difficulty_level.replace('-', '_')}"
+    paper['difficulty_level'] = difficulty_level
+    if emit:
+        emit("paper", {"paper_index": paper_index, "paper": paper})
+    return paper
+
+def _truncated_paper_parts(error, position):
+    """({section index: [question groups]}, partial paper) of the paper at position in a cut-off response"""
+    groups = {}
+    for path, q_group in error.completed:
+        if len(path) == 6 and path[1] == position:
+            groups.setdefault(path[3], []).append(q_group)
+    papers = error.partial.get('generated_papers') or []
+    partial_paper = papers[position] if position < len(papers) and isinstance(papers[position], dict) else {}
+    return groups, partial_paper
+
+def _continue_truncated_paper(calibrated_structure, groups, partial_paper, paper_index, num_papers, difficulty_level,
+                              avoid_texts, emit, stalls=0):
+    """Finish a paper whose response hit the token limit
+
+    groups holds the question groups received, by section index. A section
+    counts as finished once a later section has been started; the finished
+    sections are kept and the rest of the paper, from the unfinished section
+    on, is requested with their questions listed as ones to avoid. The
+    question groups already received for the unfinished section are kept
+    too, in place of the first ones the continuation returns for it. If the
+    continuation fails, or keeps being cut off inside the section it
+    resumed, the paper comes back with what was received and an
+    "incomplete" note the caller turns into a warning.
+    """
+    sections = calibrated_structure.get('sections', [])
+    partial_sections = partial_paper.get('sections', [])
+    
+    finished = max(max(groups, default=0), len(partial_sections) - 1)
+    kept = [
+        dict(
+            partial_sections[i] if i < len(partial_sections) else {},
+            section_id=_section_id_at(sections, i),
+            questions=groups.get(i, [])
+        )
+        for i in range(finished)
+    ]
+    
+    received = groups.get(finished, [])
+    received_id = _section_id_at(sections, finished)
+    kept_texts = [
+        question.get('question_text', '')
+        for part in kept + [{'questions': received}]
+        for question in _part_questions(part)
+    ]
+    
+    # The continuation reports question groups as they arrive, except the ones
+    # standing in for groups already shown; the finished paper is reported by the caller
+    skipped = {'count': 0}
+    def forward(kind, data):
+        if kind == "paper":
+            return
+        if kind == "question_group" and data['section_id'] == received_id and skipped['count'] < len(received):
+            skipped['count'] += 1
+            return
+        emit(kind, data)
+    
+    # Resuming the first section again makes no progress by sections, so count it
+    stalls = stalls + 1 if finished == 0 else 0
+    try:
+        if stalls > PAPER_STALLED_CONTINUATIONS:
+            raise ValueError(f"{received_id} was still cut off after {PAPER_STALLED_CONTINUATIONS} continuations")
+        rest = _generate_single_paper(
+            dict(calibrated_structure, sections=sections[finished:]), paper_index, num_papers, difficulty_level,
+            emit=forward if emit else None, avoid_texts=list(avoid_texts) + kept_texts, stalls=stalls
+        )
+    except GenerationCancelled:
+        raise
+    except Exception as e:
+        if received:
+            kept.append(dict(
+                partial_sections[finished] if finished < len(partial_sections) else {},
+                section_id=received_id,
+                questions=received
+            ))
+        return dict(
+            partial_paper, sections=kept,
+            incomplete=f"cut off in {received_id} and the remaining sections could not be generated ({str(e)})"
+        )
+    
+    rest_sections = rest.get('sections', [])
+    if rest_sections and received:
+        rest_sections[0] = dict(rest_sections[0], questions=received + rest_sections[0].get('questions', [])[len(received):])
+    paper = dict(partial_paper, sections=kept + rest_sections)
+    if 'incomplete' in rest:
+        paper['incomplete'] = rest['incomplete']  # a nested continuation came back short
+    return paper
+
+def _replace_duplicate_question(calibrated_structure, question, difficulty_level, avoid_texts, emit=None):
+    """Ask for a fresh question with the same slot attributes as a duplicated one"""
+    slot = {key: question.get(key) for key in ('marks', 'co', 'bloom_level', 'difficulty', 'question_type')}
+    avoid_list = "\n".join(f"- {text}" for text in avoid_texts)
+    
+    user_prompt = f"""A generated {difficulty_level} level question paper contains a question that duplicates one in another paper. Write ONE replacement question.
+
+SUBJECT: {calibrated_structure.get('exam_info', {}).get('subject_name', '')}
+FULL SYLLABUS TOPICS: {', '.join(calibrated_structure.get('generation_params', {}).get('full_syllabus_topics', []))}
+
+DUPLICATED QUESTION:
+{question.get('question_text', '')}
+
+KEEP THESE ATTRIBUTES:
+{json.dumps(slot, indent=2)}
+
+THE REPLACEMENT MUST NOT REPEAT OR REWORD ANY OF THESE QUESTIONS:
+{avoid_list}
+
+Return a JSON object {{"question": {{...}}}} using the same question fields as the papers (question_text, visual_aid, given_data, find, marks, co, bloom_level, difficulty, topic, question_type)."""
+
+    result = _stream_json_completion(
+        model="gpt-4.1-mini",
+        messages=[
+            {"role": "system", "content": PAPER_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.7,
+        max_tokens=2000,
+        response_format={"type": "json_object"}
+    )
+    
+    replacement = result.get('question') or {}
+    if not replacement.get('question_text'):
+        raise ValueError("response contained no replacement question")
+    return replacement
+
+def _find_cross_paper_duplicates(papers):
+    """Return (paper_index, question) pairs repeating a question from an earlier paper"""
+    entries = [(paper_index, question) for paper_index, paper in enumerate(papers) for question in _iter_paper_questions(paper)]
+    earlier = {}
+    for i, j, _ in find_near_duplicates([question.get('question_text', '') for _, question in entries]):
+        if entries[i][0] < entries[j][0]:
+            earlier.setdefault(j, []).append(i)
+    
+    # A question only counts against earlier questions that are themselves kept
+    duplicates, duplicate_indexes = [], set()
+    for j in sorted(earlier):
+        if any(i not in duplicate_indexes for i in earlier[j]):
+            duplicate_indexes.add(j)
+            duplicates.append(entries[j])
+    return duplicates
+
+def _enforce_unique_papers(calibrated_structure, papers, max_workers):
+    """Replace questions that repeat across papers; returns (replaced, remaining) counts"""
+    duplicates = _find_cross_paper_duplicates(papers)
+    if not duplicates:
+        return 0, 0
+    
+    duplicate_ids = {id(question) for _, question in duplicates}
+    avoid_texts = [
+        question.get('question_text', '')
+        for paper in papers
+        for question in _iter_paper_questions(paper)
+        if id(question) not in duplicate_ids
+    ]
+    
+    replacements, _ = _run_concurrently(
+        {
+            i: (_replace_duplicate_question, (
+                calibrated_structure, question, papers[paper_index].get('difficulty_level', 'Medium'), avoid_texts
+            ))
+            for i, (paper_index, question) in enumerate(duplicates)
+        },
+        max_workers
+    )
+    
+    for i, replacement in replacements.items():
+        question = duplicates[i][1]
+        question_number = question.get('question_number')
+        question.clear()
+        question.update(replacement)
+        if question_number:
+            question['question_number'] = question_number
+    
+    # Replacements are generated independently, so check the merged result once more
+    remaining = len(_find_cross_paper_duplicates(papers))
+    return len(replacements), remaining
+
+def _summarize_generated_papers(papers, calibrated_structure, duplicates_replaced, duplicates_remaining):
+    """Build generation_summary from the merged papers"""
+    questions = [q for paper in papers for q in _iter_paper_questions(paper)]
+    topics_covered = sorted({q['topic'] for q in questions if q.get('topic')})
+    cos_covered = sorted({q['co'] for q in questions if q.get('co')})
+    unique_texts = {_normalize_question_text(q.get('question_text', '')) for q in questions}
+    
+    syllabus_topics = calibrated_structure.get('generation_params', {}).get('full_syllabus_topics', [])
+    if syllabus_topics:
+        covered = {topic.lower() for topic in topics_covered}
+        hits = sum(1 for topic in syllabus_topics if topic.lower() in covered)
+        syllabus_utilization = f"Covered {round(100 * hits / len(syllabus_topics))}% of complete syllabus across all papers"
+    else:
+        syllabus_utilization = f"Covered {len(topics_covered)} topics across all papers"
+    
+    return {
+        "total_papers_generated": len(papers),
+        "unique_questions_created": len(unique_texts),
+        "topics_covered": topics_covered,
+        "cos_covered": cos_covered,
+        "difficulty_progression": " → ".join(paper.get('difficulty_level', '') for paper in papers),
+        "syllabus_utilization": syllabus_utilization,
+        "duplicates_replaced": duplicates_replaced,
+        "duplicates_remaining": duplicates_remaining
+    }
+
+@timed_stage("papers")
+def generate_question_papers(calibrated_structure, num_papers=5, parallel_papers=True, max_workers=LLM_MAX_WORKERS, on_progress=None):
+    """Generate question papers based on calibrated structure
+    
+    With parallel_papers each paper is requested on its own at its target
+    difficulty, concurrently, and a merge step replaces any question that
+    repeats across papers.
+    
+    on_progress is called on the script thread with ("question_group",
+    {"paper_index", "section_id", "question_group"}) and ("paper",
+    {"paper_index", "paper"}) events as the responses stream in.
+    """
+    if not parallel_papers:
+        return _generate_question_papers_single(calibrated_structure, num_papers, emit=on_progress)
+    
+    levels = _paper_difficulty_levels(num_papers)
+    papers_by_index, paper_errors = _run_concurrently(
+        {
+            i: (_generate_single_paper, (calibrated_structure, i, num_papers, level))
+            for i, level in enumerate(levels)
+        },
+        max_workers,
+        on_progress
+    )
+    
+    papers = [papers_by_index[i] for i in sorted(papers_by_index)]
+    failures = [
+        f"Paper {i + 1} ({levels[i]}): {str(paper_errors[i])}" for i in sorted(paper_errors)
+    ]
+    if not papers:
+        raise PipelineError("no paper was returned" + (f" ({'; '.join(failures)})" if failures else ""))
+    
+    warnings = ["Some papers could not be generated: " + "; ".join(failures)] if failures else []
+    warnings += _incomplete_paper_warnings(papers)
+    replaced, remaining = _enforce_unique_papers(calibrated_structure, papers, max_workers)
+    if remaining:
+        warnings.append(f"{remaining} question(s) still repeat across papers after replacement")
+    
+    return {
+        "generated_papers": papers,
+        "generation_summary": _summarize_generated_papers(papers, calibrated_structure, replaced, remaining),
+        "warnings": warnings
+    }
+
+def _part_questions(part):
+    """Question dicts of a paper section, question group, question or list of bank questions"""
+    if isinstance(part, list):
+        return [question for item in part for question in _part_questions(item)]
+    if not isinstance(part, dict):
+        return []
+    if 'questions' in part:
+        return _part_questions(part['questions'])
+    if part.get('internal_choice', False):
+        return [option for option in part.get('options', []) if isinstance(option, dict)]
+    return [part]
+
+def _regenerate_part(calibrated_structure, part, description, difficulty_level, avoid_texts, note='', system_prompt=PAPER_SYSTEM_PROMPT, emit=None):
+    """Ask for new questions in place of part, keeping its structure, numbering and slot attributes"""
+    old_questions = _part_questions(part)
+    avoid_list = "\n".join(f"- {text}" for text in avoid_texts) or "- (none)"
+    note_text = f"""
+REVIEWER NOTE ON THE CURRENT QUESTIONS:
+{note}
+""" if note else ""
+    
+    user_prompt = f"""Replace {description} with entirely new questions.
+
+SUBJECT: {calibrated_structure.get('exam_info', {}).get('subject_name', '')}
+FULL SYLLABUS TOPICS: {', '.join(calibrated_structure.get('generation_params', {}).get('full_syllabus_topics', []))}
+DIFFICULTY LEVEL: {difficulty_level}
+
+CURRENT {description.upper()}:
+{json.dumps(part, indent=2)}
+{note_text}
+REQUIREMENTS:
+- Keep exactly the same JSON structure and the same number of questions ({len(old_questions)})
+- Keep every question_number, question_id, marks, co, bloom_level, difficulty and question_type
+- Write new question_text, visual_aid, given_data, find and topic, following the same numerical/visual standards
+- Do not repeat or reword the current questions or any of these:
+{avoid_list}
+
+Return a JSON object {{"replacement": ...}} where ... is the new {description}."""
+
+    result = _stream_json_completion(
+        model="gpt-4.1-mini",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.7,
+        max_tokens=min(16000, 1000 + 1500 * len(old_questions)),
+        response_format={"type": "json_object"}
+    )
+    
+    replacement = result.get('replacement')
+    new_questions = _part_questions(replacement)
+    if type(replacement) is not type(part) or len(new_questions) != len(old_questions) \
+            or not all(question.get('question_text') for question in new_questions):
+        raise ValueError("response did not match the structure of the replaced questions")
+    
+    # Numbering and ids are the caller's, whatever the model returned
+    for old, new in zip(old_questions, new_questions):
+        for key in ('question_number', 'question_id'):
+            if key in old:
+                new[key] = old[key]
+    if isinstance(part, dict):
+        for key in ('section_id', 'section_name', 'question_number', 'internal_choice'):
+            if key in part:
+                replacement[key] = part[key]
+    return replacement
+
+def _similar_new_questions(new_questions, other_texts):
+    """How many of new_questions near-duplicate another question, old or new"""
+    texts = [question.get('question_text', '') for question in new_questions] + list(other_texts)
+    return len({i for pair in find_near_duplicates(texts) for i in pair[:2] if i < len(new_questions)})
+
+@timed_stage("regeneration")
+def regenerate_paper_part(calibrated_structure, generation_result, paper_index, section_index, group_index=None, option_index=None, note=''):
+    """Regenerate one section, question group or 1a/1b option of a generated paper in place
+    
+    With only section_index the whole section is replaced; with group_index
+    one question group (a direct question or a whole 1a/1b pair); with
+    option_index one option of a pair. The questions of every paper outside
+    the replaced part are sent as questions to avoid, and note is passed on
+    as reviewer feedback. Returns {"replaced", "added", "warnings"} with the
+    old and new question dicts; generation_summary is updated.
+    """
+    papers = generation_result.get('generated_papers', [])
+    paper = papers[paper_index]
+    sections = paper.get('sections', [])
+    section = sections[section_index]
+    section_id = section.get('section_id', f'Section {section_index + 1}')
+    
+    if group_index is None:
+        container, key = sections, section_index
+        description = f"section {section_id} of the question paper"
+    else:
+        q_group = section['questions'][group_index]
+        if option_index is None:
+            container, key = section['questions'], group_index
+            kind = "1a/1b choice pair" if q_group.get('internal_choice', False) else "question"
+            description = f"{kind} {q_group.get('question_number', group_index + 1)} of section {section_id}"
+        else:
+            option = q_group['options'][option_index]
+            container, key = q_group['options'], option_index
+            description = f"question {option.get('question_number', option_index + 1)} of section {section_id}"
+    
+    part = container[key]
+    old_questions = _part_questions(part)
+    old_ids = {id(question) for question in old_questions}
+    avoid_texts = [
+        question.get('question_text', '')
+        for other in papers
+        for question in _iter_paper_questions(other)
+        if id(question) not in old_ids
+    ]
+    
+    try:
+        replacement = _regenerate_part(
+            calibrated_structure, part, description, paper.get('difficulty_level', 'Medium'), avoid_texts, note
+        )
+    except Exception as e:
+        raise PipelineError(f"could not regenerate {description}: {str(e)}")
+    container[key] = replacement
+    new_questions = _part_questions(replacement)
+    
+    warnings = []
+    similar = _similar_new_questions(new_questions, avoid_texts)
+    if similar:
+        warnings.append(f"{similar} regenerated question(s) still resemble other questions")
+    
+    summary = generation_result.get('generation_summary', {})
+    summary.update(_summarize_generated_papers(
+        papers, calibrated_structure, summary.get('duplicates_replaced', 0), len(_find_cross_paper_duplicates(papers))
+    ))
+    generation_result['generation_summary'] = summary
+    return {"replaced": old_questions, "added": new_questions, "warnings": warnings}
+
+@timed_stage("regeneration")
+def regenerate_bank_questions(calibrated_structure, question_bank_result, section_id, question_index=None, note='', max_workers=LLM_MAX_WORKERS):
+    """Regenerate one question, or every question of a section, of a generated bank in place
+    
+    A whole section is regenerated in batches of BANK_QUESTIONS_PER_CALL on
+    the thread pool; batches that fail keep their old questions. Returns
+    {"replaced", "added", "warnings"} like regenerate_paper_part and updates
+    bank_summary.
+    """
+    question_bank = question_bank_result.get('question_bank', {})
+    questions = question_bank[section_id]
+    difficulty_level = "as given per question"
+    
+    if question_index is not None:
+        batches = [(question_index, question_index + 1)]
+    else:
+        batches = [(start, min(start + BANK_QUESTIONS_PER_CALL, len(questions))) for start in range(0, len(questions), BANK_QUESTIONS_PER_CALL)]
+    
+    def describe(start, stop):
+        if stop - start == 1:
+            return f"question {questions[start].get('question_id', start + 1)} of the {section_id} question bank"
+        return f"questions {start + 1} to {stop} of the {section_id} question bank"
+    
+    def regenerate(start, stop, emit=None):
+        avoid_texts = [question.get('question_text', '') for i, question in enumerate(questions) if not start <= i < stop]
+        return _regenerate_part(
+            calibrated_structure, questions[start:stop], describe(start, stop), difficulty_level, avoid_texts, note,
+            system_prompt=QUESTION_BANK_SYSTEM_PROMPT
+        )
+    
+    results, errors = _run_concurrently({batch: (regenerate, batch) for batch in batches}, max_workers)
+    if not results:
+        raise PipelineError("could not regenerate " + "; ".join(f"{describe(*batch)}: {str(errors[batch])}" for batch in batches))
+    
+    replaced, added = [], []
+    for (start, stop), new_questions in sorted(results.items()):
+        replaced.extend(questions[start:stop])
+        added.extend(new_questions)
+        questions[start:stop] = new_questions
+    
+    warnings = []
+    if errors:
+        warnings.append("Some questions were kept because regeneration failed: " + "; ".join(
+            f"{describe(*batch)}: {str(errors[batch])}" for batch in sorted(errors)
+        ))
+    added_ids = {id(question) for question in added}
+    similar = _similar_new_questions(added, [question.get('question_text', '') for question in questions if id(question) not in added_ids])
+    if similar:
+        warnings.append(f"{similar} regenerated question(s) still resemble other questions in {section_id}")
+    
+    question_bank_result['bank_summary'] = _summarize_question_bank(question_bank, calibrated_structure)
+    return {"replaced": replaced, "added": added, "warnings": warnings}
+
+# Calibrated style keys -> question_type values used in generated questions
+QUESTION_STYLE_TYPES = {"numerical_problems": "numerical_problem", "theoretical": "theoretical", "mixed": "mixed"}
+DIFFICULTY_RANKS = {"easy": 0, "medium": 1, "hard": 2}
+
+def _shares(distribution):
+    """Percentage dict -> {lowercased key: fraction}"""
+    distribution = {str(key).lower(): _as_number(value) for key, value in (distribution or {}).items()}
+    total = sum(distribution.values())
+    return {key: value / total for key, value in distribution.items()} if total else {}
+
+def _question_attribute(question, attribute):
+    return str(question.get(attribute) or '').strip().lower()
+
+def _section_slots(section):
+    """(groups, options per group, marks per option) of a calibrated section
+    
+    With internal choice question_count counts the options (1a and 1b) and
+    total_section_marks the one option answered per group.
+    """
+    count = max(1, int(_as_number(section.get('question_count', 1))))
+    marks = _as_number(section.get('total_section_marks', 0))
+    if section.get('has_internal_choice', False):
+        groups = max(1, count // 2)
+        return groups, 2, marks / groups
+    return count, 1, marks / count
+
+def _section_targets(section, difficulty_level):
+    """Target shares per attribute for one section of a paper at difficulty_level"""
+    difficulty = _shares(section.get('difficulty_distribution'))
+    profile = _shares(PAPER_DIFFICULTY_PROFILES.get(difficulty_level))
+    if profile:
+        difficulty = {key: (difficulty.get(key, 0) + profile.get(key, 0)) / (2 if difficulty else 1)
+                      for key in set(difficulty) | set(profile)}
+    styles = _shares(section.get('question_style_distribution'))
+    return {
+        "difficulty": difficulty,
+        "bloom_level": _shares(section.get('bloom_distribution')),
+        "question_type": {QUESTION_STYLE_TYPES.get(key, key): share for key, share in styles.items()}
+    }
+
+def _assembly_score(question, slot_marks, targets, counts, used_topics):
+    """How much picking question moves the paper towards its targets (higher is better)
+    
+    Each attribute scores the deficit of the question's value: its target
+    count after this pick minus how often it was already picked.
+    """
+    score = 0.0
+    for attribute, weight in (("difficulty", 2.0), ("bloom_level", 1.0), ("question_type", 1.0), ("co", 1.0)):
+        shares = targets.get(attribute)
+        if not shares:
+            continue
+        picked = counts[attribute]
+        value = _question_attribute(question, attribute)
+        score += weight * (shares.get(value, 0) * (sum(picked.values()) + 1) - picked[value])
+    if slot_marks:
+        score -= 6.0 * abs(_as_number(question.get('marks', 0)) - slot_marks) / slot_marks
+    if _question_attribute(question, 'topic') in used_topics:
+        score -= 1.0
+    return score
+
+def _pick_question(pool, taken, slot_marks, targets, counts, used_topics, pair_with=None):
+    """Best question of pool whose duplicate cluster is not in taken, or None"""
+    best, best_score = None, None
+    for cluster, question in pool:
+        if cluster in taken:
+            continue
+        score = _assembly_score(question, slot_marks, targets, counts, used_topics)
+        if pair_with is not None:
+            # The two options of a choice should be equally hard and test the same CO
+            score -= abs(DIFFICULTY_RANKS.get(_question_attribute(question, 'difficulty'), 1)
+                         - DIFFICULTY_RANKS.get(_question_attribute(pair_with, 'difficulty'), 1))
+            if _question_attribute(question, 'co') == _question_attribute(pair_with, 'co'):
+                score += 0.5
+        if best_score is None or score > best_score:
+            best, best_score = (cluster, question), score
+    return best
+
+def _assemble_paper(calibrated_structure, pools, paper_index, difficulty_level, used_clusters, notes):
+    """Greedily fill every slot of one paper from the bank pools; updates used_clusters"""
+    exam_info = calibrated_structure.get('exam_info', {})
+    co_shares = _shares(calibrated_structure.get('overall_distributions', {}).get('co_distribution'))
+    paper_counts = {"co": Counter()}
+    taken = set()
+    number = 0
+    sections = []
+    total_marks = 0
+    
+    for section_index, section in enumerate(calibrated_structure.get('sections', [])):
+        section_id = section.get('section_id', f'Section {section_index + 1}')
+        pool = pools.get(section_id, [])
+        groups, options_per_group, slot_marks = _section_slots(section)
+        targets = dict(_section_targets(section, difficulty_level), co=co_shares)
+        counts = {"difficulty": Counter(), "bloom_level": Counter(), "question_type": Counter(), "co": paper_counts["co"]}
+        used_topics = set()
+        reused = 0
+        section_questions = []
+        section_marks = 0
+        
+        def pick(pair_with=None):
+            nonlocal reused
+            choice = _pick_question(pool, taken | used_clusters, slot_marks, targets, counts, used_topics, pair_with)
+            if choice is None:
+                # Bank exhausted for this section: fall back to questions used by earlier papers
+                choice = _pick_question(pool, taken, slot_marks, targets, counts, used_topics, pair_with)
+                reused += choice is not None
+            if choice is None:
+                return None
+            cluster, question = choice
+            taken.add(cluster)
+            for attribute in ("difficulty", "bloom_level", "question_type", "co"):
+                counts[attribute][_question_attribute(question, attribute)] += 1
+            used_topics.add(_question_attribute(question, 'topic'))
+            picked = {key: value for key, value in question.items() if key != 'section_id'}
+            return picked
+        
+        for _ in range(groups):
+            number += 1
+            first = pick()
+            if first is None:
+                break
+            if options_per_group == 1:
+                first['question_number'] = str(number)
+                section_questions.append(first)
+                section_marks += _as_number(first.get('marks', 0))
+                continue
+            second = pick(pair_with=first)
+            if second is None:
+                break
+            first['question_number'], second['question_number'] = f"{number}a", f"{number}b"
+            section_questions.append({
+                "question_group": str(number),
+                "internal_choice": True,
+                "choice_instruction": "Answer any ONE question from this group",
+                "options": [first, second]
+            })
+            section_marks += _as_number(first.get('marks', 0))
+        total_marks += section_marks
+        
+        placed = sum(len(q.get('options', [q])) for q in section_questions)
+        if placed < groups * options_per_group:
+            notes.append(f"Paper {paper_index + 1} {section_id}: the bank has only {placed} of the {groups * options_per_group} questions needed")
+        elif round(section_marks) != round(slot_marks * groups):
+            notes.append(f"Paper {paper_index + 1} {section_id}: {section_marks:g} marks instead of {slot_marks * groups:g}, "
+                         f"the bank lacks unused questions with the right marks")
+        if reused:
+            notes.append(f"Paper {paper_index + 1} {section_id}: reused {reused} question(s) from earlier papers")
+        sections.append({
+            "section_id": section_id,
+            "section_name": section.get('section_name', f"{section_id} Questions"),
+            "questions": section_questions
+        })
+    
+    used_clusters |= taken
+    return {
+        "paper_id": f"Paper_Set_{paper_index + 1}_{difficulty_level.replace('-', '_')}",
+        "difficulty_level": difficulty_level,
+        "total_marks": round(total_marks) if total_marks else exam_info.get('total_marks', 0),
+        "exam_duration": exam_info.get('exam_duration_minutes', 0),
+        "instructions": exam_info.get('instruction_text', ''),
+        "sections": sections
+    }
+
+@timed_stage("assembled_papers")
+def assemble_question_papers(calibrated_structure, question_bank, num_papers=5):
+    """Build question papers from an existing bank locally, without LLM calls
+    
+    question_bank maps section_id -> questions. Each paper is filled slot by
+    slot with the question that best closes the gap to the calibrated
+    targets: marks per question, section difficulty (shifted by the paper's
+    level), Bloom and style mixes and the overall CO distribution; 1a/1b
+    options are paired by difficulty and CO. Near-duplicate questions count
+    as one, and no question is used twice until a section's bank runs out.
+    Returns the same structure as generate_question_papers.
+    """
+    missing = [
+        section.get('section_id') for section in calibrated_structure.get('sections', [])
+        if not question_bank.get(section.get('section_id'))
+    ]
+    if missing:
+        raise PipelineError(f"the question bank has no questions for {', '.join(map(str, missing))}")
+    
+    entries = [(section_id, question) for section_id, questions in question_bank.items() for question in questions]
+    cluster_of = list(range(len(entries)))
+    for members in cluster_near_duplicates([question.get('question_text', '') for _, question in entries]):
+        for i in members:
+            cluster_of[i] = members[0]
+    pools = {}
+    for i, (section_id, question) in enumerate(entries):
+        pools.setdefault(section_id, []).append((cluster_of[i], question))
+    
+    notes = []
+    used_clusters = set()
+    papers = [
+        _assemble_paper(calibrated_structure, pools, i, level, used_clusters, notes)
+        for i, level in enumerate(_paper_difficulty_levels(num_papers))
+    ]
+    
+    remaining = len(_find_cross_paper_duplicates(papers))
+    summary = _summarize_generated_papers(papers, calibrated_structure, 0, remaining)
+    summary["assembled_from_bank"] = True
+    summary["assembly_notes"] = notes
+    return {"generated_papers": papers, "generation_summary": summary}
+
+class FileCache:
+    """Content-addressed JSON cache on disk with size-bounded LRU eviction
+
+    Entries are stored one file per key; reading an entry refreshes its
+    mtime, and the least recently used files are deleted once the directory
+    grows past max_bytes.
+    """
+
+    suffix = ".json"
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def _read(self, path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write(self, path, value):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            value = self._read(path)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._write(tmp_path, value)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.suffix):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+class BinaryFileCache(FileCache):
+    """FileCache for raw bytes, e.g. rendered PDFs"""
+
+    def __init__(self, directory, max_bytes, suffix=".bin"):
+        super().__init__(directory, max_bytes)
+        self.suffix = suffix
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _write(self, path, value):
+        with open(path, "wb") as f:
+            f.write(value)
+
+textract_cache = FileCache(TEXTRACT_CACHE_DIR, TEXTRACT_CACHE_MAX_MB * 1024 * 1024)
+
+def _textract_cache_key(pdf_bytes, csm_id, mode):
+    """Cache key for one PDF: its SHA-256 plus the extraction parameters"""
+    pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    return hashlib.sha256(f"{pdf_hash}:{csm_id}:{mode}".encode("utf-8")).hexdigest()
+
+def _match_textract_results(results, file_names):
+    """Line up API results with the uploaded files (by file name, falling back to order)"""
+    by_name = {result.get('file_name'): result for result in results}
+    if all(name in by_name for name in file_names):
+        return [by_name[name] for name in file_names]
+    return [results[i] if i < len(results) else None for i in range(len(file_names))]
+
+def _is_cacheable_textract_result(result):
+    return bool(result) and 'error' not in result and bool((result.get('extracted_text') or '').strip())
+
+class TruncatedResponseError(Exception):
+    """A completion stopped at max_tokens; holds what was received before the cut"""
+
+    def __init__(self, parser, completed):
+        super().__init__(f"the response was cut off at the token limit after {len(parser.text)} characters")
+        self.completed = completed  # (path, value) of every stream_paths object received in full
+        try:
+            self.partial = parser.partial()
+        except ValueError:
+            self.partial = {}
+
+class PipelineError(Exception):
+    """A pipeline stage produced no usable result"""
+
+class GenerationCancelled(Exception):
+    """Raised inside a generation job's requests once the job has been cancelled"""
+
+class TextractError(Exception):
+    """Raised when the Textract API rejects or fails a file"""
+
+def _parse_textract_response(response_data):
+    """Unwrap the API payload, which is either the body itself or a Lambda-style {'body': ...}"""
+    if 'results' in response_data:
+        return response_data
+    if 'body' in response_data:
+        body_data = response_data['body']
+        if isinstance(body_data, str):
+            body_data = json.loads(body_data)
+        return body_data
+    raise TextractError("Unexpected response format from Textract API")
+
+_textract_session = None
+_textract_session_lock = threading.Lock()
+
+def get_textract_session():
+    """The process-wide requests session for TEXTRACT_API_URL, created on first use
+    
+    Up to TEXTRACT_POOL_SIZE connections are kept alive and reused by every
+    extraction job; when all are busy, uploads wait for one rather than
+    opening a throwaway connection.
+    """
+    global _textract_session
+    if _textract_session is None:
+        with _textract_session_lock:
+            if _textract_session is None:
+                requests = _lazy_import("requests")
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=TEXTRACT_POOL_SIZE, pool_block=True)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _textract_session = session
+    return _textract_session
+
+_warm_up_started = False
+
+def _open_connection(send, url):
+    """One warm-up request; any HTTP answer leaves a pooled connection behind"""
+    try:
+        send(url, timeout=OPENAI_CONNECT_TIMEOUT_SECONDS)
+    except Exception:
+        pass
+
+def warm_up_connections():
+    """Open HTTP_WARM_CONNECTIONS pooled connections to OpenAI and Textract in the background
+    
+    Runs once per process, so the first users after a restart do not pay the
+    openai import and the TCP and TLS handshakes. The requests are bare HEADs
+    and failures are ignored. Returns the background thread, or None when
+    warm-up has already started or is disabled.
+    """
+    global _warm_up_started
+    with _client_lock:
+        if _warm_up_started or HTTP_WARM_CONNECTIONS <= 0:
+            return None
+        _warm_up_started = True
+    
+    def warm_up():
+        targets = []
+        if TEXTRACT_API_URL:
+            targets.append((get_textract_session().head, TEXTRACT_API_URL))
+        try:
+            openai_client = get_openai_client()
+        except Exception:  # no API key yet; the first request will report it
+            openai_client = None
+        if openai_client is not None and _openai_http_client is not None:
+            targets.append((_openai_http_client.head, str(openai_client.base_url)))
+        if not targets:
+            return
+        with ThreadPoolExecutor(max_workers=len(targets) * HTTP_WARM_CONNECTIONS, thread_name_prefix="warm-up") as executor:
+            for send, url in targets:
+                for _ in range(HTTP_WARM_CONNECTIONS):
+                    executor.submit(_open_connection, send, url)
+    
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def _request_textract(file_name, content, csm_id):
+    """Send one PDF to the Textract API and return its result; raises on failure"""
+    started = time.perf_counter()
+    try:
+        response = get_textract_session().post(
+            TEXTRACT_API_URL,
+            files={'paper1': (file_name, content, 'application/pdf')},
+            data={'csm_id': csm_id, 'mode': TEXTRACT_MODE},
+            timeout=(TEXTRACT_CONNECT_TIMEOUT_SECONDS, TEXTRACT_TIMEOUT_SECONDS)
+        )
+    except Exception:
+        record_textract_call(time.perf_counter() - started, len(content), ok=False)
+        raise
+    record_textract_call(time.perf_counter() - started, len(content), ok=response.status_code == 200)
+    if response.status_code != 200:
+        raise TextractError(f"Textract API error: {response.status_code} - {response.text}")
+    
+    body_data = _parse_textract_response(response.json())
+    result = _match_textract_results(body_data.get('results', []), [file_name])[0]
+    if result is None:
+        raise TextractError("Textract API returned no result for this file")
+    return result
+
+def _has_usable_text_layer(text):
+    """Heuristic for a digitally generated page: enough text, mostly real characters"""
+    visible = ''.join((text or '').split())
+    if len(visible) < LOCAL_TEXT_MIN_CHARS:
+        return False
+    readable = sum(1 for char in visible if char.isalnum())
+    return readable / len(visible) >= 0.5 and visible.count('�') < len(visible) * 0.05
+
+def _local_page_texts(content):
+    """Per-page text from the PDF's own text layer, None for pages that look scanned
+    
+    Returns None when pypdf is not installed or the PDF cannot be parsed, in
+    which case the whole file goes to Textract.
+    """
+    pypdf = _lazy_import("pypdf", optional=True)
+    if pypdf is None:
+        return None
+    try:
+        reader = pypdf.PdfReader(BytesIO(content))
+        pages = []
+        for page in reader.pages:
+            text = page.extract_text() or ''
+            pages.append(text if _has_usable_text_layer(text) else None)
+        return pages
+    except Exception:
+        return None
+
+def _pdf_page_range(content, start, stop):
+    """New PDF holding pages [start, stop) of content"""
+    pypdf = _lazy_import("pypdf")
+    reader = pypdf.PdfReader(BytesIO(content))
+    writer = pypdf.PdfWriter()
+    for page in reader.pages[start:stop]:
+        writer.add_page(page)
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+def _scanned_page_runs(pages):
+    """(start, stop) ranges of consecutive pages without a usable text layer"""
+    runs = []
+    start = None
+    for i, text in enumerate(pages + ['end']):
+        if text is None and start is None:
+            start = i
+        elif text is not None and start is not None:
+            runs.append((start, i))
+            start = None
+    return runs
+
+@timed_stage("extraction")
+def extract_pdf_text(file_name, content, csm_id, use_cache=True):
+    """Extract one PDF, consulting the per-file cache first; raises on failure
+    
+    Pages with a usable text layer are read in-process; only runs of scanned
+    pages are sent to Textract (as smaller PDFs), so digital papers never
+    leave the server. The result matches the Textract results schema.
+    """
+    cache_key = _textract_cache_key(content, csm_id, TEXTRACT_MODE)
+    if use_cache:
+        cached = textract_cache.get(cache_key)
+        if cached is not None:
+            # Cached by content: the same PDF may come back under another name
+            return dict(cached, file_name=file_name, from_cache=True)
+    
+    pages = _local_page_texts(content)
+    if not pages or all(text is None for text in pages):
+        result = _request_textract(file_name, content, csm_id)
+        result['extraction_method'] = 'textract'
+    else:
+        runs = _scanned_page_runs(pages)
+        for start, stop in runs:
+            subset = content if (start, stop) == (0, len(pages)) else _pdf_page_range(content, start, stop)
+            remote = _request_textract(file_name, subset, csm_id)
+            if 'error' in remote:
+                raise TextractError(remote['error'])
+            # Keep the page order: the run's text takes the place of its first page
+            pages[start] = remote.get('extracted_text', '')
+            for i in range(start + 1, stop):
+                pages[i] = ''
+        
+        extracted_text = "\n\n".join(text for text in pages if text)
+        result = {
+            'file_name': file_name,
+            'extracted_text': extracted_text,
+            'text_length': len(extracted_text),
+            'final_status': 'SUCCEEDED',
+            'extraction_method': 'mixed' if runs else 'local',
+            'textract_pages': sum(stop - start for start, stop in runs),
+            'total_pages': len(pages)
+        }
+    
+    if use_cache and _is_cacheable_textract_result(result):
+        textract_cache.put(cache_key, result)
+    return result
+
+# Extraction jobs are process-wide so a reconnecting browser can pick its job up again
+_textract_jobs = {}
+_textract_jobs_lock = threading.Lock()
+_textract_executor = ThreadPoolExecutor(max_workers=TEXTRACT_MAX_WORKERS, thread_name_prefix="textract")
+
+def _run_textract_file(job_id, index, file_name, content, csm_id, use_cache):
+    """Worker body for one file of an extraction job"""
+    with _textract_jobs_lock:
+        job = _textract_jobs[job_id]
+        job['files'][index].update(state='extracting', started_at=time.time())
+    
+    try:
+        result = extract_pdf_text(file_name, content, csm_id, use_cache)
+        state = 'cached' if result.get('from_cache') else 'done'
+        error = result.get('error')
+    except Exception as e:
+        if isinstance(e, _lazy_import("requests").exceptions.Timeout):
+            error = "Request timed out. Textract processing took too long."
+        else:
+            error = str(e)
+        result = {'file_name': file_name, 'extracted_text': '', 'text_length': 0, 'final_status': 'FAILED', 'error': error}
+        state = 'failed'
+    
+    with _textract_jobs_lock:
+        job['files'][index].update(state=state, finished_at=time.time(), error=error)
+        job['results'][index] = result
+        if all(f['state'] in ('done', 'cached', 'failed') for f in job['files']):
+            job['state'] = 'done'
+            job['finished_at'] = time.time()
+
+def submit_textract_job(files, csm_id, use_cache=True):
+    """Start extracting [(file_name, pdf_bytes), ...] in the background and return a job id
+    
+    Each file is posted to TEXTRACT_API_URL on its own worker, so progress is
+    tracked per file; poll it with get_textract_job().
+    """
+    _prune_textract_jobs()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _textract_jobs_lock:
+        _textract_jobs[job_id] = {
+            'job_id': job_id,
+            'state': 'running',
+            'submitted_at': now,
+            'finished_at': None,
+            'files': [
+                {'file_name': name, 'state': 'queued', 'started_at': None, 'finished_at': None, 'error': None}
+                for name, _ in files
+            ],
+            'results': [None] * len(files)
+        }
+    for index, (name, content) in enumerate(files):
+        # The caller's context carries the metrics run and OpenAI tenant to the worker
+        _textract_executor.submit(
+            contextvars.copy_context().run, _run_textract_file, job_id, index, name, content, csm_id, use_cache
+        )
+    return job_id
+
+def get_textract_job(job_id):
+    """Snapshot of a job's state, with 'result' in the textract_output shape once finished"""
+    with _textract_jobs_lock:
+        job = _textract_jobs.get(job_id)
+        if job is None:
+            return None
+        snapshot = dict(job, files=[dict(f) for f in job['files']])
+        if job['state'] == 'done':
+            snapshot['result'] = {'results': list(job['results'])}
+    return snapshot
+
+def _prune_textract_jobs():
+    """Forget finished jobs nobody came back for"""
+    cutoff = time.time() - TEXTRACT_JOB_RETENTION_SECONDS
+    with _textract_jobs_lock:
+        for job_id in [j for j, job in _textract_jobs.items() if job['finished_at'] and job['finished_at'] < cutoff]:
+            del _textract_jobs[job_id]
+
+# Generation jobs outlive the script run that started them, so reruns and reloads do not abort them
+GENERATION_JOB_STAGES = {"question_bank": generate_question_bank, "papers": generate_question_papers}
+_generation_jobs = {}
+_generation_jobs_lock = threading.Lock()
+_generation_jobs_loaded = False
+_generation_executor = ThreadPoolExecutor(max_workers=GENERATION_MAX_WORKERS, thread_name_prefix="generation")
+
+def _new_job_progress(kind, calibrated_structure, options):
+    """What a job's on_progress events fill in; done/total drive the progress bar
+    
+    parts maps each section (bank) or paper label (papers) to the questions
+    or question groups parsed so far, in order, so a page polling the job
+    can show them as they arrive; complete lists the finished papers.
+    """
+    if kind == "question_bank":
+        total = options.get('questions_per_section', 25) * len(calibrated_structure.get('sections', []))
+        unit, labels = "questions", []
+    else:
+        total, unit = options.get('num_papers', 5), "papers"
+        labels = [f"Paper {i+1} ({level})" for i, level in enumerate(_paper_difficulty_levels(total))]
+    return {'done': 0, 'total': total, 'unit': unit, 'received': 0, 'first_after': None,
+            'labels': labels, 'parts': {}, 'complete': []}
+
+def _job_snapshot(job, with_params=False):
+    """Copy of a job's public fields, safe to read or serialize outside the lock"""
+    snapshot = {key: value for key, value in job.items() if not key.startswith('_') and (with_params or key != 'params')}
+    progress = job['progress']
+    snapshot['progress'] = dict(
+        progress, parts={part: list(items) for part, items in progress['parts'].items()}, complete=list(progress['complete'])
+    )
+    return snapshot
+
+def _save_generation_job(job):
+    """Write a job to GENERATION_JOBS_DIR atomically; a failed write only costs reattaching after a restart"""
+    with _generation_jobs_lock:
+        record = _job_snapshot(job, with_params=True)
+    path = os.path.join(GENERATION_JOBS_DIR, f"{record['job_id']}.json")
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(GENERATION_JOBS_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def _job_progress_handler(job):
+    """on_progress for a job: file each streamed question or question group under its section or paper"""
+    labels = job['progress']['labels']
+
+    def paper_label(paper_index):
+        return labels[paper_index] if paper_index < len(labels) else f"Paper {paper_index + 1}"
+
+    def on_progress(kind, data):
+        if kind == "question":
+            part, item = data['section_id'], data['question']
+        elif kind == "question_group":
+            part, item = paper_label(data['paper_index']), {'section_id': data['section_id'], 'question_group': data['question_group']}
+        elif kind == "paper":
+            with _generation_jobs_lock:
+                job['progress']['done'] += 1
+                job['progress']['complete'].append(paper_label(data['paper_index']))
+            return
+        else:
+            return
+        with _generation_jobs_lock:
+            progress = job['progress']
+            progress['received'] += 1
+            if progress['first_after'] is None:
+                progress['first_after'] = time.time() - job['started_at']
+            if kind == "question":
+                progress['done'] += 1
+            progress['parts'].setdefault(part, []).append(item)
+    return on_progress
+
+def _run_generation_job(job_id):
+    """Worker body of a generation job; a bank job also adds its questions to question_store"""
+    with _generation_jobs_lock:
+        job = _generation_jobs.get(job_id)
+        if job is None or job['state'] != 'queued':
+            return  # cancelled while it was queued
+        job.update(state='running', started_at=time.time())
+    _save_generation_job(job)
+    
+    _cancel_event.set(job['_cancel'])
+    _llm_cache_bypass.set(not job['use_cache'])
+    _llm_tenant.set(job['tenant'])
+    params = job['params']
+    stored = error = None
+    try:
+        result = GENERATION_JOB_STAGES[job['kind']](
+            params['calibrated_structure'], on_progress=_job_progress_handler(job), **params['options']
+        )
+        state = 'done'
+    except Exception as e:
+        result, state, error = None, 'failed', str(e)
+    if job['_cancel'].is_set():
+        result, state, error = None, 'cancelled', None
+    elif result and job['kind'] == "question_bank" and job['subject_code']:
+        try:
+            stored = question_store.add(job['subject_code'], job['subject_name'] or '', result.get('question_bank', {}))
+        except sqlite3.Error as e:
+            result.setdefault('warnings', []).append(f"Could not save the question bank: {str(e)}")
+    
+    with _generation_jobs_lock:
+        job.update(state=state, finished_at=time.time(), result=result, error=error, stored=stored)
+        job['progress']['parts'] = {}  # the result holds them now
+    _save_generation_job(job)
+
+def _enqueue_generation_job(job, context):
+    with _generation_jobs_lock:
+        _generation_jobs[job['job_id']] = job
+    _save_generation_job(job)
+    _generation_executor.submit(context.run, _run_generation_job, job['job_id'])
+
+def submit_generation_job(kind, calibrated_structure, options, subject_code=None, subject_name=None):
+    """Queue a question bank ("question_bank") or paper ("papers") generation and return its job id
+    
+    options are the keyword arguments of the stage, e.g. questions_per_section
+    or num_papers. Jobs run on one pool of GENERATION_MAX_WORKERS shared by
+    every session and keep running when the browser reruns, reloads or
+    disconnects; poll them with get_generation_job(). A bank job with a
+    subject_code adds its questions to question_store when it finishes.
+    """
+    if kind not in GENERATION_JOB_STAGES:
+        raise ValueError(f"unknown generation job kind: {kind}")
+    resume_generation_jobs()
+    _prune_generation_jobs()
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'kind': kind,
+        'state': 'queued',
+        'tenant': _llm_tenant.get(),
+        'use_cache': not _llm_cache_bypass.get(),
+        'subject_code': subject_code,
+        'subject_name': subject_name,
+        'params': {'calibrated_structure': calibrated_structure, 'options': dict(options)},
+        'submitted_at': time.time(),
+        'started_at': None,
+        'finished_at': None,
+        'cancel_requested': False,
+        'progress': _new_job_progress(kind, calibrated_structure, options),
+        'result': None,
+        'error': None,
+        'stored': None,
+        '_cancel': threading.Event()
+    }
+    # The caller's context carries the session's metrics run to the worker
+    _enqueue_generation_job(job, contextvars.copy_context())
+    return job['job_id']
+
+def get_generation_job(job_id):
+    """Snapshot of a job (state, progress, and 'result' once done), or None if it is unknown"""
+    resume_generation_jobs()
+    with _generation_jobs_lock:
+        job = _generation_jobs.get(job_id)
+        return _job_snapshot(job) if job is not None else None
+
+def cancel_generation_job(job_id):
+    """Stop a queued or running job; running requests end at their next streamed chunk
+    
+    Returns False if the job is unknown or already finished. The results of
+    a cancelled job are discarded.
+    """
+    with _generation_jobs_lock:
+        job = _generation_jobs.get(job_id)
+        if job is None or job['state'] not in ('queued', 'running'):
+            return False
+        job['_cancel'].set()
+        job['cancel_requested'] = True
+        if job['state'] == 'queued':
+            job.update(state='cancelled', finished_at=time.time())
+    _save_generation_job(job)
+    return True
+
+def generation_job_stats():
+    """Counts of queued and running generation jobs across all sessions"""
+    with _generation_jobs_lock:
+        states = Counter(job['state'] for job in _generation_jobs.values())
+    return {"queued": states['queued'], "running": states['running'], "max_workers": GENERATION_MAX_WORKERS}
+
+def resume_generation_jobs():
+    """Load the jobs saved in GENERATION_JOBS_DIR, once per process
+    
+    Finished jobs come back with their results, so a browser can still
+    reattach to them after a restart. Jobs the restart interrupted are
+    queued again from the start; with the LLM cache on, the responses they
+    had already received are not paid for twice.
+    """
+    global _generation_jobs_loaded
+    with _generation_jobs_lock:
+        if _generation_jobs_loaded:
+            return
+        _generation_jobs_loaded = True
+    try:
+        names = sorted(name for name in os.listdir(GENERATION_JOBS_DIR) if name.endswith(".json"))
+    except OSError:
+        return
+    
+    for name in names:
+        try:
+            with open(os.path.join(GENERATION_JOBS_DIR, name), encoding="utf-8") as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            continue
+        job['_cancel'] = threading.Event()
+        if job['state'] in ('queued', 'running') and job.get('cancel_requested'):
+            job.update(state='cancelled', finished_at=time.time())
+        if job['state'] in ('queued', 'running'):
+            params = job['params']
+            job.update(state='queued', started_at=None,
+                       progress=_new_job_progress(job['kind'], params['calibrated_structure'], params['options']))
+            # A fresh context: the resumed job belongs to no current session
+            _enqueue_generation_job(job, contextvars.Context())
+        else:
+            with _generation_jobs_lock:
+                _generation_jobs[job['job_id']] = job
+
+def _prune_generation_jobs():
+    """Forget finished jobs older than GENERATION_JOB_RETENTION_HOURS, in memory and on disk"""
+    cutoff = time.time() - GENERATION_JOB_RETENTION_HOURS * 3600
+    with _generation_jobs_lock:
+        expired = [job_id for job_id, job in _generation_jobs.items() if job['finished_at'] and job['finished_at'] < cutoff]
+        for job_id in expired:
+            del _generation_jobs[job_id]
+    for job_id in expired:
+        try:
+            os.remove(os.path.join(GENERATION_JOBS_DIR, f"{job_id}.json"))
+        except OSError:
+            pass
@@ -1,15 +1,50 @@
+import time
+_script_started = time.perf_counter()
+
 import streamlit as st
-import requests
 import json
-import time
+import re
+import sqlite3
+import hashlib
+import uuid
 from datetime import datetime
-from openai import OpenAI
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-from io import BytesIO
 import os
 
+# pandas, reportlab (via qpg_export), openai, numpy and requests are imported on first use
+from qpg_metrics import RunMetrics, current_run
+from qpg_pipeline import (
+    GENERATION_POLL_SECONDS,
+    IMPORT_TIMINGS,
+    QuestionBankStore,
+    TEXTRACT_POLL_SECONDS,
+    _llm_cache_bypass,
+    _llm_tenant,
+    analyze_papers_with_syllabus,
+    assemble_question_papers,
+    calibrate_structure,
+    cancel_generation_job,
+    cluster_near_duplicates,
+    generation_job_stats,
+    get_generation_job,
+    get_textract_job,
+    llm_cache,
+    openai_scheduler,
+    question_store,
+    regenerate_bank_questions,
+    regenerate_paper_part,
+    resume_generation_jobs,
+    submit_generation_job,
+    submit_textract_job,
+    warm_up_connections
+)
+
+# Only the first run in a process imports anything; later reruns find the modules loaded
+IMPORT_TIMINGS.setdefault("app modules", time.perf_counter() - _script_started)
+# Connect to OpenAI and Textract while the first page renders, and pick up generation
+# jobs a restart interrupted; both are no-ops on later reruns
+warm_up_connections()
+resume_generation_jobs()
+
 # Configure Streamlit page
 st.set_page_config(
     page_title="Question Paper Generator",
@@ -18,509 +53,182 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Questions drawn per page of the question bank browser; only the current page is rendered
+BANK_PAGE_SIZE = int(os.getenv("BANK_PAGE_SIZE", "20"))
 
-
-openai_api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=openai_api_key)
-
-# API Endpoints
-TEXTRACT_API_URL = os.getenv("TEXTRACT_API_URL")
-
-def analyze_papers_with_syllabus(paper_texts, subject_name, syllabus, course_objectives):
-    """Enhanced GPT analysis with syllabus and COs"""
+def _run_stage(error_label, stage, *args, **kwargs):
+    """Run a pipeline stage, showing its failure as an error and its warnings in the page"""
     try:
-        paper1_text = paper_texts[0]['extracted_text']
-        paper2_text = paper_texts[1]['extracted_text']
-        
-        system_prompt = """You are an expert educational assessment analyst. Your task is to analyze question papers against a given syllabus and course objectives.
-
-CRITICAL: Your job is to EXTRACT and ANALYZE the exact patterns from the sample papers, then use the FULL SYLLABUS scope for generation planning.
-
-Analyze the papers for:
-1. Structural compatibility and format consistency
-2. EXACT question type distribution observed in papers (numerical vs theoretical vs mixed)
-3. Internal choice patterns (1a/1b format recognition)
-4. Bloom's taxonomy distribution (CRITICAL for engineering education)
-5. Difficulty distribution as observed
-6. Topic coverage analysis: Sample papers vs Complete syllabus
-7. Generate detailed structure for FULL SYLLABUS coverage
-
-Return analysis in this EXACT JSON format:
-
-{
-    "are_compatible": true/false,
-    "compatibility_reason": "detailed explanation",
-    "compatibility_score": 85,
-    "subject_analysis": {
-        "subject_name": "extracted subject name",
-        "syllabus_coverage": {
-            "total_topics_in_syllabus": 12,
-            "topics_in_sample_papers": 6,
-            "sample_coverage_percentage": 50,
-            "uncovered_topics_in_samples": ["Topic A", "Topic B"],
-            "topics_in_sample_papers": ["Topic C", "Topic D"],
-            "full_syllabus_topics": ["All extracted topics from complete syllabus"]
-        },
-        "question_style_analysis": {
-            "numerical_problems_percentage": 65,
-            "theoretical_questions_percentage": 25,
-            "mixed_questions_percentage": 10,
-            "internal_choice_pattern": "1a/1b format in each section",
-            "typical_question_formats": ["State and prove...", "Calculate the...", "Determine the..."]
-        },
-        "co_alignment": {
-            "total_cos": 4,
-            "cos_covered_in_samples": ["CO1", "CO2", "CO3"],
-            "co_distribution_observed": {
-                "CO1": 35,
-                "CO2": 30,
-                "CO3": 25,
-                "CO4": 10
-            },
-            "co_alignment_score": 78
-        }
-    },
-    "common_structure": {
-        "exam_info": {
-            "exam_type": "midterm_exam",
-            "subject_name": "Engineering Mechanics",
-            "total_marks": 40,
-            "exam_duration_minutes": 120,
-            "total_questions": 8,
-            "instruction_text": "Answer any ONE question from each unit"
-        },
-        "sections": [
-            {
-                "section_id": "UNIT-I",
-                "section_name": "Unit I Questions", 
-                "section_instruction": "Answer any ONE question from this unit",
-                "question_count": 2,
-                "marks_per_question": 20,
-                "total_section_marks": 20,
-                "question_type": "long_answer",
-                "is_compulsory": false,
-                "has_internal_choice": true,
-                "internal_choice_format": "1a/1b - student picks ONE complete question",
-                "questions_to_answer": 1,
-                "observed_topics": ["Statics", "Force Systems"],
-                "question_style_distribution": {
-                    "numerical_problems": 70,
-                    "theoretical": 20,
-                    "mixed": 10
-                },
-                "difficulty_distribution": {
-                    "easy": 20,
-                    "medium": 60,
-                    "hard": 20
-                },
-                "bloom_distribution": {
-                    "Remember": 10,
-                    "Understand": 20,
-                    "Apply": 50,
-                    "Analyze": 20,
-                    "Evaluate": 0,
-                    "Create": 0
-                },
-                "co_distribution": {
-                    "CO1": 70,
-                    "CO2": 30
-                }
-            }
-        ],
-        "overall_distributions": {
-            "difficulty_distribution": {
-                "easy": 25,
-                "medium": 55,
-                "hard": 20
-            },
-            "bloom_distribution": {
-                "Remember": 15,
-                "Understand": 25,
-                "Apply": 35,
-                "Analyze": 25,
-                "Evaluate": 0,
-                "Create": 0
-            },
-            "co_distribution": {
-                "CO1": 30,
-                "CO2": 25,
-                "CO3": 25,
-                "CO4": 20
-            },
-            "question_type_distribution": {
-                "numerical_problems": 65,
-                "theoretical": 25,
-                "mixed": 10
-            }
-        }
-    },
-    "generation_ready": {
-        "can_generate": true,
-        "generation_confidence": 85,
-        "recommended_adjustments": ["Balance CO4 coverage", "Add more analytical questions"],
-        "full_syllabus_utilization": "ready to use complete syllabus for topic diversity"
-    }
-}
-
-Analysis Rules:
-- Extract EXACT patterns from sample papers (don't impose artificial distributions)
-- Use sample papers for FORMAT/STRUCTURE learning
-- Identify complete syllabus scope for CONTENT generation
-- Recognize internal choice patterns precisely
-- Analyze actual question styles and formats used"""
-
-        user_prompt = f"""Analyze these question papers against the subject syllabus and course objectives:
-
-SUBJECT: {subject_name}
-
-COMPLETE SYLLABUS (for full topic scope):
-{syllabus}
-
-COURSE OBJECTIVES:
-{course_objectives}
-
-PAPER 1 ({paper_texts[0]['filename']}) - {paper_texts[0]['text_length']} characters:
-=== OCR EXTRACTED TEXT START ===
-{paper1_text}
-=== OCR EXTRACTED TEXT END ===
-
-PAPER 2 ({paper_texts[1]['filename']}) - {paper_texts[1]['text_length']} characters:
-=== OCR EXTRACTED TEXT START ===
-{paper2_text}
-=== OCR EXTRACTED TEXT END ===
-
-CRITICAL ANALYSIS POINTS:
-1. Extract EXACT question format patterns from sample papers
-2. Identify actual question type distributions (numerical vs theoretical)
-3. Recognize internal choice structures (1a/1b patterns)
-4. Compare sample paper topics vs COMPLETE syllabus scope
-5. Plan for using FULL SYLLABUS in generation (not just sample topics)
-6. Maintain observed Bloom's taxonomy emphasis
-
-Provide comprehensive analysis for generating papers that follow sample STRUCTURE but cover FULL SYLLABUS."""
-
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.1,
-            max_tokens=8000,
-            response_format={"type": "json_object"}
-        )
-        
-        analysis_text = response.choices[0].message.content
-        structure_analysis = json.loads(analysis_text)
-        
-        return structure_analysis
-        
+        result = stage(*args, **kwargs)
     except Exception as e:
-        st.error(f"Error in structure analysis: {str(e)}")
+        st.error(f"{error_label}: {str(e)}")
         return None
+    for warning in result.pop('warnings', []) if isinstance(result, dict) else []:
+        st.warning(f"⚠️ {warning}")
+    return result
 
-def generate_question_bank(calibrated_structure, questions_per_section=25):
-    """Generate comprehensive question bank organized section-wise"""
-    try:
-        system_prompt = """You are an expert question bank generator. Create a comprehensive pool of questions organized by sections.
-
-Generate question banks that:
-1. Cover COMPLETE SYLLABUS topics extensively
-2. Provide variety in question formats and approaches
-3. Include proper difficulty distribution per section
-4. Maintain Bloom's taxonomy and CO coverage
-5. Zero duplication within the question bank
-6. Include proper numerical values and visual aids
-7. Create questions suitable for mix-and-match paper assembly
-
-VISUAL HANDLING (same as paper generation):
-- ASCII diagrams for simple geometries
-- Detailed descriptions for complex cases
-- Complete numerical data with units
-- Professional question formatting
-
-Return response in this JSON format:
-
-{
-    "question_bank": {
-        "UNIT-I": [
-            {
-                "question_id": "U1_Q001",
-                "question_text": "A cantilever beam of length 4m carries a point load of 15kN at free end...",
-                "visual_aid": {
-                    "type": "ascii",
-                    "content": "ASCII diagram here",
-                    "visualization_guide": "Description for visualization"
-                },
-                "given_data": ["Length L = 4m", "Load P = 15kN", "E = 200 GPa"],
-                "find": "Maximum deflection and slope",
-                "marks": 10,
-                "difficulty": "easy",
-                "bloom_level": "Apply",
-                "co": "CO1",
-                "topic": "Deflection of Beams",
-                "question_type": "numerical_problem",
-                "solution_approach": "Use double integration method or standard formulas"
-            }
-        ]
-    },
-    "bank_summary": {
-        "total_questions_generated": 50,
-        "questions_per_section": {"UNIT-I": 25, "UNIT-II": 25},
-        "difficulty_distribution": {"easy": 40, "medium": 40, "hard": 20},
-        "bloom_distribution": {"Remember": 15, "Understand": 25, "Apply": 35, "Analyze": 25},
-        "co_distribution": {"CO1": 25, "CO2": 25, "CO3": 25, "CO4": 25},
-        "question_type_distribution": {"numerical": 60, "theoretical": 30, "mixed": 10},
-        "topics_covered": ["Complete list of all topics covered"],
-        "syllabus_utilization": "85% of complete syllabus covered"
-    }
-}"""
-
-        user_prompt = f"""Generate a comprehensive question bank based on this calibrated structure:
-
-CALIBRATED STRUCTURE:
-{json.dumps(calibrated_structure, indent=2)}
-
-QUESTION BANK REQUIREMENTS:
-- Generate {questions_per_section} questions per section
-- Cover MAXIMUM topics from complete syllabus
-- Difficulty distribution per section: 40% Easy, 40% Medium, 20% Hard
-- Follow calibrated Bloom's and CO distributions
-- Include variety: numerical problems, theoretical questions, mixed types
-- Ensure zero duplication across entire question bank
-- Maintain professional engineering question format
-
-QUALITY STANDARDS:
-- Each question must be complete and solvable
-- Include proper visual aids (ASCII/descriptions) where needed
-- Provide realistic numerical values with units
-- Cover diverse topics within each section
-- Suitable for educators to pick and choose for paper assembly"""
-
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.4,
-            max_tokens=16000,
-            response_format={"type": "json_object"}
-        )
-        
-        question_bank_result = json.loads(response.choices[0].message.content)
-        return question_bank_result
-        
-    except Exception as e:
-        st.error(f"Error generating question bank: {str(e)}")
-        return None
-
-def generate_question_papers(calibrated_structure, num_papers=5):
-    """Generate question papers based on calibrated structure"""
-    try:
-        system_prompt = """You are an expert question paper generator. Create unique, high-quality question papers based on the provided structure and specifications.
-
-Generate question papers that:
-1. Follow the EXACT structure and format patterns from sample papers
-2. Have zero duplication across papers  
-3. Use COMPLETE SYLLABUS scope for topic coverage (not just sample paper topics)
-4. Maintain observed question style distributions (numerical vs theoretical)
-5. Preserve internal choice format exactly (1a/1b where student picks ONE)
-6. Follow specified difficulty progression across papers
-7. Maintain proper Bloom's taxonomy and CO distributions
-8. Create realistic questions matching the subject's typical formats
-9. Include proper numerical values in numerical problems
-10. Handle visual requirements intelligently
-
-VISUAL HANDLING REQUIREMENTS:
-- Generate ALL question types without limitation
-- For questions needing visuals, choose appropriate method:
-
-METHOD A - ASCII DIAGRAMS (for simple cases):
-- Simple beams, basic trusses, elementary circuits, basic loading
-- Use symbols: █ (fixed support), ▲ (pinned), ○ (roller), ↑↓←→ (forces), ──── (beams), ● (point loads), ████ (distributed loads)
-- Keep clean and readable
-
-METHOD B - DETAILED DESCRIPTIONS (for complex cases):
-- Complex geometries, 3D structures, detailed mechanisms
-- Provide comprehensive visualization guidance
-- Include all dimensions, orientations, relationships
-
-NUMERICAL PROBLEM REQUIREMENTS:
-- Include specific numerical values with proper units
-- Provide complete given data
-- Use realistic engineering values
-- Format as "Given: ..., Find: ..., Calculate: ..."
-
-EXAMPLES:
-
-ASCII SUITABLE:
-"A simply supported beam carries loads as shown:
-     15kN ↓    25kN ↓
-A ────●────●──── B
-█    2m   3m   █
-|──────8m────────|
-Given: E = 200 GPa, I = 150×10⁶ mm⁴
-Find: (a) Reactions at supports (b) Maximum bending moment"
-
-DESCRIPTION SUITABLE:
-"A compound planetary gear system has: Sun gear (30 teeth) at center, three planet gears (20 teeth each) equally spaced around sun gear, ring gear (70 teeth) surrounding the system. Planet carrier rotates at 500 RPM clockwise. Sun gear is fixed. Calculate: (a) Speed of ring gear (b) Gear ratio of the system."
-
-Return response in this JSON format:
+def display_textract_results(textract_output):
+    """Show per-file extraction status"""
+    results = textract_output.get('results', [])
+    columns = st.columns(min(len(results), 3) or 1)
+    for i, result in enumerate(results):
+        with columns[i % len(columns)]:
+            # Use 'file_name' instead of 'pdf_file'
+            st.write(f"**📄 {result.get('file_name', 'Unknown File')}**")
+            # Use 'final_status' if available, otherwise 'status'
+            status = result.get('final_status', result.get('status', 'Unknown'))
+            st.write(f"✅ Status: {status}")
+            st.write(f"📊 Characters: {result.get('text_length', 0)}")
+            if result.get('from_cache'):
+                st.caption("♻️ Reused cached extraction")
+            elif result.get('extraction_method') == 'local':
+                st.caption("⚡ Read from the PDF's text layer")
+            elif result.get('extraction_method') == 'mixed':
+                st.caption(f"⚡ Text layer used; {result.get('textract_pages', 0)} of {result.get('total_pages', 0)} pages sent to Textract")
+            
+            # Show any errors if present
+            if 'error' in result:
+                st.error(f"❌ Error: {result['error']}")
 
-{
-    "generated_papers": [
-        {
-            "paper_id": "Paper_Set_1_Easy",
-            "difficulty_level": "Easy",
-            "total_marks": 40,
-            "exam_duration": 120,
-            "instructions": "Answer any ONE question from each unit",
-            "sections": [
-                {
-                    "section_id": "UNIT-I",
-                    "section_name": "Unit I Questions",
-                    "questions": [
-                        {
-                            "question_group": "1",
-                            "internal_choice": true,
-                            "choice_instruction": "Answer any ONE question from this group",
-                            "options": [
-                                {
-                                    "question_number": "1a",
-                                    "question_text": "A steel cantilever beam AB of length 3m carries a uniformly distributed load of 20 kN/m over its entire span. Given: E = 200 GPa, I = 120×10⁶ mm⁴. Calculate: (a) Maximum deflection (b) Maximum slope",
-                                    "visual_aid": {
-                                        "type": "ascii",
-                                        "content": "████████████ ← 20 kN/m UDL\nA ────────────── B\n█               (free end)\n|─────3m───────|\nFixed support",
-                                        "visualization_guide": "Cantilever beam fixed at A, free at B, with uniform load across entire span"
-                                    },
-                                    "given_data": ["Length L = 3m", "UDL w = 20 kN/m", "E = 200 GPa", "I = 120×10⁶ mm⁴"],
-                                    "find": "Maximum deflection and slope",
-                                    "marks": 10,
-                                    "co": "CO1",
-                                    "bloom_level": "Apply",
-                                    "difficulty": "easy",
-                                    "topic": "Topic from full syllabus",
-                                    "question_type": "numerical_problem"
-                                },
-                                {
-                                    "question_number": "1b",
-                                    "question_text": "A compound gear train system consists of: Input shaft with Gear A (25 teeth, 1200 RPM clockwise), meshing with Gear B (75 teeth) on intermediate shaft. Same intermediate shaft has Gear C (20 teeth) meshing with output Gear D (80 teeth). Calculate: (a) Speed of intermediate shaft (b) Final output speed and direction (c) Overall gear ratio",
-                                    "visual_aid": {
-                                        "type": "description",
-                                        "content": "Visualize a compound gear train: Left side has input shaft (vertical) with small Gear A meshing with large Gear B on horizontal intermediate shaft. Right side of same intermediate shaft has small Gear C meshing with large output Gear D on vertical output shaft. Power flows: Input → A → B → Intermediate shaft → C → D → Output",
-                                        "visualization_guide": "Draw three parallel shafts: input (left), intermediate (center horizontal), output (right). Show gear pairs A-B and C-D with size proportional to teeth count"
-                                    },
-                                    "given_data": ["Gear A: 25 teeth, 1200 RPM CW", "Gear B: 75 teeth", "Gear C: 20 teeth", "Gear D: 80 teeth"],
-                                    "find": "Intermediate shaft speed, output speed and direction, overall gear ratio",
-                                    "marks": 10,
-                                    "co": "CO1", 
-                                    "bloom_level": "Apply",
-                                    "difficulty": "easy",
-                                    "topic": "Different topic from full syllabus",
-                                    "question_type": "numerical_problem"
-                                }
-                            ]
-                        }
-                    ]
-                }
-            ]
-        }
-    ],
-    "generation_summary": {
-        "total_papers_generated": 5,
-        "unique_questions_created": 40,
-        "topics_covered": ["Full list of topics used from complete syllabus"],
-        "cos_covered": ["CO1", "CO2", "CO3"],
-        "difficulty_progression": "Easy to Hard across papers",
-        "syllabus_utilization": "Covered X% of complete syllabus across all papers"
-    }
-}"""
+@st.fragment(run_every=TEXTRACT_POLL_SECONDS)
+def display_textract_job():
+    """Poll the running extraction job and show per-file progress
+    
+    Runs as a fragment so only this block refreshes while waiting; once the
+    job finishes its result moves into st.session_state.textract_output.
+    """
+    job_id = st.session_state.get('textract_job_id')
+    if not job_id:
+        return
+    
+    job = get_textract_job(job_id)
+    if job is None:
+        st.warning("⚠️ The extraction job is no longer available (the server may have restarted). Please extract again.")
+        st.session_state.textract_job_id = None
+        st.query_params.pop("textract_job", None)
+        return
+    
+    files = job['files']
+    finished = sum(1 for f in files if f['state'] in ('done', 'cached', 'failed'))
+    st.progress(finished / len(files), text=f"🔍 Extracting text: {finished}/{len(files)} files finished")
+    
+    state_labels = {'queued': '🕒 Queued', 'extracting': '⏳ Extracting', 'done': '✅ Done', 'cached': '♻️ Cached', 'failed': '❌ Failed'}
+    now = time.time()
+    for f in files:
+        elapsed = ''
+        if f['started_at']:
+            elapsed = f" ({(f['finished_at'] or now) - f['started_at']:.0f}s)"
+        st.write(f"**📄 {f['file_name']}** - {state_labels.get(f['state'], f['state'])}{elapsed}")
+        if f['error']:
+            st.caption(f"Error: {f['error']}")
+    
+    if job['state'] == 'done':
+        st.session_state.textract_output = job['result']
+        st.session_state.textract_job_id = None
+        st.query_params.pop("textract_job", None)
+        st.rerun()
 
-        user_prompt = f"""Generate {num_papers} unique question papers based on this calibrated structure:
+def _live_job_header(progress, noun):
+    """The 'N received' line above a running job's live preview"""
+    if progress['received']:
+        st.info(f"⏳ {progress['received']} {noun} received so far · first after {progress['first_after']:.1f}s")
 
-CALIBRATED STRUCTURE:
-{json.dumps(calibrated_structure, indent=2)}
+def _render_live_papers(progress):
+    """Show a running paper job's question groups under their papers as they stream in"""
+    _live_job_header(progress, "question groups")
+    for i, (label, groups) in enumerate(progress['parts'].items()):
+        complete = label in progress['complete']
+        box = st.status(f"📋 {label} - {'complete' if complete else 'generating...'}",
+                        state="complete" if complete else "running", expanded=i == 0)
+        with box:
+            for entry in groups:
+                st.caption(entry['section_id'])
+                _render_question_group(entry['question_group'])
 
-GENERATION REQUIREMENTS:
-- Paper 1: Easy level
-- Paper 2: Easy-Medium level  
-- Paper 3: Medium level
-- Paper 4: Medium-Hard level
-- Paper 5: Hard level
-- ZERO question duplication across all papers
-- Use COMPLETE SYLLABUS for topic diversity (not just sample paper topics)
-- Maintain EXACT internal choice format from samples (1a/1b where applicable)
-- Follow observed question style patterns (numerical vs theoretical ratios)
-- Maintain proper section-wise distributions as calibrated
-- Cover maximum possible topics from the full syllabus across all papers
+def _render_live_bank(progress):
+    """Show a running bank job's questions under their sections as they stream in"""
+    _live_job_header(progress, "questions")
+    for i, (section_id, questions) in enumerate(progress['parts'].items()):
+        with st.status(f"📖 {section_id} - {len(questions)} questions so far", expanded=i == 0):
+            for j, question in enumerate(questions):
+                _render_bank_question(question, section_id, j)
 
-CRITICAL VISUAL & NUMERICAL REQUIREMENTS:
-- For NUMERICAL problems: Include specific values, units, realistic engineering data
-- For questions needing visuals: Choose ASCII for simple geometries, detailed descriptions for complex cases
-- ASCII examples: Simple beams, basic trusses, elementary loading diagrams
-- Description examples: Complex 3D structures, multi-component systems, detailed mechanisms
-- Every numerical question must have: Given data, Find statement, specific numerical values
-- Ensure students can visualize and solve with provided information alone
+def _start_generation_job(kind, options, subject_code=None, subject_name=None):
+    """Queue a generation on the shared job pool and keep its id in the session and the URL"""
+    st.session_state.generation_job_id = submit_generation_job(
+        kind, st.session_state.calibrated_structure, options, subject_code, subject_name
+    )
+    # A reloaded or reconnecting browser finds the job again through the URL
+    st.query_params["generation_job"] = st.session_state.generation_job_id
 
-QUALITY STANDARDS:
-- Questions must be completely solvable with provided text/ASCII/descriptions
-- No missing information or ambiguous setups
-- Professional engineering question format
-- Appropriate difficulty progression across papers"""
+def _finish_generation_job(job):
+    """Move a finished job's result into the session; its messages are shown by the next run"""
+    noun = "question bank" if job['kind'] == "question_bank" else "question papers"
+    notices = {'celebrate': False, 'messages': []}
+    if job['state'] == 'done':
+        # The job keeps its own result, so copy it rather than pop the warnings from it
+        result = {key: value for key, value in job['result'].items() if key != 'warnings'}
+        if job['kind'] == "question_bank":
+            st.session_state.question_bank = result
+            total = sum(len(questions) for questions in result.get('question_bank', {}).values())
+            notices['messages'].append(("success", f"🎉 Successfully generated question bank with {total} questions!"))
+            if job['stored'] is not None:
+                notices['messages'].append(("info", f"🗄️ Saved {job['stored']} new questions to the stored {job['subject_code']} question bank"))
+        else:
+            st.session_state.generated_papers = result
+            notices['messages'].append(("success", f"🎉 Successfully generated {len(result.get('generated_papers', []))} unique question papers!"))
+        notices['messages'] += [("warning", f"⚠️ {warning}") for warning in job['result'].get('warnings', [])]
+        notices['celebrate'] = True
+    elif job['state'] == 'cancelled':
+        notices['messages'].append(("warning", f"⏹️ The {noun} generation was cancelled"))
+    else:
+        notices['messages'].append(("error", f"Error generating {noun}: {job['error']}"))
+    st.session_state.generation_notices = notices
+    st.session_state.generation_job_id = None
+    st.query_params.pop("generation_job", None)
 
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.3,
-            max_tokens=16000,
-            response_format={"type": "json_object"}
+@st.fragment(run_every=GENERATION_POLL_SECONDS)
+def display_generation_job():
+    """Poll the session's generation job and show its progress
+    
+    The job runs on the shared generation pool, not in this script, so
+    reruns, reloads and dropped connections do not stop it. Once it
+    finishes its result moves into st.session_state.
+    """
+    job_id = st.session_state.get('generation_job_id')
+    if not job_id:
+        return
+    
+    job = get_generation_job(job_id)
+    if job is None:
+        st.warning("⚠️ The generation job is no longer available. Please generate again.")
+        st.session_state.generation_job_id = None
+        st.query_params.pop("generation_job", None)
+        return
+    if job['state'] not in ('queued', 'running'):
+        _finish_generation_job(job)
+        st.rerun()
+    
+    noun = "question bank" if job['kind'] == "question_bank" else "question papers"
+    progress = job['progress']
+    if job['state'] == 'queued':
+        st.info(f"🕒 The {noun} generation is queued behind other generations...")
+    else:
+        elapsed = time.time() - job['started_at']
+        st.progress(
+            min(progress['done'] / progress['total'], 1.0) if progress['total'] else 0.0,
+            text=f"🎯 Generating the {noun}: {progress['done']}/{progress['total']} {progress['unit']} · {elapsed:.0f}s"
         )
-        
-        generation_result = json.loads(response.choices[0].message.content)
-        return generation_result
-        
-    except Exception as e:
-        st.error(f"Error generating papers: {str(e)}")
-        return None
-
-def upload_files_to_textract(file1, file2, csm_id="default_subject"):
-    """Upload files to Textract API and get extracted text"""
-    try:
-        files = {
-            'paper1': (file1.name, file1.getvalue(), 'application/pdf'),
-            'paper2': (file2.name, file2.getvalue(), 'application/pdf')
-        }
-        data = {'csm_id': csm_id, 'mode':'1'}
-        
-        with st.spinner("🔍 Extracting text using Textract... This may take a few minutes."):
-            response = requests.post(TEXTRACT_API_URL, files=files, data=data, timeout=500)
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            if 'results' in response_data:
-                return response_data
-            elif 'body' in response_data:
-                body_data = response_data['body']
-                if isinstance(body_data, str):
-                    body_data = json.loads(body_data)
-                return body_data
-            else:
-                st.error("Unexpected response format from Textract API")
-                return None
-        else:
-            st.error(f"Textract API error: {response.status_code} - {response.text}")
-            return None
-            
-    except requests.exceptions.Timeout:
-        st.error("⏰ Request timed out. Textract processing took too long.")
-        return None
-    except Exception as e:
-        st.error(f"❌ Error uploading to Textract: {str(e)}")
-        return None
+    
+    if job['cancel_requested']:
+        st.caption("⏹️ Cancelling...")
+    elif st.button("⏹️ Cancel generation", key="cancel_generation_job"):
+        cancel_generation_job(job_id)
+    
+    if job['kind'] == "question_bank":
+        _render_live_bank(progress)
+    else:
+        _render_live_papers(progress)
 
 def display_and_edit_analysis(analysis_result):
     """Display analysis results with editable fields for calibration"""
@@ -533,6 +241,24 @@ def display_and_edit_analysis(analysis_result):
     
     score = analysis_result.get('compatibility_score', 0)
     st.success(f"✅ Papers are compatible! Compatibility Score: {score}%")
+    if len(analysis_result.get('paper_analyses', [])) > 1:
+        st.caption(analysis_result.get('compatibility_reason', ''))
+    
+    prompt_stats = analysis_result.get('prompt_stats', [])
+    if prompt_stats:
+        before = sum(stats['tokens_before'] for stats in prompt_stats)
+        after = sum(stats['tokens_after'] for stats in prompt_stats)
+        with st.expander(f"🧮 Prompt size: {after:,} tokens sent ({before:,} before normalization)"):
+            st.dataframe([
+                {
+                    "Paper": stats['filename'],
+                    "Tokens before": stats['tokens_before'],
+                    "Tokens after": stats['tokens_after'],
+                    "Budget": stats['budget'],
+                    "Compaction": ", ".join(stats['steps'])
+                }
+                for stats in prompt_stats
+            ], hide_index=True, use_container_width=True)
     
     # Subject Analysis
     subject_analysis = analysis_result.get('subject_analysis', {})
@@ -736,31 +462,222 @@ def display_and_edit_analysis(analysis_result):
         
         if submitted:
             # Build calibrated structure
-            calibrated_structure = {
-                "exam_info": {
-                    "total_marks": total_marks,
-                    "exam_duration_minutes": duration,
-                    "instruction_text": instruction_text,
-                    "subject_name": exam_info.get('subject_name', 'Unknown Subject')
-                },
-                "sections": section_configs,
-                "overall_distributions": {
-                    "co_distribution": co_values
-                },
-                "generation_params": {
-                    "num_papers": num_papers,
-                    "full_syllabus_topics": syllabus_coverage.get('full_syllabus_topics', []),
-                    "sample_paper_topics": syllabus_coverage.get('topics_in_sample_papers', []),
-                    "course_objectives": list(co_values.keys()),
-                    "question_style_patterns": question_style.get('typical_question_formats', []),
-                    "use_full_syllabus_scope": True
-                }
-            }
+            calibrated_structure = calibrate_structure(analysis_result, {
+                "total_marks": total_marks,
+                "exam_duration_minutes": duration,
+                "instruction_text": instruction_text,
+                "num_papers": num_papers,
+                "co_distribution": co_values,
+                "sections": section_configs
+            })
             
             return calibrated_structure, True
     
     return None, False
 
+def _paper_question_labels(papers):
+    """(label, question) for every question of the papers, labelled like 'Paper 2 · UNIT-I · Q1a'"""
+    return [
+        (f"{paper.get('paper_id', f'Paper {paper_index + 1}')} · {section.get('section_id', 'Section')} · Q{question.get('question_number', '?')}", question)
+        for paper_index, paper in enumerate(papers)
+        for section in paper.get('sections', [])
+        for q_group in section.get('questions', [])
+        for question in (q_group.get('options', []) if q_group.get('internal_choice', False) else [q_group])
+    ]
+
+def _bank_question_labels(question_bank):
+    """(label, question) for every question of the bank, labelled like 'UNIT-I · UNIT-I_Q003'"""
+    return [
+        (f"{section_id} · {question.get('question_id', f'{section_id}_Q{i+1:03d}')}", question)
+        for section_id, questions in question_bank.items()
+        for i, question in enumerate(questions)
+    ]
+
+def _render_duplicate_report(labeled_questions):
+    """Show near-duplicate clusters; returns {id(question): [labels of its near-duplicates]} for inline flags"""
+    clusters = cluster_near_duplicates([question.get('question_text', '') for _, question in labeled_questions])
+    if not clusters:
+        st.caption(f"🔁 No near-duplicates among {len(labeled_questions)} questions")
+        return {}
+    
+    duplicate_count = sum(len(members) - 1 for members in clusters)
+    with st.expander(f"🔁 {duplicate_count} near-duplicate question(s) in {len(clusters)} group(s)"):
+        # One element per group, and at most a page of groups, however many duplicates there are
+        for n, members in enumerate(clusters[:BANK_PAGE_SIZE], 1):
+            st.write(f"**Group {n}**  \n" + "  \n".join(
+                f"• *{labeled_questions[i][0]}*: {labeled_questions[i][1].get('question_text', '')}" for i in members
+            ))
+        if len(clusters) > BANK_PAGE_SIZE:
+            st.caption(f"...and {len(clusters) - BANK_PAGE_SIZE} more group(s)")
+    
+    flags = {}
+    for members in clusters:
+        for i in members:
+            flags[id(labeled_questions[i][1])] = [labeled_questions[j][0] for j in members if j != i]
+    return flags
+
+def _render_duplicate_flag(question, duplicates):
+    if duplicates and id(question) in duplicates:
+        st.caption(f"🔁 Near-duplicate of {', '.join(duplicates[id(question)])}")
+
+def _render_question_group(q_group, duplicates=None):
+    """Render one question group of a paper (internal choice options or a direct question)"""
+    if q_group.get('internal_choice', False):
+        st.write(f"**{q_group.get('choice_instruction', 'Choose one option')}**")
+        
+        for option in q_group.get('options', []):
+            col1, col2, col3, col4, col5 = st.columns([3, 1, 1, 1, 1])
+            
+            with col1:
+                st.write(f"**{option.get('question_number', '')}** {option.get('question_text', '')}")
+                _render_duplicate_flag(option, duplicates)
+                
+                # Display visual aid if present
+                visual_aid = option.get('visual_aid', {})
+                if visual_aid and visual_aid.get('content'):
+                    if visual_aid.get('type') == 'ascii':
+                        st.code(visual_aid['content'], language=None)
+                    else:
+                        st.info(f"📝 **Visualization Guide:** {visual_aid['content']}")
+                
+                # Display given data if present
+                given_data = option.get('given_data', [])
+                if given_data:
+                    st.write("**Given:**  \n" + "  \n".join(f"• {item}" for item in given_data))
+                
+                # Display what to find
+                find_text = option.get('find', '')
+                if find_text:
+                    st.write(f"**Find:** {find_text}")
+                    
+            with col2:
+                st.write(f"**{option.get('marks', 0)} marks**")
+            with col3:
+                st.write(f"{option.get('co', '')}")
+            with col4:
+                st.write(f"{option.get('bloom_level', '')}")
+            with col5:
+                st.write(f"{option.get('question_type', '')}")
+                
+            st.divider()
+    else:
+        # Direct questions without internal choice
+        col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
+        
+        with col1:
+            st.write(f"**{q_group.get('question_number', '')}** {q_group.get('question_text', '')}")
+            _render_duplicate_flag(q_group, duplicates)
+            
+            # Display visual aid if present
+            visual_aid = q_group.get('visual_aid', {})
+            if visual_aid and visual_aid.get('content'):
+                if visual_aid.get('type') == 'ascii':
+                    st.code(visual_aid['content'], language=None)
+                else:
+                    st.info(f"📝 **Visualization Guide:** {visual_aid['content']}")
+            
+            # Display given data if present
+            given_data = q_group.get('given_data', [])
+            if given_data:
+                st.write("**Given:**  \n" + "  \n".join(f"• {item}" for item in given_data))
+            
+            # Display what to find
+            find_text = q_group.get('find', '')
+            if find_text:
+                st.write(f"**Find:** {find_text}")
+                
+        with col2:
+            st.write(f"**{q_group.get('marks', 0)} marks**")
+        with col3:
+            st.write(f"{q_group.get('co', '')}")
+        with col4:
+            st.write(f"{q_group.get('bloom_level', '')}")
+            
+        st.divider()
+
+def _live_progress_header(container, started, noun):
+    """Return an updater for the 'N received' line above a live preview"""
+    header = container.empty()
+    state = {'count': 0, 'first': None}
+
+    def update():
+        state['count'] += 1
+        if state['first'] is None:
+            state['first'] = time.time() - started
+        header.info(f"⏳ {state['count']} {noun} received so far · first after {state['first']:.1f}s")
+
+    return update
+
+def _live_analysis_renderer(container):
+    """Return an on_progress callback that lists detected sections while analysis streams in"""
+    update_header = _live_progress_header(container, time.time(), "sections")
+
+    def on_progress(kind, data):
+        if kind != "section":
+            return
+        section = data['section']
+        update_header()
+        container.write(
+            f"• {data.get('filename', '')} - **{section.get('section_id', 'Section')}**: "
+            f"{section.get('question_count', '?')} questions, {section.get('total_section_marks', '?')} marks"
+        )
+
+    return on_progress
+
+def _paper_regeneration_targets(paper):
+    """(label, (section_index, group_index, option_index)) for every part of a paper that can be regenerated"""
+    targets = []
+    for section_index, section in enumerate(paper.get('sections', [])):
+        section_id = section.get('section_id', f'Section {section_index + 1}')
+        targets.append((f"{section_id} · whole section", (section_index, None, None)))
+        for group_index, q_group in enumerate(section.get('questions', [])):
+            number = q_group.get('question_number', group_index + 1)
+            if q_group.get('internal_choice', False):
+                targets.append((f"{section_id} · Q{number} (1a/1b pair)", (section_index, group_index, None)))
+                for option_index, option in enumerate(q_group.get('options', [])):
+                    targets.append((f"{section_id} · Q{option.get('question_number', '?')}", (section_index, group_index, option_index)))
+            else:
+                targets.append((f"{section_id} · Q{number}", (section_index, group_index, None)))
+    return targets
+
+def _queue_paper_regeneration(paper_index, targets):
+    """Button callback: remember what to regenerate so it runs before the papers are drawn"""
+    label, target = targets[st.session_state[f"regen_target_{paper_index}"]]
+    st.session_state.pending_paper_regeneration = {
+        "paper_index": paper_index,
+        "label": label,
+        "target": target,
+        "note": st.session_state.get(f"regen_note_{paper_index}", "")
+    }
+
+def _render_paper_regeneration(paper_index, paper):
+    """Controls to regenerate one question, 1a/1b pair or section of a paper in place"""
+    targets = _paper_regeneration_targets(paper)
+    if not targets or not st.session_state.get('calibrated_structure'):
+        return
+    
+    st.write("**🔁 Regenerate part of this paper**")
+    col1, col2, col3 = st.columns([2, 3, 1])
+    with col1:
+        st.selectbox("Part", range(len(targets)), format_func=lambda n: targets[n][0], key=f"regen_target_{paper_index}")
+    with col2:
+        st.text_input("What is wrong with it (optional)", key=f"regen_note_{paper_index}", placeholder="e.g. too easy, missing data")
+    with col3:
+        st.button("🔁 Regenerate", key=f"regen_paper_{paper_index}", use_container_width=True,
+                  on_click=_queue_paper_regeneration, args=(paper_index, targets))
+
+def _apply_paper_regeneration(generation_result, pending):
+    """Run a queued paper regeneration and report the outcome"""
+    paper_index = pending['paper_index']
+    paper_id = generation_result['generated_papers'][paper_index].get('paper_id', f'Paper {paper_index + 1}')
+    with st.spinner(f"🔁 Regenerating {paper_id} · {pending['label']}..."):
+        result = _run_stage(
+            "Error regenerating questions", regenerate_paper_part,
+            st.session_state.calibrated_structure, generation_result, paper_index, *pending['target'], note=pending['note']
+        )
+    if result:
+        st.success(f"✅ {paper_id} · {pending['label']}: replaced {len(result['replaced'])} question(s)")
+
 def display_generated_papers(generation_result):
     """Display generated question papers with download options"""
     st.subheader("📄 Generated Question Papers")
@@ -769,6 +686,10 @@ def display_generated_papers(generation_result):
         st.error("❌ No papers were generated")
         return
     
+    pending = st.session_state.pop('pending_paper_regeneration', None)
+    if pending:
+        _apply_paper_regeneration(generation_result, pending)
+    
     generated_papers = generation_result.get('generated_papers', [])
     generation_summary = generation_result.get('generation_summary', {})
     
@@ -787,104 +708,48 @@ def display_generated_papers(generation_result):
     if 'syllabus_utilization' in generation_summary:
         st.info(f"📚 **Syllabus Utilization:** {generation_summary['syllabus_utilization']}")
     
+    if generation_summary.get('assembled_from_bank'):
+        st.caption("🧩 Assembled locally from the question bank")
+        for note in generation_summary.get('assembly_notes', []):
+            st.warning(f"⚠️ {note}")
+    
     st.success("✅ All papers generated successfully!")
     
-    # Display each paper
-    for i, paper in enumerate(generated_papers):
-        with st.expander(f"📋 {paper.get('paper_id', f'Paper {i+1}')} - {paper.get('difficulty_level', 'Unknown')} Level"):
-            
-            # Paper header info
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.write(f"**Total Marks:** {paper.get('total_marks', 0)}")
-            with col2:
-                st.write(f"**Duration:** {paper.get('exam_duration', 0)} minutes")
-            with col3:
-                st.write(f"**Difficulty:** {paper.get('difficulty_level', 'Unknown')}")
-            
-            st.write(f"**Instructions:** {paper.get('instructions', '')}")
+    duplicates = _render_duplicate_report(_paper_question_labels(generated_papers))
+    
+    # Only the selected paper is rendered, however many were generated
+    if not generated_papers:
+        return
+    i = st.selectbox(
+        "📋 Paper",
+        range(len(generated_papers)),
+        format_func=lambda n: f"{generated_papers[n].get('paper_id', f'Paper {n+1}')} - {generated_papers[n].get('difficulty_level', 'Unknown')} Level",
+        key="paper_view_index"
+    )
+    paper = generated_papers[i]
+    with st.container(border=True):
+        
+        # Paper header info
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.write(f"**Total Marks:** {paper.get('total_marks', 0)}")
+        with col2:
+            st.write(f"**Duration:** {paper.get('exam_duration', 0)} minutes")
+        with col3:
+            st.write(f"**Difficulty:** {paper.get('difficulty_level', 'Unknown')}")
+        
+        st.write(f"**Instructions:** {paper.get('instructions', '')}")
+        
+        # Display questions by section
+        sections = paper.get('sections', [])
+        for section in sections:
+            st.write(f"### {section.get('section_id', 'Section')}: {section.get('section_name', '')}")
             
-            # Display questions by section
-            sections = paper.get('sections', [])
-            for section in sections:
-                st.write(f"### {section.get('section_id', 'Section')}: {section.get('section_name', '')}")
-                
-                questions = section.get('questions', [])
-                for q_group in questions:
-                    if q_group.get('internal_choice', False):
-                        st.write(f"**{q_group.get('choice_instruction', 'Choose one option')}**")
-                        
-                        for option in q_group.get('options', []):
-                            col1, col2, col3, col4, col5 = st.columns([3, 1, 1, 1, 1])
-                            
-                            with col1:
-                                st.write(f"**{option.get('question_number', '')}** {option.get('question_text', '')}")
-                                
-                                # Display visual aid if present
-                                visual_aid = option.get('visual_aid', {})
-                                if visual_aid and visual_aid.get('content'):
-                                    if visual_aid.get('type') == 'ascii':
-                                        st.code(visual_aid['content'], language=None)
-                                    else:
-                                        st.info(f"📝 **Visualization Guide:** {visual_aid['content']}")
-                                
-                                # Display given data if present
-                                given_data = option.get('given_data', [])
-                                if given_data:
-                                    st.write("**Given:**")
-                                    for item in given_data:
-                                        st.write(f"• {item}")
-                                
-                                # Display what to find
-                                find_text = option.get('find', '')
-                                if find_text:
-                                    st.write(f"**Find:** {find_text}")
-                                    
-                            with col2:
-                                st.write(f"**{option.get('marks', 0)} marks**")
-                            with col3:
-                                st.write(f"{option.get('co', '')}")
-                            with col4:
-                                st.write(f"{option.get('bloom_level', '')}")
-                            with col5:
-                                st.write(f"{option.get('question_type', '')}")
-                                
-                            st.divider()
-                    else:
-                        # Direct questions without internal choice
-                        col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
-                        
-                        with col1:
-                            st.write(f"**{q_group.get('question_number', '')}** {q_group.get('question_text', '')}")
-                            
-                            # Display visual aid if present
-                            visual_aid = q_group.get('visual_aid', {})
-                            if visual_aid and visual_aid.get('content'):
-                                if visual_aid.get('type') == 'ascii':
-                                    st.code(visual_aid['content'], language=None)
-                                else:
-                                    st.info(f"📝 **Visualization Guide:** {visual_aid['content']}")
-                            
-                            # Display given data if present
-                            given_data = q_group.get('given_data', [])
-                            if given_data:
-                                st.write("**Given:**")
-                                for item in given_data:
-                                    st.write(f"• {item}")
-                            
-                            # Display what to find
-                            find_text = q_group.get('find', '')
-                            if find_text:
-                                st.write(f"**Find:** {find_text}")
-                                
-                        with col2:
-                            st.write(f"**{q_group.get('marks', 0)} marks**")
-                        with col3:
-                            st.write(f"{q_group.get('co', '')}")
-                        with col4:
-                            st.write(f"{q_group.get('bloom_level', '')}")
-                            
-                        st.divider()
+            questions = section.get('questions', [])
+            for q_group in questions:
+                _render_question_group(q_group, duplicates)
+        
+        _render_paper_regeneration(i, paper)
     
     # Download options
     st.subheader("💾 Download Options")
@@ -903,10 +768,313 @@ def display_generated_papers(generation_result):
         )
     
     with col2:
-        st.button("📄 Generate PDF Downloads", type="secondary", use_container_width=True, 
-                 help="PDF generation feature - coming soon!")
+        _render_pdf_export(generation_result)
+
+def _render_pdf_export(generation_result):
+    """Render the papers to PDF on request and offer them as one ZIP"""
+    from qpg_export import export_papers_zip
+    
+    exam_info = (st.session_state.get('calibrated_structure') or {}).get('exam_info', {})
+    content_key = hashlib.sha256(
+        json.dumps([generation_result.get('generated_papers', []), exam_info], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    
+    export = st.session_state.get('pdf_export')
+    if not export or export['key'] != content_key:
+        if st.button("📄 Generate PDF Downloads", type="secondary", use_container_width=True,
+                     help="Render every paper to PDF; unchanged papers are served from the PDF cache"):
+            with st.spinner("📄 Rendering PDFs..."):
+                try:
+                    data, stats = export_papers_zip(generation_result, exam_info)
+                except Exception as e:
+                    st.error(f"❌ PDF export failed: {str(e)}")
+                    return
+            export = st.session_state.pdf_export = {"key": content_key, "data": data, "stats": stats}
+        else:
+            return
+    
+    st.download_button(
+        label="📥 Download All Papers (PDF, ZIP)",
+        data=export['data'],
+        file_name=f"question_papers_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+        mime="application/zip",
+        type="secondary",
+        use_container_width=True
+    )
+    stats = export['stats']
+    st.caption(f"📄 {stats['rendered']} rendered, {stats['cached']} from cache in {stats['seconds']:.1f}s")
+
+def _render_bank_question(question, section_id, i, duplicates=None):
+    """Render one question bank entry"""
+    st.write(f"**Question {question.get('question_id', f'{section_id}_Q{i+1:03d}')}**")
+    _render_duplicate_flag(question, duplicates)
+    
+    col1, col2, col3, col4, col5 = st.columns([3, 1, 1, 1, 1])
+    
+    with col1:
+        st.write(question.get('question_text', ''))
+        
+        # Display visual aid if present
+        visual_aid = question.get('visual_aid', {})
+        if visual_aid and visual_aid.get('content'):
+            if visual_aid.get('type') == 'ascii':
+                st.code(visual_aid['content'], language=None)
+            else:
+                st.info(f"📝 **Visualization:** {visual_aid['content']}")
+        
+        # Display given data if present
+        given_data = question.get('given_data', [])
+        if given_data:
+            st.write("**Given:**  \n" + "  \n".join(f"• {item}" for item in given_data))
+        
+        # Display what to find
+        find_text = question.get('find', '')
+        if find_text:
+            st.write(f"**Find:** {find_text}")
+            
+        # Solution approach if provided
+        solution_approach = question.get('solution_approach', '')
+        if solution_approach:
+            st.write(f"**Approach:** {solution_approach}")
+    
+    with col2:
+        st.write(f"**{question.get('marks', 0)} marks**")
+        st.write(f"**{question.get('difficulty', 'Unknown').title()}**")
+    
+    with col3:
+        st.write(f"**{question.get('co', '')}**")
+    
+    with col4:
+        st.write(f"**{question.get('bloom_level', '')}**")
+    
+    with col5:
+        st.write(f"**{question.get('question_type', '').replace('_', ' ').title()}**")
+        st.write(f"*{question.get('topic', '')}*")
+    
+    st.divider()
+
+BANK_FILTER_LABELS = {
+    "section_id": "Section",
+    "difficulty": "Difficulty",
+    "bloom_level": "Bloom Level",
+    "question_type": "Question Type",
+    "co": "CO",
+    "topic": "Topic"
+}
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _bank_frame(content_hash, _question_bank):
+    """The bank as one row per question: filter columns, lowercased text and (section_id, position)
+
+    Cached by content_hash; _question_bank is not hashed by Streamlit.
+    """
+    import pandas as pd
+    records = [
+        (section_id, position, question.get('question_text', '').lower(),
+         *(question.get(column) for column in QuestionBankStore.FILTER_COLUMNS if column != 'section_id'))
+        for section_id, questions in _question_bank.items()
+        for position, question in enumerate(questions)
+    ]
+    return pd.DataFrame.from_records(records, columns=[
+        'section_id', 'position', 'text',
+        *(column for column in QuestionBankStore.FILTER_COLUMNS if column != 'section_id')
+    ])
+
+def _distribution_text(column):
+    """'• Easy: 12 (40%)' lines for the values of a bank table column"""
+    counts = column.fillna('unspecified').astype(str).value_counts()
+    return "  \n".join(
+        f"• {str(value).replace('_', ' ').title()}: {count} ({count / counts.sum():.0%})" for value, count in counts.items()
+    ) or "• None"
+
+def _bank_table(question_bank):
+    """Columnar view of a generated bank, rebuilt only when its content changes (e.g. after a regeneration)"""
+    content_hash = hashlib.sha256(json.dumps(question_bank, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return _bank_frame(content_hash, question_bank)
 
-def display_question_bank(question_bank_result):
+def _bank_facets(table):
+    """In-memory counterpart of QuestionBankStore.facets for a single generated bank"""
+    return {
+        column: sorted(table[column].value_counts(dropna=True).items(), key=lambda item: str(item[0]))
+        for column in QuestionBankStore.FILTER_COLUMNS
+    }
+
+def _filter_bank(table, question_bank, filters, search):
+    """Filter a generated bank in memory (used when the question store is unavailable)"""
+    import pandas as pd
+    mask = pd.Series(True, index=table.index)
+    for column, value in filters.items():
+        mask &= table[column] == value
+    for word in re.findall(r'\w+', (search or '').lower()):
+        mask &= table['text'].str.contains(word, regex=False)
+    matches = table.loc[mask, ['section_id', 'position']]
+    return [
+        dict(question_bank[section_id][position], section_id=section_id)
+        for section_id, position in zip(matches['section_id'], matches['position'])
+    ]
+
+def _page_bounds(total, key, reset_on):
+    """(start, stop) of the page to show, with a page picker when there is more than one page
+
+    The picker goes back to the first page whenever reset_on (e.g. the active filters) changes.
+    """
+    pages = max(1, -(-total // BANK_PAGE_SIZE))
+    if st.session_state.get(f"{key}_reset_on") != reset_on or st.session_state.get(key, 1) > pages:
+        st.session_state[key] = 1
+    st.session_state[f"{key}_reset_on"] = reset_on
+    if pages > 1:
+        col1, col2 = st.columns([1, 3])
+        with col1:
+            st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, step=1, key=key)
+    start = (st.session_state[key] - 1) * BANK_PAGE_SIZE
+    stop = min(total, start + BANK_PAGE_SIZE)
+    if pages > 1:
+        with col2:
+            st.caption(f"Showing questions {start + 1}-{stop} of {total}")
+    return start, stop
+
+@st.fragment
+def _render_bank_browser(question_bank, subject_code):
+    """Filter and list questions: from the persistent store for subject_code, else from question_bank
+
+    Runs as a fragment and draws one page at a time, so changing a filter or
+    page only redraws the browser, and never more than BANK_PAGE_SIZE questions.
+    """
+    st.subheader("🔍 Filter Questions")
+    
+    facets = None
+    if subject_code:
+        try:
+            facets = question_store.facets(subject_code)
+        except sqlite3.Error as e:
+            st.warning(f"⚠️ Question store unavailable, filtering this generation only: {str(e)}")
+    from_store = facets is not None
+    if not from_store:
+        table = _bank_table(question_bank)
+        facets = _bank_facets(table)
+    
+    filters = {}
+    columns = st.columns(3)
+    for n, (column, label) in enumerate(BANK_FILTER_LABELS.items()):
+        counts = dict(facets.get(column, []))
+        with columns[n % 3]:
+            selected = st.selectbox(
+                f"Filter by {label}",
+                [None] + list(counts),
+                format_func=lambda value, label=label, counts=counts: f"All ({label})" if value is None else f"{value} ({counts.get(value, 0)})",
+                key=f"bank_filter_{column}"
+            )
+        if selected is not None:
+            filters[column] = selected
+    search = st.text_input("Search question text", key="bank_search", placeholder="e.g. binary search tree")
+    
+    # Display filtered questions
+    st.subheader("📋 Question Bank Details")
+    
+    reset_on = json.dumps([filters, search], sort_keys=True, default=str)
+    if from_store:
+        total = question_store.count(subject_code, filters, search)
+        st.caption(f"🗄️ {total} matching questions in the stored {subject_code} bank (all sessions)")
+        start, stop = _page_bounds(total, "bank_page", reset_on)
+        page = question_store.query(subject_code, filters, search, limit=BANK_PAGE_SIZE, offset=start)
+        # The stored bank can be huge, so near-duplicates are looked for on this page only
+        labeled = page
+    else:
+        rows = _filter_bank(table, question_bank, filters, search)
+        start, stop = _page_bounds(len(rows), "bank_page", reset_on)
+        page = rows[start:stop]
+        labeled = rows
+    
+    filtered_bank = {}
+    for row in labeled:
+        filtered_bank.setdefault(row['section_id'], []).append(row)
+    duplicates = _render_duplicate_report(_bank_question_labels(filtered_bank))
+    
+    page_bank = {}
+    for row in page:
+        page_bank.setdefault(row['section_id'], []).append(row)
+    for section_id, page_questions in page_bank.items():
+        st.write(f"#### 📖 {section_id} - {len(page_questions)} question(s) on this page")
+        for i, question in enumerate(page_questions):
+            _render_bank_question(question, section_id, i, duplicates)
+
+def display_stored_question_bank(subject_code):
+    """Browse the persistent question bank of a subject without a generation in this session"""
+    st.subheader(f"🗄️ Stored Question Bank - {subject_code}")
+    _render_bank_browser({}, subject_code)
+
+def _queue_bank_regeneration():
+    """Button callback: remember what to regenerate so it runs before the bank is drawn"""
+    st.session_state.pending_bank_regeneration = {
+        "section_id": st.session_state.bank_regen_section,
+        "question_index": st.session_state.bank_regen_question,
+        "note": st.session_state.get("bank_regen_note", "")
+    }
+
+def _render_bank_regeneration(question_bank):
+    """Controls to regenerate one question or a whole section of the bank in place"""
+    if not question_bank or not st.session_state.get('calibrated_structure'):
+        return
+    
+    with st.expander("🔁 Regenerate questions"):
+        col1, col2 = st.columns(2)
+        with col1:
+            section_id = st.selectbox("Section", list(question_bank), key="bank_regen_section")
+        questions = question_bank.get(section_id, [])
+        with col2:
+            st.selectbox(
+                "Question",
+                [None] + list(range(len(questions))),
+                format_func=lambda i: f"All {len(questions)} questions of the section" if i is None
+                else f"{questions[i].get('question_id', f'{section_id}_Q{i+1:03d}')}: {questions[i].get('question_text', '')[:80]}",
+                key="bank_regen_question"
+            )
+        st.text_input("What is wrong with it (optional)", key="bank_regen_note", placeholder="e.g. too theoretical, ambiguous")
+        st.button("🔁 Regenerate", key="bank_regen_button", on_click=_queue_bank_regeneration)
+
+def _apply_bank_regeneration(question_bank_result, pending, subject_code):
+    """Run a queued bank regeneration and swap the questions in the question store too"""
+    calibrated_structure = st.session_state.calibrated_structure
+    label = pending['section_id'] if pending['question_index'] is None else f"{pending['section_id']} question {pending['question_index'] + 1}"
+    with st.spinner(f"🔁 Regenerating {label}..."):
+        result = _run_stage(
+            "Error regenerating questions", regenerate_bank_questions,
+            calibrated_structure, question_bank_result, pending['section_id'], pending['question_index'], note=pending['note']
+        )
+    if not result:
+        return
+    
+    st.success(f"✅ {label}: replaced {len(result['replaced'])} question(s)")
+    if subject_code:
+        try:
+            question_store.remove(subject_code, [question.get('question_text', '') for question in result['replaced']])
+            question_store.add(
+                subject_code, calibrated_structure.get('exam_info', {}).get('subject_name'), {pending['section_id']: result['added']}
+            )
+        except sqlite3.Error as e:
+            st.warning(f"⚠️ Could not update the stored question bank: {str(e)}")
+
+def _export_question_bank(question_bank, subject_code, file_format):
+    """Download button callback: build the export file when it is clicked"""
+    from qpg_export import export_question_bank
+    return export_question_bank(_bank_export_sections(question_bank, subject_code), file_format)
+
+def _bank_export_sections(question_bank, subject_code):
+    """(section_id, questions) pairs to export: the whole stored bank of subject_code if any, else this generation
+
+    Stored questions are read from the database section by section while the file is written.
+    """
+    if subject_code:
+        try:
+            section_ids = [value for value, _ in question_store.facets(subject_code).get('section_id', [])]
+        except sqlite3.Error:
+            section_ids = []
+        if section_ids:
+            return ((section_id, question_store.iter_query(subject_code, {'section_id': section_id}))
+                    for section_id in section_ids)
+    return question_bank.items()
+
+def display_question_bank(question_bank_result, subject_code=None):
     """Display generated question bank with filtering and download options"""
     st.subheader("📊 Generated Question Bank")
     
@@ -914,18 +1082,24 @@ def display_question_bank(question_bank_result):
         st.error("❌ No question bank was generated")
         return
     
+    pending = st.session_state.pop('pending_bank_regeneration', None)
+    if pending:
+        _apply_bank_regeneration(question_bank_result, pending, subject_code)
+    
     question_bank = question_bank_result.get('question_bank', {})
     bank_summary = question_bank_result.get('bank_summary', {})
+    # Counted from the questions themselves rather than taken from the model's bank_summary
+    table = _bank_table(question_bank)
     
     # Summary metrics
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        st.metric("Total Questions", bank_summary.get('total_questions_generated', 0))
+        st.metric("Total Questions", len(table))
     with col2:
         st.metric("Sections", len(question_bank))
     with col3:
-        st.metric("Topics Covered", len(bank_summary.get('topics_covered', [])))
+        st.metric("Topics Covered", table['topic'].nunique())
     with col4:
         st.metric("Syllabus Utilization", bank_summary.get('syllabus_utilization', 'Unknown'))
     
@@ -934,135 +1108,80 @@ def display_question_bank(question_bank_result):
     
     with col1:
         st.write("**Difficulty Distribution:**")
-        diff_dist = bank_summary.get('difficulty_distribution', {})
-        for level, pct in diff_dist.items():
-            st.write(f"• {level.title()}: {pct}%")
+        st.write(_distribution_text(table['difficulty']))
     
     with col2:
         st.write("**Question Type Distribution:**")
-        type_dist = bank_summary.get('question_type_distribution', {})
-        for qtype, pct in type_dist.items():
-            st.write(f"• {qtype.title()}: {pct}%")
+        st.write(_distribution_text(table['question_type']))
     
     st.success("✅ Question bank generated successfully!")
     
-    # Filtering options
-    st.subheader("🔍 Filter Questions")
-    
-    col1, col2, col3, col4 = st.columns(4)
-    
-    with col1:
-        selected_section = st.selectbox(
-            "Filter by Section",
-            ["All Sections"] + list(question_bank.keys())
-        )
-    
-    with col2:
-        selected_difficulty = st.selectbox(
-            "Filter by Difficulty", 
-            ["All Difficulties", "easy", "medium", "hard"]
-        )
-    
-    with col3:
-        selected_bloom = st.selectbox(
-            "Filter by Bloom Level",
-            ["All Bloom Levels", "Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]
-        )
-    
-    with col4:
-        selected_type = st.selectbox(
-            "Filter by Question Type",
-            ["All Types", "numerical_problem", "theoretical", "mixed"]
-        )
-    
-    # Display filtered questions
-    st.subheader("📋 Question Bank Details")
-    
-    for section_id, questions in question_bank.items():
-        if selected_section != "All Sections" and section_id != selected_section:
-            continue
-            
-        # Filter questions based on selections
-        filtered_questions = []
-        for q in questions:
-            if (selected_difficulty == "All Difficulties" or q.get('difficulty') == selected_difficulty) and \
-               (selected_bloom == "All Bloom Levels" or q.get('bloom_level') == selected_bloom) and \
-               (selected_type == "All Types" or q.get('question_type') == selected_type):
-                filtered_questions.append(q)
-        
-        if not filtered_questions:
-            continue
-            
-        with st.expander(f"📖 {section_id} - {len(filtered_questions)} questions (filtered)"):
-            
-            for i, question in enumerate(filtered_questions):
-                st.write(f"**Question {question.get('question_id', f'{section_id}_Q{i+1:03d}')}**")
-                
-                col1, col2, col3, col4, col5 = st.columns([3, 1, 1, 1, 1])
-                
-                with col1:
-                    st.write(question.get('question_text', ''))
-                    
-                    # Display visual aid if present
-                    visual_aid = question.get('visual_aid', {})
-                    if visual_aid and visual_aid.get('content'):
-                        if visual_aid.get('type') == 'ascii':
-                            st.code(visual_aid['content'], language=None)
-                        else:
-                            st.info(f"📝 **Visualization:** {visual_aid['content']}")
-                    
-                    # Display given data if present
-                    given_data = question.get('given_data', [])
-                    if given_data:
-                        st.write("**Given:**")
-                        for item in given_data:
-                            st.write(f"• {item}")
-                    
-                    # Display what to find
-                    find_text = question.get('find', '')
-                    if find_text:
-                        st.write(f"**Find:** {find_text}")
-                        
-                    # Solution approach if provided
-                    solution_approach = question.get('solution_approach', '')
-                    if solution_approach:
-                        st.write(f"**Approach:** {solution_approach}")
-                
-                with col2:
-                    st.write(f"**{question.get('marks', 0)} marks**")
-                    st.write(f"**{question.get('difficulty', 'Unknown').title()}**")
-                
-                with col3:
-                    st.write(f"**{question.get('co', '')}**")
-                
-                with col4:
-                    st.write(f"**{question.get('bloom_level', '')}**")
-                
-                with col5:
-                    st.write(f"**{question.get('question_type', '').replace('_', ' ').title()}**")
-                    st.write(f"*{question.get('topic', '')}*")
-                
-                st.divider()
+    _render_bank_regeneration(question_bank)
+    _render_bank_browser(question_bank, subject_code)
     
     # Download options
     st.subheader("💾 Download Question Bank")
     
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    export_help = (f"Every question stored for {subject_code}, one sheet per section" if subject_code
+                   else "This generation's questions, one sheet per section")
     
     with col1:
         json_data = json.dumps(question_bank_result, indent=2)
         st.download_button(
             label="📥 Download Complete Question Bank (JSON)",
             data=json_data,
-            file_name=f"question_bank_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+            file_name=f"question_bank_{timestamp}.json",
             mime="application/json",
             type="secondary",
             use_container_width=True
         )
     
+    # The files are only built when a button is clicked
     with col2:
-        st.button("📄 Export to Excel/PDF", type="secondary", use_container_width=True,
-                 help="Export functionality - coming soon!")
+        st.download_button(
+            label="📄 Export to Excel",
+            data=lambda: _export_question_bank(question_bank, subject_code, "xlsx"),
+            file_name=f"question_bank_{timestamp}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            type="secondary",
+            use_container_width=True,
+            help=export_help
+        )
+    
+    with col3:
+        st.download_button(
+            label="📄 Export to CSV",
+            data=lambda: _export_question_bank(question_bank, subject_code, "csv"),
+            file_name=f"question_bank_{timestamp}.csv",
+            mime="text/csv",
+            type="secondary",
+            use_container_width=True,
+            help=export_help
+        )
+
+def _render_run_metrics(area, run_metrics):
+    """Sidebar summary of this session's stages: time, OpenAI calls, tokens and estimated cost"""
+    summary = run_metrics.summary()
+    if not summary:
+        return
+    lines = []
+    for stage, totals in summary.items():
+        line = f"**{stage.replace('_', ' ').title()}**" + (f" ×{totals['count']}" if totals['count'] > 1 else "")
+        line += f": {totals['seconds']:.1f}s"
+        if totals['calls'] or totals['cache_hits']:
+            tokens = totals['prompt_tokens'] + totals['completion_tokens']
+            line += f" · {totals['calls']} LLM call(s), {tokens:,} tokens"
+            if totals['cache_hits']:
+                line += f", {totals['cache_hits']} cached"
+            line += f" · ${totals['cost_usd']:.4f}"
+        if totals['textract_calls']:
+            line += f" · {totals['textract_calls']} Textract call(s) {totals['textract_seconds']:.1f}s"
+        if totals['failures']:
+            line += f" · {totals['failures']} failed"
+        lines.append(line)
+    area.caption("📈 This session  \n" + "  \n".join(lines))
 
 def main():
     """Main Streamlit application"""
@@ -1081,12 +1200,35 @@ def main():
         
         st.header("⚙️ Settings")
         show_debug = st.checkbox("Show debug info", False)
+        bypass_llm_cache = st.checkbox(
+            "Bypass LLM response cache",
+            False,
+            help="Always call the model, e.g. to get a different set of questions for the same inputs"
+        )
+        cache_stats_area = st.empty()
+        scheduler_stats_area = st.empty()
+        run_metrics_area = st.empty()
+    
+    _llm_cache_bypass.set(bypass_llm_cache)
+    # Each browser session is its own tenant in the shared OpenAI queue
+    if 'llm_tenant' not in st.session_state:
+        st.session_state.llm_tenant = uuid.uuid4().hex
+    _llm_tenant.set(st.session_state.llm_tenant)
+    # Stage timings, tokens and cost of this session
+    if 'run_metrics' not in st.session_state:
+        st.session_state.run_metrics = RunMetrics(st.session_state.llm_tenant)
+    current_run.set(st.session_state.run_metrics)
     
     # Initialize session state
-    for key in ['textract_output', 'structure_analysis', 'calibrated_structure', 'generated_papers', 'question_bank', 'generation_type']:
+    for key in ['textract_output', 'textract_job_id', 'structure_analysis', 'calibrated_structure', 'generated_papers', 'question_bank', 'generation_type', 'generation_job_id']:
         if key not in st.session_state:
             st.session_state[key] = None
     
+    if not st.session_state.textract_job_id and not st.session_state.textract_output:
+        st.session_state.textract_job_id = st.query_params.get("textract_job")
+    if not st.session_state.generation_job_id:
+        st.session_state.generation_job_id = st.query_params.get("generation_job")
+    
     # Replace the "Step 1: Subject Information" section in your main() function:
 
     # Step 1: Subject Information
@@ -1171,58 +1313,39 @@ def main():
         st.header("📤 Step 2: Upload Sample Question Papers")
         st.info("💡 **Note:** Sample papers are used to learn the FORMAT and STRUCTURE. The complete syllabus above will be used for topic coverage in generated papers.")
         
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            uploaded_file1 = st.file_uploader(
-                "Upload First Sample Paper",
-                type=['pdf'],
-                key="file1",
-                help="Upload the first PDF question paper"
-            )
-        
-        with col2:
-            uploaded_file2 = st.file_uploader(
-                "Upload Second Sample Paper",
-                type=['pdf'],
-                key="file2",
-                help="Upload the second PDF question paper"
-            )
+        uploaded_files = st.file_uploader(
+            "Upload Sample Papers",
+            type=['pdf'],
+            accept_multiple_files=True,
+            key="sample_papers",
+            help="Upload one or more past PDF question papers - each one is analyzed separately and the results are merged"
+        )
         
         # Step 3: Extract Text
-        if uploaded_file1 and uploaded_file2:
+        if uploaded_files:
             st.header("🔍 Step 3: Extract Text from Papers")
             
+            use_textract_cache = st.checkbox(
+                "Reuse cached extractions",
+                value=True,
+                help="Skip Textract for papers that were already extracted with the same subject code"
+            )
+            
             if st.button("🚀 Extract Text with Textract", type="primary", use_container_width=True):
-                textract_output = upload_files_to_textract(uploaded_file1, uploaded_file2, csm_id or "default")
-                
-                if textract_output:
-                    st.session_state.textract_output = textract_output
-                    st.success("✅ Text extraction completed!")
-                    
-                    results = textract_output.get('results', [])
-                    if len(results) == 2:
-                        col1, col2 = st.columns(2)
-                        for i, result in enumerate(results):
-                            with col1 if i == 0 else col2:
-                                # Use 'file_name' instead of 'pdf_file'
-                                st.write(f"**📄 {result.get('file_name', 'Unknown File')}**")
-                                # Use 'final_status' if available, otherwise 'status'
-                                status = result.get('final_status', result.get('status', 'Unknown'))
-                                st.write(f"✅ Status: {status}")
-                                st.write(f"📊 Characters: {result.get('text_length', 0)}")
-                                
-                                # Show any errors if present
-                                if 'error' in result:
-                                    st.error(f"❌ Error: {result['error']}")
-                    else:
-                        st.warning(f"Expected 2 results, got {len(results)}")
-                        # Display whatever results we have
-                        for i, result in enumerate(results):
-                            st.write(f"**File {i+1}:** {result.get('file_name', 'Unknown')}")
-                            st.write(f"**Status:** {result.get('final_status', result.get('status', 'Unknown'))}")
-                            if 'error' in result:
-                                st.error(f"Error: {result['error']}")
+                st.session_state.textract_output = None
+                st.session_state.textract_job_id = submit_textract_job(
+                    [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files],
+                    csm_id or "default",
+                    use_cache=use_textract_cache
+                )
+                # Keep the job id in the URL so a reconnecting browser can reattach
+                st.query_params["textract_job"] = st.session_state.textract_job_id
+    
+    if st.session_state.textract_job_id:
+        display_textract_job()
+    elif st.session_state.textract_output:
+        st.success("✅ Text extraction completed!")
+        display_textract_results(st.session_state.textract_output)
     
     # Step 4: Analyze Structure
     if st.session_state.textract_output:
@@ -1231,36 +1354,39 @@ def main():
         if st.button("🔬 Analyze Papers with Complete Syllabus", type="primary", use_container_width=True):
             textract_results = st.session_state.textract_output.get('results', [])
             
-            if len(textract_results) >= 2:
-                # Take only the first 2 results if more than 2
+            if textract_results:
                 paper_texts = [
                     {
                         'filename': result.get('file_name', f'Paper_{i+1}'),  # Use 'file_name' instead of 'pdf_file'
                         'extracted_text': result.get('extracted_text', ''),
                         'text_length': result.get('text_length', 0)
                     }
-                    for i, result in enumerate(textract_results[:2])  # Only take first 2
+                    for i, result in enumerate(textract_results)
                 ]
                 
                 # Only proceed if we have valid extracted text
                 valid_papers = [p for p in paper_texts if p['extracted_text'] and len(p['extracted_text'].strip()) > 0]
                 
-                if len(valid_papers) >= 2:
-                    with st.spinner("🤖 Analyzing papers for structure patterns and syllabus mapping..."):
-                        structure_analysis = analyze_papers_with_syllabus(
-                            valid_papers[:2], subject_name, syllabus, course_objectives  # Use only first 2 valid papers
+                if valid_papers:
+                    live_area = st.empty()
+                    with st.spinner(f"🤖 Analyzing {len(valid_papers)} papers for structure patterns and syllabus mapping..."):
+                        structure_analysis = _run_stage(
+                            "Error in structure analysis", analyze_papers_with_syllabus,
+                            valid_papers, subject_name, syllabus, course_objectives,
+                            on_progress=_live_analysis_renderer(live_area.container())
                         )
+                    live_area.empty()
                     
                     if structure_analysis:
                         st.session_state.structure_analysis = structure_analysis
                         st.success("✅ Structure analysis completed!")
                 else:
-                    st.error("❌ Need at least 2 papers with valid extracted text to proceed with analysis")
+                    st.error("❌ Need at least one paper with valid extracted text to proceed with analysis")
                     st.write("**Available papers:**")
                     for i, paper in enumerate(paper_texts):
                         st.write(f"• {paper['filename']}: {paper['text_length']} characters")
             else:
-                st.error(f"❌ Need at least 2 extracted papers, got {len(textract_results)}")
+                st.error("❌ No extracted papers found")
     
     # Step 5: Calibrate Parameters
     if st.session_state.structure_analysis:
@@ -1323,18 +1449,22 @@ def main():
                 if st.button("🔄 Change Generation Type", type="secondary"):
                     st.session_state.generation_type = None
                     st.rerun()
+                
+                parallel_sections = st.checkbox(
+                    "Generate sections in parallel",
+                    value=True,
+                    help="One request per section chunk, run concurrently - faster and avoids truncated output"
+                )
             
             total_questions = questions_per_section * len(st.session_state.calibrated_structure.get('sections', []))
             st.info(f"Will generate approximately {total_questions} questions total across all sections")
             
-            if st.button("🚀 Generate Question Bank", type="primary", use_container_width=True):
-                with st.spinner(f"🎯 Generating comprehensive question bank with {questions_per_section} questions per section... This may take a few minutes."):
-                    question_bank = generate_question_bank(st.session_state.calibrated_structure, questions_per_section)
-                
-                if question_bank:
-                    st.session_state.question_bank = question_bank
-                    st.balloons()
-                    st.success(f"🎉 Successfully generated question bank with {total_questions}+ questions!")
+            if st.button("🚀 Generate Question Bank", type="primary", use_container_width=True,
+                         disabled=bool(st.session_state.generation_job_id)):
+                _start_generation_job(
+                    "question_bank", {"questions_per_section": questions_per_section, "parallel_sections": parallel_sections},
+                    csm_id, subject_name
+                )
         
         # Generate Paper Sets
         elif st.session_state.generation_type == "paper_sets":
@@ -1354,24 +1484,94 @@ def main():
                 if st.button("🔄 Change Generation Type", type="secondary"):
                     st.session_state.generation_type = None
                     st.rerun()
+                
+                parallel_papers = st.checkbox(
+                    "Generate papers in parallel",
+                    value=True,
+                    help="One request per paper, run concurrently, followed by a cross-paper duplicate check"
+                )
+            
+            # Only count the stored bank here; it is loaded when papers are actually assembled
+            try:
+                stored_count = question_store.count(csm_id)
+            except sqlite3.Error:
+                stored_count = 0
+            session_bank = (st.session_state.question_bank or {}).get('question_bank', {})
+            bank_size = stored_count or sum(len(questions) for questions in session_bank.values())
+            assemble_from_bank = False
+            if bank_size:
+                assemble_from_bank = st.checkbox(
+                    f"Assemble from the {csm_id} question bank ({bank_size} questions, no LLM calls)",
+                    value=False,
+                    help="Pick questions from the existing bank to meet the calibrated marks, distributions and internal choice"
+                )
             
             st.info(f"Will generate {num_papers} complete question papers with progressive difficulty (Easy → Hard)")
             
-            if st.button("🚀 Generate Question Paper Sets", type="primary", use_container_width=True):
-                with st.spinner(f"🎯 Generating {num_papers} unique question papers from complete syllabus... This may take a few minutes."):
-                    generated_papers = generate_question_papers(st.session_state.calibrated_structure, num_papers)
-                
+            if assemble_from_bank and st.button("🧩 Assemble Question Paper Sets", type="primary", use_container_width=True):
+                assembly_bank = {}
+                try:
+                    for question in question_store.iter_query(csm_id) if stored_count else ():
+                        assembly_bank.setdefault(question['section_id'], []).append(question)
+                except sqlite3.Error as e:
+                    st.warning(f"⚠️ Could not load the stored question bank: {str(e)}")
+                assembly_bank = assembly_bank or session_bank
+                generated_papers = _run_stage(
+                    "Error assembling papers", assemble_question_papers,
+                    st.session_state.calibrated_structure, assembly_bank, num_papers
+                )
                 if generated_papers:
                     st.session_state.generated_papers = generated_papers
-                    st.balloons()
-                    st.success(f"🎉 Successfully generated {num_papers} unique question papers!")
+                    st.success(f"🎉 Assembled {num_papers} question papers from the question bank!")
+            
+            if not assemble_from_bank and st.button("🚀 Generate Question Paper Sets", type="primary", use_container_width=True,
+                                                    disabled=bool(st.session_state.generation_job_id)):
+                _start_generation_job("papers", {"num_papers": num_papers, "parallel_papers": parallel_papers})
+    
+    # Generation runs as a background job; reattach to it after a rerun, reload or reconnect
+    if st.session_state.generation_job_id:
+        display_generation_job()
+    notices = st.session_state.pop('generation_notices', None)
+    if notices:
+        if notices['celebrate']:
+            st.balloons()
+        for level, message in notices['messages']:
+            getattr(st, level)(message)
     
     # Display Generated Content
     if st.session_state.generated_papers:
         display_generated_papers(st.session_state.generated_papers)
     
     if st.session_state.question_bank:
-        display_question_bank(st.session_state.question_bank)
+        display_question_bank(st.session_state.question_bank, csm_id)
+    elif csm_id:
+        try:
+            has_stored_questions = question_store.count(csm_id) > 0
+        except sqlite3.Error:
+            has_stored_questions = False
+        if has_stored_questions:
+            display_stored_question_bank(csm_id)
+    
+    # Cache statistics are drawn last so they include this run's lookups
+    try:
+        cache_stats = llm_cache.stats()
+        cache_stats_area.caption(
+            f"🗄️ LLM cache hit rate: {cache_stats['hit_rate']:.0%} "
+            f"({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']} lookups) · "
+            f"{cache_stats['entries']} entries, {cache_stats['size_bytes'] / (1024 * 1024):.1f} MB"
+        )
+    except sqlite3.Error:
+        cache_stats_area.caption("🗄️ LLM cache unavailable")
+    
+    queue_stats = openai_scheduler.stats()
+    job_stats = generation_job_stats()
+    scheduler_stats_area.caption(
+        f"🚦 OpenAI queue: {queue_stats['queued']} waiting, {queue_stats['in_flight']} in flight · "
+        f"wait avg {queue_stats['mean_wait_seconds']:.1f}s, p95 {queue_stats['p95_wait_seconds']:.1f}s · "
+        f"{queue_stats['retries']} retries ({queue_stats['rate_limited']} rate limited) · "
+        f"generation jobs: {job_stats['running']}/{job_stats['max_workers']} running, {job_stats['queued']} queued"
+    )
+    _render_run_metrics(run_metrics_area, st.session_state.run_metrics)
     
     # Debug Information
     if show_debug:
@@ -1389,6 +1589,13 @@ def main():
             if data:
                 with st.expander(title):
                     st.json(data)
+        
+        with st.expander("⏱️ Import times"):
+            st.caption("App modules are imported once per process; the heavy libraries on their first use")
+            st.dataframe(
+                [{"Module": name, "Seconds": round(seconds, 3)} for name, seconds in IMPORT_TIMINGS.items()],
+                hide_index=True, use_container_width=True
+            )
 
 if __name__ == "__main__":
     main()